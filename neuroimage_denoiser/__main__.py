@@ -1,17 +1,51 @@
 import argparse
-from alive_progress import alive_bar
-import h5py
-from scipy.ndimage import uniform_filter
-import numpy as np
+import torch
 import yaml
 
 from neuroimage_denoiser.utils.trainfiles import TrainFiles
-from neuroimage_denoiser.utils.dataloader import DataLoader
+from neuroimage_denoiser.utils.dataloader import create_dataloader
+from neuroimage_denoiser.utils.augmentation import BatchAugmentation
+from neuroimage_denoiser.utils.rawsource import raw_source_from_config
+from neuroimage_denoiser.utils.activitymapcache import DEFAULT_ACTIVITYMAP_CACHE_DIR
+from neuroimage_denoiser.utils.patchcache import (
+    DEFAULT_CACHE_DIR,
+    PatchCache,
+    remove_patch_cache,
+)
 from neuroimage_denoiser.model.unet import UNet
 from neuroimage_denoiser.model.train import train
 from neuroimage_denoiser.model.denoise import inference
+from neuroimage_denoiser.model.engine import export_torchscript, export_onnx
 from neuroimage_denoiser.model.gridsearch_train import gridsearch_train
+from neuroimage_denoiser.model.quantize import quantize
+from neuroimage_denoiser.model.service import serve
 from neuroimage_denoiser.utils.inferencespeed import eval_inferencespeed
+from neuroimage_denoiser.utils.normalizationspeed import eval_normalization_speed
+from neuroimage_denoiser.utils.h5patches import (
+    COMPRESSIONS,
+    STORAGE_DTYPES,
+    convert_legacy_h5,
+)
+from neuroimage_denoiser.filter_h5 import filter_patches
+
+
+def batch_size_type(value: str) -> int | str:
+    """
+    Parse a batch size argument, which is either a positive integer or "auto".
+    """
+    if value == "auto":
+        return value
+    try:
+        batch_size = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Batch size has to be a positive integer or 'auto', got '{value}'."
+        )
+    if batch_size < 1:
+        raise argparse.ArgumentTypeError(
+            f"Batch size has to be a positive integer or 'auto', got '{value}'."
+        )
+    return batch_size
 
 
 def main():
@@ -77,7 +111,70 @@ def main():
     pre_training_p.add_argument(
         "--memory_optimized",
         action="store_true",
-        help="Utilize optimized memory mode. Trades speed for lower memory usage",
+        help="Utilize optimized memory mode: process the recordings out-of-core in blocks of frames. Trades speed for lower memory usage",
+    )
+    pre_training_p.add_argument(
+        "--scratch_dir",
+        type=str,
+        default=None,
+        help="Directory for temporary files in memory optimized mode (default: system temp directory).",
+    )
+    pre_training_p.add_argument(
+        "--block_size",
+        type=int,
+        default=256,
+        help="Number of frames processed at once in memory optimized mode (default: 256).",
+    )
+    pre_training_p.add_argument(
+        "--dtype",
+        choices=["float32", "float64"],
+        default="float32",
+        help="Floating point type used for normalization and the stored patches (default: float32).",
+    )
+    pre_training_p.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for the selection of the background patches (default: random).",
+    )
+    pre_training_p.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes that extract the training examples of the files in parallel (default: 1).",
+    )
+    pre_training_p.add_argument(
+        "--compression",
+        choices=COMPRESSIONS,
+        default=None,
+        help="Compression of the patches in a new H5 file (default: None).",
+    )
+    pre_training_p.add_argument(
+        "--storage_dtype",
+        choices=STORAGE_DTYPES,
+        default=None,
+        help="Dtype of the patches in a new H5 file, float16 or int16 for compact storage (default: --dtype).",
+    )
+    pre_training_p.add_argument(
+        "--index_roi_sizes",
+        type=int,
+        nargs="+",
+        default=None,
+        help="ROI sizes for which the max. ROI-mean z-score of every patch is stored in the metadata, used by filter (default: --roi_size).",
+    )
+    pre_training_p.add_argument(
+        "--activitymap_cache_dir",
+        type=str,
+        nargs="?",
+        const=DEFAULT_ACTIVITYMAP_CACHE_DIR,
+        default=None,
+        help=f"Cache the activity maps in this directory, re-runs with another --min_z_score or --fgsplit reuse them (without a value: {DEFAULT_ACTIVITYMAP_CACHE_DIR}; default: no cache).",
+    )
+    pre_training_p.add_argument(
+        "--activitymap_cache_size",
+        type=float,
+        default=1.0,
+        help="Maximal size of the activity map cache in GB, the least recently used maps are deleted (default: 1.0).",
     )
     # Training
     train_p = subparsers.add_parser("train")
@@ -107,6 +204,57 @@ def main():
         help="Size of the Region of Interest (ROI)",
         required=True,
     )
+    filter_p.add_argument(
+        "--compression",
+        choices=COMPRESSIONS,
+        default=None,
+        help="Compression of the patches in the output H5 file (default: None).",
+    )
+    filter_p.add_argument(
+        "--storage_dtype",
+        choices=STORAGE_DTYPES,
+        default=None,
+        help="Dtype of the patches in the output H5 file, float16 or int16 for compact storage (default: dtype of the input).",
+    )
+    # Convert legacy H5 files
+    convert_h5_p = subparsers.add_parser("convert_h5")
+    convert_h5_p.add_argument(
+        "--h5",
+        type=str,
+        help="Path to the input H5 file (one dataset per patch)",
+        required=True,
+    )
+    convert_h5_p.add_argument(
+        "--output_h5", "-o", type=str, help="Path to the output H5 file", required=True
+    )
+    convert_h5_p.add_argument(
+        "--compression",
+        choices=COMPRESSIONS,
+        default=None,
+        help="Compression of the patches in the output H5 file (default: None).",
+    )
+    convert_h5_p.add_argument(
+        "--storage_dtype",
+        choices=STORAGE_DTYPES,
+        default=None,
+        help="Dtype of the patches in the output H5 file, float16 or int16 for compact storage (default: dtype of the input).",
+    )
+    # Shared in-RAM cache of the training patches
+    patch_cache_p = subparsers.add_parser("patch_cache")
+    patch_cache_p.add_argument(
+        "--h5", type=str, help="Path to the training H5 file", required=True
+    )
+    patch_cache_p.add_argument(
+        "--cache_dir",
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help=f"Directory of the cache (default: {DEFAULT_CACHE_DIR}).",
+    )
+    patch_cache_p.add_argument(
+        "--remove",
+        action="store_true",
+        help="Delete the cache instead of creating it.",
+    )
     # Denoise / Inference
     denoise_p = subparsers.add_parser("denoise")
     denoise_p.add_argument(
@@ -124,13 +272,229 @@ def main():
     denoise_p.add_argument(
         "--batchsize",
         "-b",
+        type=batch_size_type,
+        default=1,
+        help="Number of frames that are predicted at once, or 'auto' to tune it for the frame shape and device (default: 1).",
+    )
+    denoise_p.add_argument(
+        "--memory_budget",
+        type=float,
+        default=None,
+        help="Maximum memory in GB used with --batchsize auto (default: 80%% of free GPU memory or 50%% of available RAM).",
+    )
+    denoise_p.add_argument(
+        "--dtype",
+        choices=["float32", "float64"],
+        default="float32",
+        help="Floating point type used for the image data and normalization (default: float32).",
+    )
+    denoise_p.add_argument(
+        "--cpu", action="store_true", help="Force CPU and not use GPU."
+    )
+    denoise_p.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Read, denoise and write recordings in blocks of frames. Use for recordings larger than the RAM.",
+    )
+    denoise_p.add_argument(
+        "--block_size",
+        type=int,
+        default=256,
+        help="Number of frames per block in streaming mode (default: 256).",
+    )
+    denoise_p.add_argument(
+        "--tile_size",
+        type=int,
+        default=0,
+        help="Predict frames in overlapping square tiles of this size; the batch size then counts tiles (default: 0, full frames).",
+    )
+    denoise_p.add_argument(
+        "--tile_overlap",
+        type=int,
+        default=32,
+        help="Overlap of neighboring tiles in pixels (default: 32).",
+    )
+    denoise_p.add_argument(
+        "--queue_depth",
+        type=int,
+        default=1,
+        help="Directory mode: number of recordings read ahead and queued for writing while denoising; 0 disables pipelining (default: 1).",
+    )
+    denoise_p.add_argument(
+        "--workers",
         type=int,
         default=1,
-        help="Number of frames that are predicted at once.",
+        help="Directory mode: number of processes that denoise files in parallel, each with its own model (default: 1).",
+    )
+    denoise_p.add_argument(
+        "--backend",
+        choices=["torch", "onnxruntime"],
+        default="torch",
+        help="Inference backend; onnxruntime runs an ONNX model (see export_onnx) on the CPU (default: torch).",
+    )
+    denoise_p.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help="Number of threads used by the inference backend (default: backend default).",
     )
     denoise_p.add_argument(
+        "--quantized",
+        action="store_true",
+        help="Run an int8 model written by quantize; forces the CPU.",
+    )
+    # denoising service with warm models
+    serve_p = subparsers.add_parser("serve")
+    serve_p.add_argument(
+        "--modelpath", "-m", type=str, required=True, help="Path to modelweights."
+    )
+    serve_p.add_argument(
+        "--batchsize",
+        "-b",
+        type=batch_size_type,
+        default="auto",
+        help="Number of frames that are predicted at once, or 'auto' to tune it for the frame shape and device (default: auto).",
+    )
+    serve_p.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Address the service listens on (default: 127.0.0.1).",
+    )
+    serve_p.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="Port the service listens on (default: 8765).",
+    )
+    serve_p.add_argument(
+        "--num_models",
+        type=int,
+        default=1,
+        help="Number of loaded models that predict batches concurrently (default: 1).",
+    )
+    serve_p.add_argument(
+        "--max_wait",
+        type=float,
+        default=0.005,
+        help="Maximum time in seconds a partial batch waits for frames of further requests (default: 0.005).",
+    )
+    serve_p.add_argument(
+        "--dtype",
+        choices=["float32", "float64"],
+        default="float32",
+        help="Floating point type used for the image data and normalization (default: float32).",
+    )
+    serve_p.add_argument(
         "--cpu", action="store_true", help="Force CPU and not use GPU."
     )
+    serve_p.add_argument(
+        "--backend",
+        choices=["torch", "onnxruntime"],
+        default="torch",
+        help="Inference backend; onnxruntime runs an ONNX model (see export_onnx) on the CPU (default: torch).",
+    )
+    serve_p.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help="Number of threads used for inference, shared by all models with torch and per model with onnxruntime (default: backend default).",
+    )
+    serve_p.add_argument(
+        "--quantized",
+        action="store_true",
+        help="Run an int8 model written by quantize; forces the CPU.",
+    )
+    # export an optimized TorchScript archive for inference
+    export_ts_p = subparsers.add_parser("export_torchscript")
+    export_ts_p.add_argument(
+        "--modelpath", "-m", type=str, required=True, help="Path to modelweights."
+    )
+    export_ts_p.add_argument(
+        "--outputpath",
+        "-o",
+        type=str,
+        required=True,
+        help="Path to the TorchScript archive that will be written.",
+    )
+    export_ts_p.add_argument(
+        "--cpu", action="store_true", help="Force CPU and not use GPU."
+    )
+    # export an ONNX model for inference with ONNX Runtime
+    export_onnx_p = subparsers.add_parser("export_onnx")
+    export_onnx_p.add_argument(
+        "--modelpath", "-m", type=str, required=True, help="Path to modelweights."
+    )
+    export_onnx_p.add_argument(
+        "--outputpath",
+        "-o",
+        type=str,
+        required=True,
+        help="Path to the ONNX model that will be written.",
+    )
+    export_onnx_p.add_argument(
+        "--opset", type=int, default=17, help="ONNX opset version (default: 17)."
+    )
+    # int8 post-training quantization
+    quantize_p = subparsers.add_parser("quantize")
+    quantize_p.add_argument(
+        "--modelpath", "-m", type=str, required=True, help="Path to modelweights."
+    )
+    quantize_p.add_argument(
+        "--h5",
+        type=str,
+        required=True,
+        help="Path to the training H5 file used for calibration.",
+    )
+    quantize_p.add_argument(
+        "--outputpath",
+        "-o",
+        type=str,
+        required=True,
+        help="Path to the quantized TorchScript archive that will be written.",
+    )
+    quantize_p.add_argument(
+        "--evaluation_img_path",
+        type=str,
+        required=True,
+        help="Path to the recording used for the accuracy check.",
+    )
+    quantize_p.add_argument(
+        "--evaluation_roi_folder",
+        type=str,
+        required=True,
+        help="Folder with the ImageJ ROIs (.roi) of the evaluation recording.",
+    )
+    quantize_p.add_argument(
+        "--stimulation_frames",
+        type=int,
+        required=True,
+        nargs="+",
+        help="Frames of the stimulations in the evaluation recording.",
+    )
+    quantize_p.add_argument(
+        "--response_patience",
+        type=int,
+        default=5,
+        help="Number of frames after a stimulation in which a response is expected (default: 5).",
+    )
+    quantize_p.add_argument(
+        "--num_patches",
+        type=int,
+        default=256,
+        help="Number of training patches used for calibration (default: 256).",
+    )
+    quantize_p.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.05,
+        help="Maximal relative deviation of peak intensities and noise from the float model (default: 0.05).",
+    )
+    quantize_p.add_argument(
+        "--force",
+        action="store_true",
+        help="Save the quantized model even if it fails the accuracy check.",
+    )
     # evaluate inference speed for several image sizes
     eval_speed_p = subparsers.add_parser("eval_inference_speed")
     eval_speed_p.add_argument(
@@ -157,6 +521,36 @@ def main():
         "--cpu", action="store_true", help="Force CPU and not use GPU."
     )
 
+    # compare the rolling window z-normalization with the reference implementation
+    eval_norm_p = subparsers.add_parser("eval_normalization_speed")
+    eval_norm_p.add_argument(
+        "--path", "-p", type=str, required=True, help="Path to an image sequence."
+    )
+    eval_norm_p.add_argument(
+        "--window_sizes",
+        "-w",
+        type=int,
+        required=True,
+        nargs="+",
+        help="List of window sizes to test",
+    )
+    eval_norm_p.add_argument(
+        "--num_frames",
+        "-n",
+        type=int,
+        default=None,
+        help="Number of frames to test (default: all)",
+    )
+    eval_norm_p.add_argument(
+        "--outpath", "-o", required=True, type=str, help="Path to save result."
+    )
+    eval_norm_p.add_argument(
+        "--dtype",
+        choices=["float32", "float64"],
+        default="float32",
+        help="Floating point type used for normalization (default: float32).",
+    )
+
     args = parser.parse_args()
     if args.mode == "prepare_training":
         trainfiles = TrainFiles(
@@ -168,11 +562,21 @@ def main():
             window_size=args.window_size,
             foreground_background_split=args.fgsplit,
             overwrite=args.overwrite,
+            dtype=args.dtype,
+            seed=args.seed,
+            compression=args.compression,
+            storage_dtype=args.storage_dtype,
+            index_roi_sizes=args.index_roi_sizes,
+            activitymap_cache_dir=args.activitymap_cache_dir,
+            activitymap_cache_size=args.activitymap_cache_size,
         )
         # gather train data
         trainfiles.files_to_traindata(
             directory=args.path,
             memory_optimized=args.memory_optimized,
+            scratch_dir=args.scratch_dir,
+            block_size=args.block_size,
+            workers=args.workers,
         )
     # training
     elif args.mode == "train":
@@ -181,7 +585,7 @@ def main():
         with open(trainconfigpath, "r") as f:
             trainconfig = yaml.safe_load(f)
         modelpath = trainconfig["modelpath"]
-        h5 = trainconfig["train_h5"]
+        h5 = trainconfig.get("train_h5")
         batch_size = trainconfig["batch_size"]
         learning_rate = trainconfig["learning_rate"]
         lossfunction = trainconfig["lossfunction"]
@@ -190,40 +594,87 @@ def main():
         noise_scale = trainconfig["noise_scale"]
         gausian_filter = trainconfig["gausian_filter"]
         sigma_gausian_filter = trainconfig["sigma_gausian_filter"]
-        dataloader = DataLoader(
-            h5,
-            batch_size,
-            noise_center,
-            noise_scale,
-            gausian_filter,
-            sigma_gausian_filter,
-        )
-        model = UNet(1)
-        train(model, dataloader, num_epochs, learning_rate, lossfunction, modelpath)
+        device_augmentation = trainconfig.get("device_augmentation", False)
+        # patches cropped from the recordings in train_directory instead of train_h5
+        raw_source = raw_source_from_config(trainconfig)
+        cache_dir = None
+        if raw_source is None:
+            cache_dir = trainconfig.get("patch_cache_dir")
+        patch_cache = None
+        dataloader = None
+        try:
+            if cache_dir is not None:
+                patch_cache = PatchCache(h5, cache_dir)
+            dataloader = create_dataloader(
+                h5,
+                batch_size,
+                noise_center,
+                noise_scale,
+                gausian_filter,
+                sigma_gausian_filter,
+                dtype=trainconfig.get("dtype", "float32"),
+                augment=not device_augmentation,
+                cache_dir=cache_dir,
+                patches=raw_source,
+                num_workers=trainconfig.get("num_workers", 0),
+                prefetch_batches=trainconfig.get("prefetch_batches", 4),
+            )
+            augmentation = None
+            if device_augmentation:
+                augmentation = BatchAugmentation(
+                    noise_center, noise_scale, gausian_filter, sigma_gausian_filter
+                )
+            model = UNet(1)
+            train(
+                model,
+                dataloader,
+                num_epochs,
+                learning_rate,
+                lossfunction,
+                modelpath,
+                augmentation=augmentation,
+            )
+        finally:
+            # release the patches also if the training fails
+            if dataloader is not None:
+                dataloader.close()
+            if patch_cache is not None:
+                # a cache created for this training is removed, unless it should be kept
+                if patch_cache.created and not trainconfig.get(
+                    "keep_patch_cache", False
+                ):
+                    patch_cache.remove()
+                else:
+                    patch_cache.close()
+            if raw_source is not None:
+                raw_source.close()
     # gridsearch train
     elif args.mode == "gridsearch_train":
         gridsearch_train(args.trainconfigpath)
     # filter
     elif args.mode == "filter":
-        # input
-        f_in = h5py.File(args.h5, "r")
-        # "/mnt/nvme2/iGlu_train_data/iglu_train_data_cropsize32_roisize4_stim_z2_filtered.h5"
-        f_out = h5py.File(args.output_h5, "w")
-        idx = 0
-        num_samples = f_in.__len__()
-        with alive_bar(num_samples) as bar:
-            for i in range(num_samples):
-                frame = np.array(f_in.get(str(i)))
-                mean_frame = uniform_filter(frame, args.roi_size, mode="constant")
-                if np.any(mean_frame > args.min_z):
-                    f_out.create_dataset(str(idx), data=frame)
-                    idx += 1
-                    if idx % 1_000 == 0:
-                        print(f"Wrote {idx} files to the filtered h5-file.")
-                bar()
-        f_out.close()
-        f_in.close()
-        print(f"Kept {idx} of {num_samples} examples.")
+        filter_patches(
+            args.h5,
+            args.output_h5,
+            args.min_z,
+            args.roi_size,
+            compression=args.compression,
+            storage_dtype=args.storage_dtype,
+        )
+    # convert legacy h5 files
+    elif args.mode == "convert_h5":
+        convert_legacy_h5(
+            args.h5, args.output_h5, args.compression, storage_dtype=args.storage_dtype
+        )
+    # shared patch cache
+    elif args.mode == "patch_cache":
+        if args.remove:
+            if remove_patch_cache(args.h5, args.cache_dir):
+                print(f"Removed the patch cache of {args.h5}.")
+            else:
+                print(f"No patch cache of {args.h5} found in {args.cache_dir}.")
+        else:
+            PatchCache(args.h5, args.cache_dir).close()
     # denoising / inference
     elif args.mode == "denoise":
         inference(
@@ -233,6 +684,53 @@ def main():
             args.outputpath,
             args.batchsize,
             args.cpu,
+            streaming=args.streaming,
+            block_size=args.block_size,
+            tile_size=args.tile_size,
+            tile_overlap=args.tile_overlap,
+            queue_depth=args.queue_depth,
+            workers=args.workers,
+            memory_budget=(
+                None if args.memory_budget is None else int(args.memory_budget * 2**30)
+            ),
+            dtype=args.dtype,
+            backend=args.backend,
+            num_threads=args.num_threads,
+            quantized=args.quantized,
+        )
+    elif args.mode == "serve":
+        serve(
+            model_kwargs={
+                "weights": args.modelpath,
+                "batch_size": args.batchsize,
+                "cpu": args.cpu,
+                "dtype": args.dtype,
+                "backend": args.backend,
+                "num_threads": args.num_threads,
+                "quantized": args.quantized,
+            },
+            host=args.host,
+            port=args.port,
+            num_models=args.num_models,
+            max_wait=args.max_wait,
+        )
+    elif args.mode == "export_torchscript":
+        device = "cuda" if torch.cuda.is_available() and not args.cpu else "cpu"
+        export_torchscript(args.modelpath, args.outputpath, device)
+    elif args.mode == "export_onnx":
+        export_onnx(args.modelpath, args.outputpath, args.opset)
+    elif args.mode == "quantize":
+        quantize(
+            weights=args.modelpath,
+            h5_path=args.h5,
+            outpath=args.outputpath,
+            evaluation_img_path=args.evaluation_img_path,
+            evaluation_roi_folder=args.evaluation_roi_folder,
+            stimulation_frames=args.stimulation_frames,
+            response_patience=args.response_patience,
+            num_patches=args.num_patches,
+            tolerance=args.tolerance,
+            force=args.force,
         )
     elif args.mode == "eval_inference_speed":
         eval_inferencespeed(
@@ -243,6 +741,14 @@ def main():
             cpu=args.cpu,
             outpath=args.outpath,
         )
+    elif args.mode == "eval_normalization_speed":
+        eval_normalization_speed(
+            filepath=args.path,
+            window_sizes=args.window_sizes,
+            num_frames=args.num_frames,
+            outpath=args.outpath,
+            dtype=args.dtype,
+        )
     else:
         parser.print_help()
 
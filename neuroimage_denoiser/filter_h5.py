@@ -1,31 +1,94 @@
 from alive_progress import alive_bar
 
-import h5py
-from scipy.ndimage import uniform_filter
 import numpy as np
 import argparse
+from neuroimage_denoiser.utils.h5patches import (
+    PatchStore,
+    max_roi_means,
+    print_encoding_error,
+)
 
 
-def main(input_h5: str, output_h5: str, min_z: float, roi_size: int) -> None:
-    # input
-    f_in = h5py.File(input_h5, "r")
-    # "/mnt/nvme2/iGlu_train_data/iglu_train_data_cropsize32_roisize4_stim_z2_filtered.h5"
-    f_out = h5py.File(output_h5, "w")
-    idx = 0
-    num_samples = f_in.__len__()
-    with alive_bar(num_samples) as bar:
-        for i in range(num_samples):
-            frame = np.array(f_in.get(str(i)))
-            mean_frame = uniform_filter(frame, roi_size, mode="constant")
-            if np.any(mean_frame > min_z):
-                f_out.create_dataset(str(idx), data=frame)
-                idx += 1
-                if idx % 1_000 == 0:
-                    print(f"Wrote {idx} files to the filtered h5-file.")
-            bar()
-    f_out.close()
-    f_in.close()
-    print(f"Kept {idx} of {num_samples} examples.")
+def filter_patches(
+    input_h5: str,
+    output_h5: str,
+    min_z: float,
+    roi_size: int,
+    block_size: int = 4096,
+    compression: str | None = None,
+    storage_dtype: str | None = None,
+) -> None:
+    """
+    Keep the training patches in which the mean of a roi_size x roi_size window exceeds min_z.
+
+    If the metadata of the input contains the max. ROI-mean z-scores for roi_size,
+    the patches are selected with a single query on the metadata and only the
+    kept patches are copied, in blocks of block_size patches. Otherwise the
+    patches are read in blocks of block_size patches and the ROI means are
+    recomputed. Input files in the legacy layout (one dataset per patch) are
+    read as well, the output is always written as a single patches dataset.
+    The metadata of the kept patches is copied.
+
+    Args:
+        input_h5 (str): Path to the input H5 file.
+        output_h5 (str): Path to the output H5 file.
+        min_z (float): Minimum Z value.
+        roi_size (int): Size of the Region of Interest (ROI).
+        block_size (int): Number of patches processed at once (default: 4096).
+        compression (str, optional): Compression of the output, "gzip" or "lzf" (default: None).
+        storage_dtype (str, optional): Dtype of the output patches, e.g. "float16" or "int16"
+                                       (default: None, dtype of the input).
+    """
+    num_kept = 0
+    with PatchStore(input_h5) as patches_in, PatchStore(output_h5, "w") as patches_out:
+        num_samples = len(patches_in)
+        if storage_dtype is None:
+            storage_dtype = patches_in.storage_dtype
+        has_metadata = patches_in.has_metadata
+        roi_sizes = patches_in.metadata_roi_sizes() if has_metadata else None
+        if has_metadata:
+            patches_out.add_sources(patches_in.sources())
+            metadata = patches_in.read_metadata()
+        if has_metadata and roi_size in roi_sizes:
+            print("Selecting the patches with the metadata.")
+            scores = metadata["max_roi_mean"][:, roi_sizes.index(roi_size)]
+            kept_idxs = np.flatnonzero(scores > min_z)
+            with alive_bar(len(kept_idxs)) as bar:
+                for start in range(0, len(kept_idxs), block_size):
+                    idxs = kept_idxs[start : start + block_size]
+                    patches_out.append(
+                        patches_in.read_indices(idxs),
+                        compression,
+                        storage_dtype=storage_dtype,
+                        metadata=metadata[idxs],
+                        roi_sizes=roi_sizes,
+                    )
+                    bar(len(idxs))
+            num_kept = len(kept_idxs)
+        else:
+            with alive_bar(num_samples) as bar:
+                for start in range(0, num_samples, block_size):
+                    patches = patches_in.read(start, start + block_size)
+                    scores = max_roi_means(patches, [roi_size])[:, 0]
+                    keep = scores > min_z
+                    patches_out.append(
+                        patches[keep],
+                        compression,
+                        storage_dtype=storage_dtype,
+                        metadata=(
+                            metadata[start : start + block_size][keep]
+                            if has_metadata
+                            else None
+                        ),
+                        roi_sizes=roi_sizes,
+                    )
+                    num_kept += int(np.count_nonzero(keep))
+                    bar(len(patches))
+        print(f"Kept {num_kept} of {num_samples} examples.")
+        if patches_out.storage_dtype is not None:
+            print_encoding_error(
+                patches_out.encoding_error(), patches_out.storage_dtype
+            )
 
 
 if __name__ == "__main__":
@@ -48,4 +111,4 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
-    main(args.input_h5, args.output_h5, args.min_z, args.roi_size)
+    filter_patches(args.input_h5, args.output_h5, args.min_z, args.roi_size)
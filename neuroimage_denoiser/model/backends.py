@@ -0,0 +1,131 @@
+import numpy as np
+import torch
+import neuroimage_denoiser.model.engine as engine
+
+BACKENDS = ["torch", "onnxruntime"]
+
+
+class TorchBackend:
+    """
+    Inference backend running the optimized U-Net (or a TorchScript archive) with PyTorch.
+
+    Attributes:
+        device (torch.device): Device used for inference.
+        model (torch.nn.Module): Model optimized for inference.
+    """
+
+    def __init__(
+        self,
+        modelpath: str,
+        device: torch.device | str = "cpu",
+    ) -> None:
+        """
+        Load the model. The number of threads of torch is a setting of the process,
+        it is set once with torch.set_num_threads by the caller, not per model.
+
+        Args:
+            modelpath (str): Path to the model weights or a TorchScript archive.
+            device (torch.device | str): Device used for inference.
+        """
+        self.device = torch.device(device)
+        self.model = engine.load_model(modelpath, self.device)
+
+    def __call__(self, X: np.ndarray) -> np.ndarray:
+        """
+        Predict a batch.
+
+        Args:
+            X (np.ndarray[np.float32]): Input of shape (batch, 1, height, width).
+
+        Returns:
+            np.ndarray[np.float32]: Prediction of shape (batch, 1, height, width).
+        """
+        X = torch.from_numpy(X).to(self.device)
+        X = X.contiguous(memory_format=torch.channels_last)
+        with torch.inference_mode():
+            y_pred = self.model(X)
+        return y_pred.to("cpu").numpy()
+
+
+class OnnxRuntimeBackend:
+    """
+    Inference backend running an ONNX export of the U-Net (see export_onnx) with ONNX Runtime on the CPU.
+
+    Attributes:
+        device (torch.device): Device used for inference (always the CPU).
+        session (onnxruntime.InferenceSession): ONNX Runtime session with all graph optimizations enabled.
+    """
+
+    def __init__(self, modelpath: str, num_threads: int | None = None) -> None:
+        """
+        Create the ONNX Runtime session.
+
+        Args:
+            modelpath (str): Path to the ONNX model.
+            num_threads (int, optional): Size of the intra-op thread pool. None uses all cores.
+
+        Raises:
+            ImportError: If onnxruntime is not installed.
+        """
+        try:
+            import onnxruntime
+        except ImportError as error:
+            raise ImportError(
+                "The onnxruntime backend requires onnxruntime. Install it with `pip install onnxruntime`."
+            ) from error
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        options.inter_op_num_threads = 1
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.device = torch.device("cpu")
+        self.session = onnxruntime.InferenceSession(
+            modelpath, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, X: np.ndarray) -> np.ndarray:
+        """
+        Predict a batch.
+
+        Args:
+            X (np.ndarray[np.float32]): Input of shape (batch, 1, height, width).
+
+        Returns:
+            np.ndarray[np.float32]: Prediction of shape (batch, 1, height, width).
+        """
+        return self.session.run(None, {self.input_name: X})[0]
+
+
+def load_backend(
+    backend: str,
+    modelpath: str,
+    device: torch.device | str = "cpu",
+    num_threads: int | None = None,
+) -> TorchBackend | OnnxRuntimeBackend:
+    """
+    Create an inference backend.
+
+    Args:
+        backend (str): Name of the backend, one of BACKENDS.
+        modelpath (str): Path to the model (weights or TorchScript archive for torch,
+                         ONNX model for onnxruntime).
+        device (torch.device | str): Device used by the torch backend.
+        num_threads (int, optional): Size of the intra-op thread pool of onnxruntime. The torch
+                                     backend uses the thread pool of the process (see torch.set_num_threads).
+
+    Returns:
+        TorchBackend | OnnxRuntimeBackend: The backend.
+
+    Raises:
+        NotImplementedError: If the backend is not available.
+    """
+    if backend == "torch":
+        return TorchBackend(modelpath, device)
+    elif backend == "onnxruntime":
+        return OnnxRuntimeBackend(modelpath, num_threads)
+    raise NotImplementedError(
+        f"The selected backend ('{backend}') is not available. Select from {BACKENDS}."
+    )
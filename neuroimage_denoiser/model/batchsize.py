@@ -0,0 +1,235 @@
+import os
+import json
+import tempfile
+import time
+from typing import Callable
+import numpy as np
+import torch
+from neuroimage_denoiser.model.unet import UNet
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "neuroimage_denoiser", "batchsize.json"
+)
+
+
+def device_name(device: torch.device | str) -> str:
+    """
+    Name of a device that identifies it in the batch size cache.
+
+    Args:
+        device (torch.device | str): Device used for inference.
+
+    Returns:
+        str: "cpu" or "cuda:<name of the GPU>".
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        return f"cuda:{torch.cuda.get_device_name(device)}"
+    return device.type
+
+
+def default_memory_budget(device: torch.device | str) -> int:
+    """
+    Default memory budget for inference: 80% of the free GPU memory or 50% of
+    the available RAM.
+
+    Args:
+        device (torch.device | str): Device used for inference.
+
+    Returns:
+        int: Memory budget in bytes.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return int(0.8 * free)
+    try:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        # sysconf is not available on all platforms, assume 8 GB
+        available = 8 * 2**30
+    return int(0.5 * available)
+
+
+def activation_bytes_per_frame(height: int, width: int, dtype: torch.dtype) -> int:
+    """
+    Measure the size of all intermediate outputs of the UNet for a single frame.
+
+    This is an upper bound of the memory needed for the activations of one frame,
+    since not all intermediate outputs are alive at the same time. The UNet is
+    run on the meta device, so no memory is allocated and nothing is computed.
+
+    Args:
+        height (int): Height of the frames.
+        width (int): Width of the frames.
+        dtype (torch.dtype): Data type of the input frames.
+
+    Returns:
+        int: Number of bytes.
+    """
+    total_bytes = 0
+
+    def count_output(module, input, output) -> None:
+        nonlocal total_bytes
+        if isinstance(output, torch.Tensor):
+            total_bytes += output.numel() * output.element_size()
+
+    model = UNet(1).to(device="meta", dtype=dtype)
+    for module in model.modules():
+        if len(list(module.children())) == 0:
+            module.register_forward_hook(count_output)
+    with torch.no_grad():
+        model(torch.zeros((1, 1, height, width), dtype=dtype, device="meta"))
+    return total_bytes
+
+
+def tune_batch_size(
+    model: Callable[[np.ndarray], np.ndarray],
+    device: torch.device | str,
+    height: int,
+    width: int,
+    dtype: torch.dtype = torch.float32,
+    memory_budget: int | None = None,
+    max_batch_size: int = 256,
+    probe_iterations: int = 3,
+) -> int:
+    """
+    Find the batch size with the highest throughput for a frame shape and device.
+
+    Batch sizes 1, 2, 4, ... are probed with short inference passes on random
+    frames. Probing stops when the memory needed exceeds the memory budget, the
+    device runs out of memory, or the throughput did not improve for two
+    consecutive batch sizes.
+
+    Args:
+        model (Callable[[np.ndarray], np.ndarray]): Inference backend (see backends.py),
+                                                    called with a batch of frames.
+        device (torch.device | str): Device used for inference.
+        height (int): Height of the frames.
+        width (int): Width of the frames.
+        dtype (torch.dtype): Data type of the input frames.
+        memory_budget (int, optional): Maximum memory in bytes used for inference.
+                                       Defaults to default_memory_budget(device).
+        max_batch_size (int): Largest batch size that is probed.
+        probe_iterations (int): Number of timed inference passes per batch size.
+
+    Returns:
+        int: Batch size with the highest number of frames per second.
+    """
+    device = torch.device(device)
+    if memory_budget is None:
+        memory_budget = default_memory_budget(device)
+    bytes_per_frame = activation_bytes_per_frame(height, width, dtype)
+    best_batch_size = 1
+    best_fps = 0.0
+    no_improvement = 0
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        if device.type != "cuda" and batch_size * bytes_per_frame > memory_budget:
+            break
+        X = torch.randn((batch_size, 1, height, width), dtype=dtype).numpy()
+        try:
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(device)
+            # warm up
+            model(X)
+            # the backends return numpy arrays, so every call is synchronized
+            start = time.perf_counter()
+            for _ in range(probe_iterations):
+                model(X)
+            elapsed = time.perf_counter() - start
+        except torch.cuda.OutOfMemoryError:
+            break
+        finally:
+            del X
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+        if (
+            device.type == "cuda"
+            and torch.cuda.max_memory_allocated(device) > memory_budget
+        ):
+            break
+        fps = batch_size * probe_iterations / elapsed
+        if fps > best_fps:
+            best_batch_size = batch_size
+            best_fps = fps
+            no_improvement = 0
+        else:
+            no_improvement += 1
+            if no_improvement == 2:
+                break
+        batch_size *= 2
+    return best_batch_size
+
+
+def load_cached_batch_sizes(cache_path: str) -> dict:
+    """
+    Load the cached batch sizes.
+
+    Args:
+        cache_path (str): Path to the JSON cache file.
+
+    Returns:
+        dict: Batch sizes keyed by model, device, frame shape and data type.
+              Empty if the cache does not exist or cannot be read.
+    """
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def get_batch_size(
+    model: Callable[[np.ndarray], np.ndarray],
+    model_key: str,
+    device: torch.device | str,
+    height: int,
+    width: int,
+    dtype: torch.dtype = torch.float32,
+    memory_budget: int | None = None,
+    cache_path: str | None = DEFAULT_CACHE_PATH,
+) -> int:
+    """
+    Get the tuned batch size from the cache or tune and cache it.
+
+    Args:
+        model (Callable[[np.ndarray], np.ndarray]): Inference backend (see backends.py).
+        model_key (str): Identifier of the model weights (e.g. a hash of the file).
+        device (torch.device | str): Device used for inference.
+        height (int): Height of the frames.
+        width (int): Width of the frames.
+        dtype (torch.dtype): Data type of the input frames.
+        memory_budget (int, optional): Maximum memory in bytes used for inference.
+        cache_path (str, optional): Path to the JSON cache file. None disables the cache.
+
+    Returns:
+        int: Batch size with the highest number of frames per second.
+    """
+    key = f"{model_key}|{device_name(device)}|{height}|{width}|{dtype}"
+    if cache_path is not None:
+        cached = load_cached_batch_sizes(cache_path)
+        if key in cached:
+            return cached[key]
+    batch_size = tune_batch_size(model, device, height, width, dtype, memory_budget)
+    print(f"Selected batch size {batch_size} for frames of shape ({height}, {width}).")
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        # re-read to keep entries written by concurrent runs
+        cached = load_cached_batch_sizes(cache_path)
+        cached[key] = batch_size
+        # unique temporary file, several threads or processes may write the cache
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(cache_path)), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(cached, f, indent=2)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return batch_size
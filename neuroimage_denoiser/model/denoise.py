@@ -1,7 +1,107 @@
 import os
+import queue
+import threading
+import torch
 from alive_progress import alive_bar
 from neuroimage_denoiser.model.modelwrapper import ModelWrapper
+from neuroimage_denoiser.model.workerpool import denoise_worker_pool
 from neuroimage_denoiser.utils.copy_folder_structure import copy_folder_structure
+from neuroimage_denoiser.utils.open_file import open_file
+from neuroimage_denoiser.utils.write_file import write_file
+
+
+def pending_jobs(
+    filelist: list[str], outputpaths: list[str]
+) -> tuple[list[str], list[str]]:
+    """
+    Determine the output files and skip files that were already denoised.
+
+    Args:
+        filelist (list[str]): Paths to the input images.
+        outputpaths (list[str]): Output directories of the input images.
+
+    Returns:
+        tuple[list[str], list[str]]: Paths to the input images that still have to be
+                                     denoised and the paths to their output files.
+    """
+    todo_filelist = []
+    todo_outfilepaths = []
+    for filepath, outpath in zip(filelist, outputpaths):
+        filename = os.path.splitext(os.path.basename(filepath))[0]
+        outfilepath = os.path.join(outpath, f"{filename}_denoised.tif")
+        if os.path.exists(outfilepath):
+            print(f"Skipped {filename}, because file already exists ({outfilepath}).")
+            continue
+        todo_filelist.append(filepath)
+        todo_outfilepaths.append(outfilepath)
+    return todo_filelist, todo_outfilepaths
+
+
+def denoise_pipelined(
+    model: ModelWrapper,
+    filelist: list[str],
+    outfilepaths: list[str],
+    queue_depth: int,
+    pbar: bool = True,
+) -> None:
+    """
+    Denoise several images with background threads for reading and writing.
+
+    A reader thread decodes the next image(s) while the model denoises the
+    current one in the calling thread, and a writer thread encodes the
+    finished outputs. Both queues hold at most `queue_depth` images, which
+    bounds the memory usage. Files that cannot be read, denoised or written
+    are skipped.
+
+    Args:
+        model (ModelWrapper): Initialized model.
+        filelist (list[str]): Paths to the input images.
+        outfilepaths (list[str]): Paths to the output files.
+        queue_depth (int): Maximum number of images buffered in each queue.
+        pbar (bool): Flag to show a progress bar.
+    """
+    read_queue = queue.Queue(maxsize=queue_depth)
+    write_queue = queue.Queue(maxsize=queue_depth)
+
+    def read_files() -> None:
+        for filepath, outfilepath in zip(filelist, outfilepaths):
+            try:
+                img = open_file(filepath, model.dtype)
+                read_queue.put((filepath, outfilepath, img, None))
+            except Exception as error:
+                read_queue.put((filepath, outfilepath, None, error))
+        read_queue.put(None)
+
+    def write_files() -> None:
+        while (item := write_queue.get()) is not None:
+            filepath, outfilepath, denoised_img = item
+            try:
+                write_file(denoised_img, outfilepath)
+                print(f"Saved image ({os.path.basename(filepath)}) as: {outfilepath}")
+            except Exception as error:
+                print(f"Skipped {filepath}, due to an unexpected error:")
+                print(error)
+
+    reader = threading.Thread(target=read_files, daemon=True)
+    writer = threading.Thread(target=write_files, daemon=True)
+    reader.start()
+    writer.start()
+    with alive_bar(len(filelist), disable=not pbar) as bar:
+        while (item := read_queue.get()) is not None:
+            filepath, outfilepath, img, error = item
+            if error is None:
+                try:
+                    model.denoise_array(img)
+                    write_queue.put((filepath, outfilepath, model.denoised_img))
+                except Exception as inference_error:
+                    error = inference_error
+            if error is not None:
+                print(f"Skipped {filepath}, due to an unexpected error:")
+                print(error)
+            del img
+            bar()
+    write_queue.put(None)
+    writer.join()
 
 
 def inference(
@@ -9,9 +109,20 @@ def inference(
     modelpath: str,
     directory_mode: False,
     outputpath: str,
-    batch_size: int,
+    batch_size: int | str,
     cpu: bool,
     pbar: bool = True,
+    streaming: bool = False,
+    block_size: int = 256,
+    tile_size: int = 0,
+    tile_overlap: int = 32,
+    queue_depth: int = 0,
+    workers: int = 1,
+    memory_budget: int | None = None,
+    dtype: str = "float32",
+    backend: str = "torch",
+    num_threads: int | None = None,
+    quantized: bool = False,
 ) -> None:
     """
     Main function for denoising images using a trained model.
@@ -21,15 +132,30 @@ def inference(
         modelpath (str): Path to the model weights.
         directory_mode (bool): Flag to enable directory mode (True/False).
         outputpath (str): Path to the output directory.
-        batch_size (int): Number of frames predicted at once.
+        batch_size (int | str): Number of frames predicted at once, "auto" to tune it.
+        cpu (bool): Flag to force CPU usage, even if a GPU is available.
+        pbar (bool): Flag to show a progress bar.
+        streaming (bool): Flag to read, denoise and write the images in blocks of frames,
+            so that recordings larger than the available memory can be denoised.
+        block_size (int): Number of frames per block in streaming mode.
+        tile_size (int): Size of the square tiles that are predicted at once (0: full frames).
+        tile_overlap (int): Overlap of neighboring tiles.
+        queue_depth (int): Number of images that are read ahead and queued for writing
+            in directory mode, while the model denoises the current image (0: no pipelining).
+        workers (int): Number of worker processes that denoise the files of the directory
+            in parallel, each with its own model and share of the CPU threads.
+        memory_budget (int, optional): Maximum memory in bytes used when the batch size is tuned.
+        dtype (str): Floating point type used for the image data and normalization.
+        backend (str): Inference backend, "torch" or "onnxruntime" (CPU only, requires
+            a model exported with export_onnx).
+        num_threads (int, optional): Number of threads used by the inference backend.
+        quantized (bool): Flag to run an int8 model written by quantize (CPU only).
     """
     valid_fileendings = [".tif", ".tiff", ".stk", ".nd2"]
     # ensure absolute path
     outputpath = os.path.abspath(outputpath)
     os.makedirs(outputpath, exist_ok=True)
     path = os.path.abspath(path)
-    # initalize model
-    model = ModelWrapper(modelpath, batch_size, cpu)
     if directory_mode:
         # preserver original folderstructure
         copy_folder_structure(path, outputpath)
@@ -56,6 +182,37 @@ def inference(
             )
         filelist = [path]
         outputpaths = [outputpath]
+    model_kwargs = {
+        "weights": modelpath,
+        "batch_size": batch_size,
+        "cpu": cpu,
+        "tile_size": tile_size,
+        "tile_overlap": tile_overlap,
+        "memory_budget": memory_budget,
+        "dtype": dtype,
+        "backend": backend,
+        "quantized": quantized,
+    }
+    if directory_mode and workers > 1:
+        denoise_worker_pool(
+            *pending_jobs(filelist, outputpaths),
+            workers,
+            model_kwargs,
+            streaming,
+            block_size,
+            pbar,
+        )
+        return
+    # the thread pool of torch is shared by the whole process
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    # initalize model
+    model = ModelWrapper(**model_kwargs, num_threads=num_threads)
+    if directory_mode and queue_depth > 0 and not streaming:
+        denoise_pipelined(
+            model, *pending_jobs(filelist, outputpaths), queue_depth, pbar
+        )
+        return
     if pbar:
         with alive_bar(len(filelist)) as bar:
             for filepath, outpath in zip(filelist, outputpaths):
@@ -68,8 +225,11 @@ def inference(
                     bar()
                     continue
                 try:
-                    model.denoise_img(filepath)
-                    model.write_denoised_img(outfilepath)
+                    if streaming:
+                        model.denoise_img_streaming(filepath, outfilepath, block_size)
+                    else:
+                        model.denoise_img(filepath)
+                        model.write_denoised_img(outfilepath)
                     print(
                         f"Saved image ({os.path.basename(filepath)}) as: {outfilepath}"
                     )
@@ -86,5 +246,8 @@ def inference(
                     f"Skipped {filename}, because file already exists ({outfilepath})."
                 )
                 continue
-            model.denoise_img(filepath)
-            model.write_denoised_img(outfilepath)
+            if streaming:
+                model.denoise_img_streaming(filepath, outfilepath, block_size)
+            else:
+                model.denoise_img(filepath)
+                model.write_denoised_img(outfilepath)
@@ -0,0 +1,144 @@
+import inspect
+import zipfile
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from neuroimage_denoiser.model.unet import UNet
+
+
+def fold_batchnorm(model: nn.Module) -> nn.Module:
+    """
+    Fold every BatchNorm2d that directly follows a Conv2d into the weights of the convolution.
+
+    In evaluation mode a batch normalization is an affine transformation with fixed
+    parameters, which can be merged into the preceding convolution. The BatchNorm2d
+    layers are replaced by nn.Identity, so one kernel launch and one pass over the
+    activations are saved per convolution.
+
+    Parameters:
+    - model (nn.Module): Model in evaluation mode. It is modified in place.
+
+    Returns:
+    - nn.Module: The model with folded batch normalizations.
+    """
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        for idx in range(len(module) - 1):
+            if isinstance(module[idx], nn.Conv2d) and isinstance(
+                module[idx + 1], nn.BatchNorm2d
+            ):
+                module[idx] = fuse_conv_bn_eval(module[idx], module[idx + 1])
+                module[idx + 1] = nn.Identity()
+    return model
+
+
+def optimize_for_inference(
+    model: nn.Module, device: torch.device | str = "cpu"
+) -> nn.Module:
+    """
+    Prepare a trained model for inference: evaluation mode, folded batch
+    normalizations and channels_last memory format on the target device.
+
+    Parameters:
+    - model (nn.Module): Trained model. It is modified in place.
+    - device (torch.device | str): Device used for inference.
+
+    Returns:
+    - nn.Module: The optimized model.
+    """
+    model.eval()
+    fold_batchnorm(model)
+    return model.to(device, memory_format=torch.channels_last)
+
+
+def is_torchscript(path: str) -> bool:
+    """
+    Check whether a file is a TorchScript archive (and not a state_dict).
+
+    Parameters:
+    - path (str): Path to the model file.
+
+    Returns:
+    - bool: True if the file was written by torch.jit.save.
+    """
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any("/code/" in name for name in archive.namelist())
+
+
+def load_model(path: str, device: torch.device | str = "cpu") -> nn.Module:
+    """
+    Load a model for inference from a state_dict or a TorchScript archive.
+
+    State_dicts are loaded into a UNet, which is then optimized with
+    optimize_for_inference. TorchScript archives (see export_torchscript)
+    are loaded as they are.
+
+    Parameters:
+    - path (str): Path to the model weights or the TorchScript archive.
+    - device (torch.device | str): Device used for inference.
+
+    Returns:
+    - nn.Module: The model in evaluation mode.
+    """
+    if is_torchscript(path):
+        model = torch.jit.load(path, map_location=device)
+        model.eval()
+        return model
+    model = UNet(1)
+    model.load_state_dict(torch.load(path, map_location=device))
+    return optimize_for_inference(model, device)
+
+
+def export_torchscript(
+    weights: str, outpath: str, device: torch.device | str = "cpu"
+) -> None:
+    """
+    Export trained weights as frozen TorchScript archive for inference.
+
+    The batch normalizations are folded into the convolutions, the weights are
+    stored in channels_last format and the scripted model is frozen, so that
+    parameters are inlined as constants. Loading the archive does not require
+    constructing the UNet in Python. Height, width and batch size stay dynamic.
+
+    Parameters:
+    - weights (str): Path to the trained weights (state_dict).
+    - outpath (str): Path to the TorchScript archive that will be written.
+    - device (torch.device | str): Device the archive is optimized for.
+    """
+    model = load_model(weights, device)
+    frozen = torch.jit.freeze(torch.jit.script(model))
+    torch.jit.save(frozen, outpath)
+
+
+def export_onnx(weights: str, outpath: str, opset: int = 17) -> None:
+    """
+    Export trained weights as ONNX model for inference with ONNX Runtime.
+
+    The batch normalizations are folded into the convolutions before the export.
+    Batch size, height and width are dynamic axes of the input ("input") and the
+    output ("output"), both of shape (batch, 1, height, width).
+
+    Parameters:
+    - weights (str): Path to the trained weights (state_dict).
+    - outpath (str): Path to the ONNX model that will be written.
+    - opset (int): ONNX opset version (default: 17).
+    """
+    model = load_model(weights, "cpu").to(memory_format=torch.contiguous_format)
+    dynamic_axes = {0: "batch", 2: "height", 3: "width"}
+    export_kwargs = {}
+    # newer torch versions default to the dynamo based exporter
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs["dynamo"] = False
+    torch.onnx.export(
+        model,
+        torch.zeros((1, 1, 64, 64)),
+        outpath,
+        input_names=["input"],
+        output_names=["output"],
+        dynamic_axes={"input": dynamic_axes, "output": dynamic_axes},
+        opset_version=opset,
+        **export_kwargs,
+    )
@@ -1,6 +1,9 @@
 from neuroimage_denoiser.model.train import train
 from neuroimage_denoiser.model.unet import UNet
-from neuroimage_denoiser.utils.dataloader import DataLoader
+from neuroimage_denoiser.utils.dataloader import create_dataloader
+from neuroimage_denoiser.utils.augmentation import BatchAugmentation
+from neuroimage_denoiser.utils.patchcache import PatchCache
+from neuroimage_denoiser.utils.rawsource import raw_source_from_config
 from neuroimage_denoiser.utils.evaluate_model import evaluate, raw_evaluate
 
 import os
@@ -13,7 +16,6 @@ def gridsearch_train(trainconfigpath: str) -> None:
     with open(trainconfigpath, "r") as f:
         trainconfig = yaml.safe_load(f)
     for key in [
-        "train_h5",
         "batch_size",
         "learning_rate",
         "num_epochs",
@@ -33,6 +35,11 @@ def gridsearch_train(trainconfigpath: str) -> None:
             raise ValueError(
                 f"Did not find required parameter {key} in {trainconfigpath}."
             )
+    if "train_h5" not in trainconfig and "train_directory" not in trainconfig:
+        raise ValueError(
+            f"Did not find required parameter train_h5 (or train_directory) in {trainconfigpath}."
+        )
+    device_augmentation = trainconfig.get("device_augmentation", False)
     # create outputfolder
     modelfolder = os.path.abspath(trainconfig["modelfolder"])
     if os.path.exists(modelfolder):
@@ -68,46 +75,79 @@ def gridsearch_train(trainconfigpath: str) -> None:
                               trainconfig['response_patience'])
     with open(os.path.join(modelfolder,f'raw_performance.json'),'w') as outfile:
         json.dump(raw_result,outfile)
-    with alive_bar(len(parameterspace)) as bar:
-        for params in parameterspace:
-            ns, nc, gf, lf, sgf = params
-            modelname = f"unet_{lf}-loss_noisescale-{ns}_noisecenter-{nc}_gaussian-{gf}_sigma-{sgf}.pt"
-            modelpath = os.path.join(modelfolder, modelname)
-            history_savepath = os.path.join(
-                modelfolder,
-                f"unet_{lf}-loss_noisescale-{ns}_noisecenter-{nc}_gaussian-{gf}_sigma-{sgf}.npy",
-            )
-            dataloader = DataLoader(
-                trainconfig["train_h5"],
-                trainconfig["batch_size"],
-                noise_center=nc,
-                noise_scale=ns,
-                apply_gausian_filter=gf,
-                sigma_gausian_filter=sgf,
-            )
-            # train a model with the given parameters
-            model = UNet(1)
-            train(
-                model,
-                dataloader,
-                trainconfig["num_epochs"],
-                trainconfig["learning_rate"],
-                lf,
-                modelpath,
-                history_savepath,
-                False
-            )
-            model.to('cpu')
-            del model
-            # evaluate
-            results_model = evaluate(modelpath,
-                     tmp_folder,
-                     trainconfig['evaluation_img_path'],
-                     trainconfig['batch_size_inference'],
-                     trainconfig['evaluation_roi_folder'],
-                     trainconfig['stimulation_frames'],
-                     trainconfig['response_patience'],
-                     raw_result)
-            with open(os.path.join(modelfolder,f'unet_{lf}-loss_noisescale-{ns}_noisecenter-{nc}_gaussian-{gf}_sigma-{sgf}_performance.json'),'w') as outfile:
-                json.dump(results_model,outfile)
-            bar()
+    # the index of the raw recordings is built once for all models
+    raw_source = raw_source_from_config(trainconfig)
+    cache_dir = None
+    if raw_source is None:
+        cache_dir = trainconfig.get("patch_cache_dir")
+    patch_cache = None
+    if cache_dir is not None:
+        # read the patches once for all models
+        patch_cache = PatchCache(trainconfig["train_h5"], cache_dir)
+    try:
+        with alive_bar(len(parameterspace)) as bar:
+            for params in parameterspace:
+                ns, nc, gf, lf, sgf = params
+                modelname = f"unet_{lf}-loss_noisescale-{ns}_noisecenter-{nc}_gaussian-{gf}_sigma-{sgf}.pt"
+                modelpath = os.path.join(modelfolder, modelname)
+                history_savepath = os.path.join(
+                    modelfolder,
+                    f"unet_{lf}-loss_noisescale-{ns}_noisecenter-{nc}_gaussian-{gf}_sigma-{sgf}.npy",
+                )
+                dataloader = create_dataloader(
+                    trainconfig.get("train_h5"),
+                    trainconfig["batch_size"],
+                    noise_center=nc,
+                    noise_scale=ns,
+                    apply_gausian_filter=gf,
+                    sigma_gausian_filter=sgf,
+                    dtype=trainconfig.get("dtype", "float32"),
+                    augment=not device_augmentation,
+                    cache_dir=cache_dir,
+                    patches=raw_source,
+                    num_workers=trainconfig.get("num_workers", 0),
+                    prefetch_batches=trainconfig.get("prefetch_batches", 4),
+                )
+                augmentation = None
+                if device_augmentation:
+                    augmentation = BatchAugmentation(nc, ns, gf, sgf)
+                try:
+                    # train a model with the given parameters
+                    model = UNet(1)
+                    train(
+                        model,
+                        dataloader,
+                        trainconfig["num_epochs"],
+                        trainconfig["learning_rate"],
+                        lf,
+                        modelpath,
+                        history_savepath,
+                        False,
+                        augmentation,
+                    )
+                finally:
+                    dataloader.close()
+                model.to('cpu')
+                del model
+                # evaluate
+                results_model = evaluate(modelpath,
+                         tmp_folder,
+                         trainconfig['evaluation_img_path'],
+                         trainconfig['batch_size_inference'],
+                         trainconfig['evaluation_roi_folder'],
+                         trainconfig['stimulation_frames'],
+                         trainconfig['response_patience'],
+                         raw_result)
+                with open(os.path.join(modelfolder,f'unet_{lf}-loss_noisescale-{ns}_noisecenter-{nc}_gaussian-{gf}_sigma-{sgf}_performance.json'),'w') as outfile:
+                    json.dump(results_model,outfile)
+                bar()
+    finally:
+        # release the patches also if a model fails
+        if patch_cache is not None:
+            # a cache created for the gridsearch is removed, unless it should be kept
+            if patch_cache.created and not trainconfig.get("keep_patch_cache", False):
+                patch_cache.remove()
+            else:
+                patch_cache.close()
+        if raw_source is not None:
+            raw_source.close()
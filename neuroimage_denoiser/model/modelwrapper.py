@@ -1,10 +1,15 @@
-from neuroimage_denoiser.model.unet import UNet
+import neuroimage_denoiser.model.backends as backends
+import neuroimage_denoiser.model.engine as engine
+import neuroimage_denoiser.model.tiling as tiling
+import neuroimage_denoiser.model.batchsize as batchsize
 import neuroimage_denoiser.utils.normalization as normalization
-from neuroimage_denoiser.utils.write_file import write_file
-from neuroimage_denoiser.utils.open_file import open_file
+from neuroimage_denoiser.utils.write_file import write_file, write_file_blocks
+from neuroimage_denoiser.utils.open_file import open_file, StackReader
 from neuroimage_denoiser.utils.convert import float_to_uint
+from neuroimage_denoiser.utils.hashing import file_hash
 import torch
 import numpy as np
+from typing import Iterator
 
 
 class ModelWrapper:
@@ -16,10 +21,18 @@ class ModelWrapper:
 
     Attributes:
         weights (str): Path to the pre-trained weights.
-        batch_size (int): Number of frames to process in each batch.
+        batch_size (int): Number of frames (or tiles in tiled mode) to process in each batch.
+        auto_batch_size (bool): Flag to tune the batch size for each frame shape.
+        memory_budget (int | None): Maximum memory in bytes used when tuning the batch size.
+        dtype (np.dtype): Floating point type used for the image data and normalization.
         cpu (bool): Flag to force CPU usage, even if a GPU is available.
+        tile_size (int): Size of the square tiles that are predicted (0: predict full frames).
+        tile_overlap (int): Overlap of neighboring tiles.
+        backend_name (str): Name of the inference backend ("torch" or "onnxruntime").
+        num_threads (int | None): Number of threads used by the inference backend.
+        quantized (bool): Flag indicating that the model is an int8 quantized TorchScript archive.
         device (torch.device): Device to use for computations (GPU or CPU).
-        model (UNet): The U-Net model instance.
+        backend (TorchBackend | OnnxRuntimeBackend): Inference backend running the U-Net.
         denoised_img (np.ndarray): The denoised image sequence.
         img (np.ndarray): The input image sequence.
         img_height (int): Height of the input image sequence.
@@ -28,25 +41,77 @@ class ModelWrapper:
         img_std (np.ndarray): Standard deviation of the input image sequence along the z-axis.
     """
 
-    def __init__(self, weights: str, batch_size: int, cpu: bool) -> None:
+    def __init__(
+        self,
+        weights: str,
+        batch_size: int | str,
+        cpu: bool,
+        tile_size: int = 0,
+        tile_overlap: int = 32,
+        memory_budget: int | None = None,
+        dtype: np.dtype | str = np.float32,
+        backend: str = "torch",
+        num_threads: int | None = None,
+        quantized: bool = False,
+    ) -> None:
         """
         Initialize the ModelWrapper instance.
 
         Args:
-            weights (str): Path to the pre-trained weights.
-            batch_size (int): Number of frames to process in each batch.
+            weights (str): Path to the pre-trained weights or to a TorchScript archive
+                           exported with export_torchscript. For the onnxruntime backend,
+                           path to an ONNX model exported with export_onnx.
+            batch_size (int | str): Number of frames (or tiles in tiled mode) to process in each batch.
+                                    "auto" tunes the batch size for each frame shape and device,
+                                    the result is cached on disk.
             cpu (bool): Flag to force CPU usage, even if a GPU is available.
+            tile_size (int): Size of the square tiles that are predicted. Frames are split into
+                             overlapping tiles, which bounds the memory usage independent of the
+                             frame size (0: predict full frames).
+            tile_overlap (int): Overlap of neighboring tiles, must be smaller than tile_size.
+            memory_budget (int, optional): Maximum memory in bytes used when tuning the batch size.
+                                           Defaults to 80% of the free GPU memory or 50% of the
+                                           available RAM.
+            dtype (np.dtype | str): Floating point type used for the image data and normalization
+                                    (default: float32). The model itself always runs in float32.
+            backend (str): Inference backend, "torch" or "onnxruntime" (CPU only).
+            num_threads (int, optional): Number of threads used by the inference backend.
+                                         None keeps the default of the backend.
+            quantized (bool): Flag indicating that weights is an int8 quantized TorchScript
+                              archive written by quantize. Quantized models run on the CPU only.
+
+        Raises:
+            ValueError: If the tile overlap is not smaller than the tile size or a quantized
+                        model is not a TorchScript archive run with the torch backend.
         """
+        if tile_size > 0 and not 0 <= tile_overlap < tile_size:
+            raise ValueError(
+                f"Tile overlap ({tile_overlap}) has to be smaller than the tile size ({tile_size})."
+            )
         # initalize model
-        self.batch_size = batch_size
+        self.weights = weights
+        self.auto_batch_size = batch_size == "auto"
+        self.batch_size = 1 if self.auto_batch_size else int(batch_size)
+        self.memory_budget = memory_budget
+        self.dtype = np.dtype(dtype)
+        self.tuned_batch_sizes = {}
+        self.model_key = None
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.backend_name = backend
+        self.num_threads = num_threads
+        self.quantized = quantized
+        if quantized and (backend != "torch" or not engine.is_torchscript(weights)):
+            raise ValueError(
+                "Quantized models have to be TorchScript archives written by quantize and run with the torch backend."
+            )
         # check for GPU, use CPU otherwise
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         # if flag cpu is set, use cpu regardless of available GPU
-        if cpu:
+        # quantized kernels are only available on the CPU
+        if cpu or quantized:
             self.device = "cpu"
-        self.model = UNet(1)
         self.load_weights(weights)
-        self.model.to(self.device)
         # initalize image
         self.denoised_img = np.empty((0, 0, 0))
         self.img = np.empty((0, 0, 0))
@@ -57,18 +122,58 @@ class ModelWrapper:
 
     def load_weights(self, weights: str) -> None:
         """
-        Load pre-trained weights into the U-Net model.
+        Load pre-trained weights into the inference backend.
+
+        For the torch backend, batch normalizations are folded into the convolutions
+        and the model uses the channels_last memory format. TorchScript archives are
+        loaded directly. The onnxruntime backend loads an ONNX model and always runs
+        on the CPU.
+
+        Args:
+            weights (str): Path to the pre-trained weights file, TorchScript archive or ONNX model.
+        """
+        self.backend = backends.load_backend(
+            self.backend_name, weights, self.device, self.num_threads
+        )
+        self.device = self.backend.device
+
+    def tune_batch_size(self, height: int, width: int) -> None:
+        """
+        Select the batch size for inputs of the given shape, if the batch size is tuned automatically.
+
+        The tuned batch size is looked up in the on-disk cache, keyed by the model weights,
+        the device, the input shape and the data type. Only if it is not cached, short
+        probe passes are run.
 
         Args:
-            weights (str): Path to the pre-trained weights file.
+            height (int): Height of the model input (frame or tile).
+            width (int): Width of the model input (frame or tile).
         """
-        if self.device == "cpu":
-            self.model.load_state_dict(
-                torch.load(weights, map_location=torch.device("cpu"))
+        if not self.auto_batch_size:
+            return
+        if (height, width) not in self.tuned_batch_sizes:
+            if self.model_key is None:
+                self.model_key = file_hash(self.weights)
+            self.tuned_batch_sizes[(height, width)] = batchsize.get_batch_size(
+                self.backend,
+                self.model_key,
+                self.device,
+                height,
+                width,
+                torch.float32,
+                self.memory_budget,
             )
-        else:
-            self.model.load_state_dict(torch.load(weights))
-        self.model.eval()
+        self.batch_size = self.tuned_batch_sizes[(height, width)]
+
+    def stats_threads(self) -> int:
+        """
+        Number of threads used to compute the mean and standard deviation of an
+        image sequence, the number of threads of the backend.
+
+        Returns:
+            int: Number of threads.
+        """
+        return self.num_threads or torch.get_num_threads()
 
     def normalize_img(self) -> None:
         """
@@ -78,8 +183,9 @@ class ModelWrapper:
         of the input image sequence and performs z-score normalization using
         these values.
         """
-        self.img_mean: np.ndarray = np.mean(self.img, axis=0)
-        self.img_std: np.ndarray = np.std(self.img, axis=0)
+        self.img_mean, self.img_std = normalization.mean_std(
+            self.img, self.dtype, num_threads=self.stats_threads()
+        )
         # normalization
         self.img: np.ndarray = normalization.z_norm(
             self.img, self.img_mean, self.img_std
@@ -109,27 +215,130 @@ class ModelWrapper:
             self.img_height,
             self.img_width,
         )
-        return torch.tensor(X, dtype=torch.float)
+        return torch.from_numpy(np.ascontiguousarray(X, dtype=np.float32))
 
-    def inference(self) -> list[np.ndarray]:
+    def predict(self, X: torch.Tensor) -> np.ndarray:
+        """
+        Predict a batch of (z-normalized) frames or tiles.
+
+        Args:
+            X (torch.Tensor): Input tensor of shape (batch, 1, height, width).
+
+        Returns:
+            np.ndarray[np.float32]: Prediction of shape (batch, 1, height, width).
+        """
+        return self.backend(X.numpy())
+
+    def write_denoised_frames(self, frames: np.ndarray, out: np.ndarray) -> None:
+        """
+        Reverse the z-normalization of predicted frames and cast them to uint16.
+
+        The reversed frames are clipped in place and written directly into the
+        preallocated output array, so that at most one temporary array of the
+        size of the predicted frames is allocated.
+
+        Args:
+            frames (np.ndarray): Predicted, z-normalized frames (frames, height, width).
+            out (np.ndarray[np.uint16]): Output array of the same shape as frames.
+        """
+        frames = normalization.reverse_z_norm(frames, self.img_mean, self.img_std)
+        # tiff format is based on uint16 -> cast
+        float_to_uint(frames, out=out)
+
+    def inference(self, out: np.ndarray | None = None) -> np.ndarray:
         """
         Perform inference on the input image sequence using the U-Net model.
 
         This method processes the input image sequence in batches using the
-        U-Net model and returns the denoised frames as a list of NumPy arrays.
+        U-Net model. Each batch is de-normalized and written directly into the
+        uint16 output array.
+
+        Args:
+            out (np.ndarray[np.uint16], optional): Preallocated output array with the
+                                                   shape of the input image sequence.
+                                                   If None, a new array is allocated.
 
         Returns:
-            list[np.ndarray]: List of denoised frames.
+            np.ndarray[np.uint16]: Denoised image sequence.
         """
-        denoised_image_sequence = []
+        if out is None:
+            out = np.empty(self.img.shape, dtype=np.uint16)
+        if self.tile_size > 0:
+            return self.tiled_inference(out)
+        self.tune_batch_size(self.img_height, self.img_width)
         for from_frame in range(0, self.img.shape[0], self.batch_size):
-            X = self.get_prediction_frames(from_frame).to(self.device)
-            y_pred = np.array(self.model(X).detach().to("cpu"))
-            for denoised_frame in y_pred:
-                denoised_image_sequence.append(
-                    denoised_frame.reshape(self.img_height, self.img_width)
+            y_pred = self.predict(self.get_prediction_frames(from_frame))
+            to_frame = from_frame + y_pred.shape[0]
+            self.write_denoised_frames(
+                y_pred.reshape(-1, self.img_height, self.img_width),
+                out[from_frame:to_frame],
+            )
+        return out
+
+    def tiled_inference(self, out: np.ndarray) -> np.ndarray:
+        """
+        Perform inference on the input image sequence in overlapping tiles.
+
+        Each frame is split into overlapping tiles of size `tile_size`. Tiles of
+        consecutive frames are packed into batches of `batch_size` tiles. The
+        predicted tiles are blended back together with weights that ramp up
+        linearly within the overlap, so that no seams are visible. As soon as
+        all tiles of a frame are predicted, the frame is written into `out`.
+
+        Args:
+            out (np.ndarray[np.uint16]): Preallocated output array with the
+                                         shape of the input image sequence.
+
+        Returns:
+            np.ndarray[np.uint16]: Denoised image sequence.
+        """
+        tile_height = min(self.tile_size, self.img_height)
+        tile_width = min(self.tile_size, self.img_width)
+        self.tune_batch_size(tile_height, tile_width)
+        y_starts = tiling.tile_starts(self.img_height, tile_height, self.tile_overlap)
+        x_starts = tiling.tile_starts(self.img_width, tile_width, self.tile_overlap)
+        weights = tiling.blending_weights(tile_height, tile_width, self.tile_overlap)
+        weight_sum = tiling.blending_normalization(
+            self.img_height, self.img_width, y_starts, x_starts, weights
+        )
+        tiles_per_frame = len(y_starts) * len(x_starts)
+        tiles = [
+            (frame, y, x)
+            for frame in range(self.img.shape[0])
+            for y in y_starts
+            for x in x_starts
+        ]
+        # frames of which not all tiles were predicted yet
+        pending_frames = {}
+        for from_tile in range(0, len(tiles), self.batch_size):
+            batch = tiles[from_tile : from_tile + self.batch_size]
+            X = np.stack(
+                [
+                    self.img[frame, y : y + tile_height, x : x + tile_width]
+                    for frame, y, x in batch
+                ]
+            ).reshape(len(batch), 1, tile_height, tile_width)
+            X = torch.from_numpy(np.ascontiguousarray(X, dtype=np.float32))
+            y_pred = self.predict(X)
+            for (frame, y, x), denoised_tile in zip(batch, y_pred):
+                if frame not in pending_frames:
+                    pending_frames[frame] = np.zeros(
+                        (self.img_height, self.img_width), dtype=np.float32
+                    )
+                pending_frames[frame][y : y + tile_height, x : x + tile_width] += (
+                    denoised_tile.reshape(tile_height, tile_width) * weights
                 )
-        return denoised_image_sequence
+            # all tiles of frames before the last tile of the batch are predicted
+            done_tiles = from_tile + len(batch)
+            for frame in sorted(pending_frames):
+                if (frame + 1) * tiles_per_frame > done_tiles:
+                    break
+                denoised_frame = pending_frames.pop(frame)
+                np.divide(denoised_frame, weight_sum, out=denoised_frame)
+                self.write_denoised_frames(
+                    denoised_frame[np.newaxis], out[frame : frame + 1]
+                )
+        return out
 
     def denoise_img(self, img_path: str) -> None:
         """
@@ -142,16 +351,76 @@ class ModelWrapper:
         Args:
             img_path (str): Path to the image sequence file.
         """
+        self.denoise_array(open_file(img_path, self.dtype))
+
+    def denoise_array(self, img: np.ndarray) -> None:
+        """
+        Denoise an image sequence that is already loaded into memory.
 
-        self.img: np.ndarray = open_file(img_path)
+        This method normalizes the input image sequence, performs inference
+        using the U-Net model, and stores the denoised image sequence in the
+        `denoised_img` attribute. A new output array is allocated for every
+        image sequence, so a previous result stays valid.
+
+        Args:
+            img (np.ndarray): Image sequence (frames, height, width).
+        """
+        self.img: np.ndarray = img.astype(self.dtype, copy=False)
         _, self.img_height, self.img_width = self.img.shape
         self.normalize_img()
-        denoised_image_sequence = self.inference()
-        self.denoised_img = normalization.reverse_z_norm(
-            np.array(denoised_image_sequence), self.img_mean, self.img_std
+        self.denoised_img = np.empty(self.img.shape, dtype=np.uint16)
+        self.inference(self.denoised_img)
+
+    def denoise_img_streaming(
+        self, img_path: str, outpath: str, block_size: int = 256
+    ) -> None:
+        """
+        Denoise an image sequence that does not fit into memory.
+
+        The mean and standard deviation are computed in a first pass over the
+        image sequence. In a second pass, blocks of `block_size` frames are
+        read, denoised and directly appended to the output file. Thus, the
+        memory usage depends on the block size and not on the number of frames.
+
+        Args:
+            img_path (str): Path to the image sequence file.
+            outpath (str): Path to the output file where the denoised image sequence
+                           should be written.
+            block_size (int): Number of frames that are read and written at once.
+        """
+        with StackReader(img_path, self.dtype) as reader:
+            _, self.img_height, self.img_width = reader.shape
+            self.img_mean, self.img_std = normalization.reader_mean_std(
+                reader, self.dtype, block_size, self.stats_threads()
+            )
+            write_file_blocks(
+                self.denoise_blocks(reader, block_size), reader.shape, outpath
+            )
+        self.img = np.empty((0, 0, 0))
+
+    def denoise_blocks(
+        self, reader: StackReader, block_size: int
+    ) -> Iterator[np.ndarray]:
+        """
+        Denoise an image sequence block by block.
+
+        Requires `img_mean` and `img_std` of the complete image sequence. The
+        output buffer is reused for all blocks, each yielded block is only valid
+        until the next block is requested.
+
+        Args:
+            reader (StackReader): Reader of the image sequence.
+            block_size (int): Number of frames per block.
+
+        Yields:
+            np.ndarray[np.uint16]: Denoised block of frames.
+        """
+        denoised_block = np.empty(
+            (block_size, self.img_height, self.img_width), dtype=np.uint16
         )
-        # tiff format is based on uint16 -> cast
-        self.denoised_img = float_to_uint(self.denoised_img)
+        for _, block in reader.iter_blocks(block_size):
+            self.img = normalization.z_norm(block, self.img_mean, self.img_std)
+            yield self.inference(denoised_block[: block.shape[0]])
 
     def write_denoised_img(self, outpath: str) -> None:
         """
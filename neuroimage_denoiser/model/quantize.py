@@ -0,0 +1,213 @@
+import os
+import copy
+import shutil
+import tempfile
+import numpy as np
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from neuroimage_denoiser.model.unet import UNet
+from neuroimage_denoiser.utils.evaluate_model import evaluate, raw_evaluate
+from neuroimage_denoiser.utils.h5patches import PatchStore
+
+# quantized kernels of the x86 backend (fbgemm/onednn)
+QUANTIZED_ENGINE = "x86"
+
+
+def set_quantized_engine() -> None:
+    """
+    Select the x86 engine for quantized kernels, if it is available on this machine.
+    """
+    if QUANTIZED_ENGINE in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = QUANTIZED_ENGINE
+
+
+def load_calibration_data(
+    h5_path: str, num_patches: int = 256, seed: int = 0
+) -> np.ndarray:
+    """
+    Load a random subset of the training patches to calibrate the quantization.
+
+    Args:
+        h5_path (str): Path to a training H5 file written by prepare_training.
+        num_patches (int): Number of patches used for calibration.
+        seed (int): Seed of the random selection.
+
+    Returns:
+        np.ndarray[np.float32]: Patches of shape (num_patches, 1, crop_size, crop_size).
+
+    Raises:
+        ValueError: If the H5 file does not contain any patches.
+    """
+    with PatchStore(h5_path) as store:
+        num_examples = len(store)
+        if num_examples == 0:
+            raise ValueError(f"No training patches found in {h5_path}.")
+        rng = np.random.default_rng(seed)
+        idxs = rng.choice(num_examples, min(num_patches, num_examples), replace=False)
+        patches = store.read_indices(idxs).astype(np.float32)
+    return patches[:, np.newaxis]
+
+
+def quantize_unet(
+    weights: str, calibration_data: np.ndarray, batch_size: int = 16
+) -> torch.nn.Module:
+    """
+    Quantize a trained U-Net to int8 with static post-training quantization.
+
+    The model is traced with torch.fx, Conv2d-BatchNorm2d-ReLU sequences are fused
+    and observers are inserted. Running the calibration patches through the model
+    records the value ranges of the activations, from which the quantization
+    parameters are computed. Weights are quantized per channel (per tensor for the
+    transposed convolutions). The quantized model runs on the CPU only.
+
+    Args:
+        weights (str): Path to the trained weights (state_dict).
+        calibration_data (np.ndarray[np.float32]): Z-normalized patches of shape
+                                                   (patches, 1, height, width).
+        batch_size (int): Number of patches per calibration pass.
+
+    Returns:
+        torch.nn.Module: The quantized model, which takes and returns float32 tensors.
+    """
+    set_quantized_engine()
+    model = UNet(1)
+    model.load_state_dict(torch.load(weights, map_location="cpu"))
+    model.eval()
+    example_inputs = (torch.from_numpy(calibration_data[:1]),)
+    prepared = prepare_fx(
+        copy.deepcopy(model),
+        get_default_qconfig_mapping(QUANTIZED_ENGINE),
+        example_inputs=example_inputs,
+    )
+    with torch.inference_mode():
+        for from_patch in range(0, len(calibration_data), batch_size):
+            prepared(
+                torch.from_numpy(calibration_data[from_patch : from_patch + batch_size])
+            )
+    return convert_fx(prepared)
+
+
+def save_quantized(model: torch.nn.Module, outpath: str) -> None:
+    """
+    Save a quantized model as frozen TorchScript archive.
+
+    Args:
+        model (torch.nn.Module): Quantized model (see quantize_unet).
+        outpath (str): Path to the TorchScript archive that will be written.
+    """
+    frozen = torch.jit.freeze(torch.jit.script(model))
+    torch.jit.save(frozen, outpath)
+
+
+def compare_results(
+    result_float: dict, result_quantized: dict, tolerance: float
+) -> list[str]:
+    """
+    Compare the evaluation results (see evaluate_model.evaluate) of the float and the quantized model.
+
+    The quantized model has to detect the same peaks in every ROI. The peak intensities
+    at the events of the raw recording and the mean noise standard deviation may differ
+    by at most `tolerance` relative to the float model.
+
+    Args:
+        result_float (dict): Evaluation result of the float model.
+        result_quantized (dict): Evaluation result of the quantized model.
+        tolerance (float): Maximal relative deviation.
+
+    Returns:
+        list[str]: Descriptions of all violations, empty if the quantized model passed.
+    """
+    violations = []
+    for roi_name, roi_float in result_float.items():
+        if roi_name == "noise_stds":
+            continue
+        roi_quantized = result_quantized[roi_name]
+        if roi_float["peak_frames"] != roi_quantized["peak_frames"]:
+            violations.append(
+                f"ROI {roi_name}: detected peaks at frames {roi_quantized['peak_frames']} instead of {roi_float['peak_frames']}."
+            )
+        peaks_float = np.array(roi_float["peak_intensities_match_raw_events"])
+        peaks_quantized = np.array(roi_quantized["peak_intensities_match_raw_events"])
+        deviation = np.abs(peaks_quantized - peaks_float)
+        if np.any(deviation > tolerance * np.abs(peaks_float)):
+            violations.append(
+                f"ROI {roi_name}: peak intensities {peaks_quantized.tolist()} deviate from {peaks_float.tolist()}."
+            )
+    noise_float = result_float["noise_stds"]
+    noise_quantized = result_quantized["noise_stds"]
+    if abs(noise_quantized - noise_float) > tolerance * abs(noise_float):
+        violations.append(
+            f"Noise standard deviation {noise_quantized:.4f} deviates from {noise_float:.4f}."
+        )
+    return violations
+
+
+def quantize(
+    weights: str,
+    h5_path: str,
+    outpath: str,
+    evaluation_img_path: str,
+    evaluation_roi_folder: str,
+    stimulation_frames: list[int],
+    response_patience: int,
+    num_patches: int = 256,
+    tolerance: float = 0.05,
+    force: bool = False,
+) -> bool:
+    """
+    Quantize a trained U-Net and save it only if it preserves the event detection quality.
+
+    The quantized model is calibrated on patches of the training H5 file. Then both the
+    float and the quantized model denoise the evaluation recording and are compared with
+    the ROI metrics of evaluate_model.evaluate (see compare_results).
+
+    Args:
+        weights (str): Path to the trained weights (state_dict).
+        h5_path (str): Path to the training H5 file used for calibration.
+        outpath (str): Path to the quantized TorchScript archive that will be written.
+        evaluation_img_path (str): Path to the evaluation recording.
+        evaluation_roi_folder (str): Folder with the ImageJ ROIs (.roi) of the evaluation recording.
+        stimulation_frames (list[int]): Frames of the stimulations.
+        response_patience (int): Number of frames after a stimulation in which a response is expected.
+        num_patches (int): Number of training patches used for calibration.
+        tolerance (float): Maximal relative deviation of the ROI metrics.
+        force (bool): Save the quantized model even if it did not pass the accuracy check.
+
+    Returns:
+        bool: True if the quantized model passed the accuracy check.
+    """
+    calibration_data = load_calibration_data(h5_path, num_patches)
+    quantized_model = quantize_unet(weights, calibration_data)
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        quantized_path = os.path.join(tmp_folder, "quantized.pt")
+        save_quantized(quantized_model, quantized_path)
+        result_raw = raw_evaluate(
+            evaluation_img_path,
+            evaluation_roi_folder,
+            stimulation_frames,
+            response_patience,
+        )
+        evaluation_args = (
+            tmp_folder,
+            evaluation_img_path,
+            "auto",
+            evaluation_roi_folder,
+            stimulation_frames,
+            response_patience,
+            result_raw,
+        )
+        result_float = evaluate(weights, *evaluation_args)
+        result_quantized = evaluate(quantized_path, *evaluation_args, quantized=True)
+        violations = compare_results(result_float, result_quantized, tolerance)
+        passed = len(violations) == 0
+        for violation in violations:
+            print(violation)
+        if passed:
+            print("Quantized model passed the accuracy check.")
+        else:
+            print("Quantized model failed the accuracy check.")
+        if passed or force:
+            shutil.move(quantized_path, outpath)
+            print(f"Saved quantized model as: {outpath}")
+    return passed
@@ -0,0 +1,477 @@
+import io
+import os
+import json
+import time
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+import neuroimage_denoiser.utils.normalization as normalization
+from neuroimage_denoiser.model.modelwrapper import ModelWrapper
+from neuroimage_denoiser.utils.convert import float_to_uint
+from neuroimage_denoiser.utils.open_file import open_file
+from neuroimage_denoiser.utils.write_file import write_file
+
+
+class DenoiseJob:
+    """
+    A single image sequence submitted to the DenoiseService.
+
+    Attributes:
+        img (np.ndarray): Z-normalized image sequence (frames, height, width).
+        num_frames (int): Number of frames of the image sequence.
+        frame_shape (tuple[int, int]): Height and width of the frames.
+        img_mean (np.ndarray): Mean of the image sequence along the z-axis.
+        img_std (np.ndarray): Standard deviation of the image sequence along the z-axis.
+        denoised_img (np.ndarray[np.uint16]): Denoised image sequence, valid once `done` is set.
+        next_frame (int): First frame that was not yet scheduled for prediction.
+        done_frames (int): Number of frames that are denoised.
+        done (threading.Event): Set when all frames are denoised or the job failed.
+        error (Exception | None): Error raised during the prediction of the job.
+        submitted (float): Time (perf_counter) the job was submitted.
+    """
+
+    def __init__(self, img: np.ndarray, dtype: np.dtype) -> None:
+        """
+        Normalize the image sequence and allocate the output.
+
+        Args:
+            img (np.ndarray): Image sequence (frames, height, width).
+            dtype (np.dtype): Floating point type used for the normalization.
+
+        Raises:
+            ValueError: If the image sequence is not 3D.
+        """
+        if img.ndim != 3:
+            raise ValueError(
+                f"Expected an image sequence of shape (frames, height, width), got shape {img.shape}."
+            )
+        img = img.astype(dtype, copy=False)
+        self.img_mean, self.img_std = normalization.mean_std(img, dtype)
+        self.img = normalization.z_norm(img, self.img_mean, self.img_std)
+        self.denoised_img = np.empty(img.shape, dtype=np.uint16)
+        self.num_frames = img.shape[0]
+        self.frame_shape = img.shape[1:]
+        self.next_frame = 0
+        self.done_frames = 0
+        self.done = threading.Event()
+        self.error = None
+        self.submitted = time.perf_counter()
+
+
+class DenoiseService:
+    """
+    Long-running denoiser that keeps one or more models loaded and batches
+    frames of concurrent jobs into shared forward passes.
+
+    Every model is driven by its own batcher thread. A batcher takes the
+    frame shape with the oldest waiting job and fills a batch with frames of
+    all waiting jobs of that shape, in order of submission. If fewer frames
+    than the batch size are waiting, it waits up to `max_wait` seconds for
+    further jobs before predicting a partial batch.
+
+    Attributes:
+        models (list[ModelWrapper]): Loaded models, one batcher thread each.
+        dtype (np.dtype): Floating point type used for the normalization.
+        max_wait (float): Maximum time in seconds a partial batch waits for further jobs.
+        pending (dict[tuple[int, int], deque[DenoiseJob]]): Waiting jobs, keyed by frame shape.
+        batch_sizes (dict[tuple[str, tuple[int, int]], int]): Tuned batch sizes, keyed by device and frame shape.
+    """
+
+    def __init__(
+        self, model_kwargs: dict, num_models: int = 1, max_wait: float = 0.005
+    ) -> None:
+        """
+        Load the models and start the batcher threads.
+
+        Args:
+            model_kwargs (dict): Keyword arguments passed to ModelWrapper (tiling is not
+                                 supported by the service, frames are always predicted whole).
+            num_models (int): Number of models that predict batches concurrently.
+            max_wait (float): Maximum time in seconds a partial batch waits for further jobs.
+        """
+        self.models = [ModelWrapper(**model_kwargs) for _ in range(num_models)]
+        self.dtype = self.models[0].dtype
+        self.max_wait = max_wait
+        self.pending: dict[tuple[int, int], deque[DenoiseJob]] = {}
+        self.condition = threading.Condition()
+        self.running = True
+        # tuning runs once per device and frame shape, shared by all models
+        self.tuning_lock = threading.Lock()
+        self.batch_sizes: dict[tuple[str, tuple[int, int]], int] = {}
+        # statistics
+        self.stats_lock = threading.Lock()
+        self.started = time.time()
+        self.latencies = deque(maxlen=1000)
+        self.completed_jobs = 0
+        self.failed_jobs = 0
+        self.denoised_frames = 0
+        self.batches = 0
+        self.batchers = [
+            threading.Thread(target=self.run_batcher, args=(model,), daemon=True)
+            for model in self.models
+        ]
+        for batcher in self.batchers:
+            batcher.start()
+
+    def submit(self, img: np.ndarray) -> DenoiseJob:
+        """
+        Normalize an image sequence and queue it for denoising.
+
+        Args:
+            img (np.ndarray): Image sequence (frames, height, width).
+
+        Returns:
+            DenoiseJob: The queued job, wait for `job.done` to get the result.
+        """
+        job = DenoiseJob(img, self.dtype)
+        if job.num_frames == 0:
+            job.done.set()
+            return job
+        with self.condition:
+            self.pending.setdefault(job.frame_shape, deque()).append(job)
+            self.condition.notify_all()
+        return job
+
+    def denoise(self, img: np.ndarray) -> np.ndarray:
+        """
+        Denoise an image sequence and block until it is done.
+
+        Args:
+            img (np.ndarray): Image sequence (frames, height, width).
+
+        Returns:
+            np.ndarray[np.uint16]: Denoised image sequence.
+
+        Raises:
+            Exception: Any error raised during the prediction of the job.
+        """
+        job = self.submit(img)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.denoised_img
+
+    def denoise_file(self, filepath: str, outputpath: str) -> str:
+        """
+        Denoise an image sequence file and write the result as <name>_denoised.tif.
+
+        Args:
+            filepath (str): Path to the image sequence file.
+            outputpath (str): Output directory.
+
+        Returns:
+            str: Path to the denoised image sequence.
+        """
+        denoised_img = self.denoise(open_file(filepath, self.dtype))
+        os.makedirs(outputpath, exist_ok=True)
+        filename = os.path.splitext(os.path.basename(filepath))[0]
+        outfilepath = os.path.join(outputpath, f"{filename}_denoised.tif")
+        write_file(denoised_img, outfilepath)
+        return outfilepath
+
+    def pending_frames(self, frame_shape: tuple[int, int]) -> int:
+        """
+        Number of waiting frames of a frame shape. Requires the lock of `condition`.
+        """
+        return sum(
+            job.num_frames - job.next_frame for job in self.pending.get(frame_shape, [])
+        )
+
+    def tune_batch_size(
+        self, model: ModelWrapper, frame_shape: tuple[int, int]
+    ) -> None:
+        """
+        Select the batch size of a model for a frame shape, if the batch size is tuned automatically.
+
+        The probe passes of a device and frame shape run only once, in one batcher:
+        concurrent probes would time each other's load. The other models on the device
+        wait for the result and reuse it.
+
+        Args:
+            model (ModelWrapper): Model of the batcher.
+            frame_shape (tuple[int, int]): Height and width of the frames.
+        """
+        if not model.auto_batch_size:
+            return
+        key = (str(model.device), frame_shape)
+        if key not in self.batch_sizes:
+            with self.tuning_lock:
+                if key not in self.batch_sizes:
+                    model.tune_batch_size(*frame_shape)
+                    self.batch_sizes[key] = model.batch_size
+        model.tuned_batch_sizes[frame_shape] = self.batch_sizes[key]
+        model.batch_size = self.batch_sizes[key]
+
+    def next_batch(
+        self, model: ModelWrapper
+    ) -> list[tuple[DenoiseJob, int, int]] | None:
+        """
+        Wait for waiting frames and assemble the next batch of a batcher.
+
+        Args:
+            model (ModelWrapper): Model of the batcher, which determines the batch size.
+
+        Returns:
+            list[tuple[DenoiseJob, int, int]] | None: Frame ranges (job, start, stop) of the
+                                                      batch, None if the service is shut down.
+        """
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return None
+                frame_shape = min(
+                    self.pending, key=lambda shape: self.pending[shape][0].submitted
+                )
+            # tuning may run probe passes, do not block submissions meanwhile
+            try:
+                self.tune_batch_size(model, frame_shape)
+            except Exception as error:
+                # fail the waiting jobs of the frame shape, keep the batcher alive
+                with self.condition:
+                    jobs = list(self.pending.pop(frame_shape, []))
+                for job in jobs:
+                    self.finish_job(job, error)
+                continue
+            batch_size = model.batch_size
+            with self.condition:
+                deadline = time.perf_counter() + self.max_wait
+                while (
+                    self.running
+                    and frame_shape in self.pending
+                    and self.pending_frames(frame_shape) < batch_size
+                    and (remaining := deadline - time.perf_counter()) > 0
+                ):
+                    self.condition.wait(remaining)
+                if not self.running:
+                    return None
+                # another batcher took the waiting frames
+                if frame_shape not in self.pending:
+                    continue
+                jobs = self.pending[frame_shape]
+                batch = []
+                num_frames = 0
+                while jobs and num_frames < batch_size:
+                    job = jobs[0]
+                    stop = min(job.num_frames, job.next_frame + batch_size - num_frames)
+                    batch.append((job, job.next_frame, stop))
+                    num_frames += stop - job.next_frame
+                    job.next_frame = stop
+                    if job.next_frame == job.num_frames:
+                        jobs.popleft()
+                if not jobs:
+                    del self.pending[frame_shape]
+                return batch
+
+    def run_batcher(self, model: ModelWrapper) -> None:
+        """
+        Predict batches with a model until the service is shut down.
+
+        Args:
+            model (ModelWrapper): Model of the batcher.
+        """
+        while (batch := self.next_batch(model)) is not None:
+            height, width = batch[0][0].frame_shape
+            X = np.concatenate([job.img[start:stop] for job, start, stop in batch])
+            X = np.ascontiguousarray(X, dtype=np.float32).reshape(-1, 1, height, width)
+            try:
+                y_pred = model.predict(torch.from_numpy(X))
+            except Exception as error:
+                for job, _, _ in batch:
+                    self.finish_job(job, error)
+                continue
+            y_pred = y_pred.reshape(-1, height, width)
+            from_frame = 0
+            for job, start, stop in batch:
+                frames = y_pred[from_frame : from_frame + stop - start]
+                from_frame += stop - start
+                if job.error is not None:
+                    continue
+                frames = normalization.reverse_z_norm(frames, job.img_mean, job.img_std)
+                float_to_uint(frames, out=job.denoised_img[start:stop])
+                # batches of the same job may be predicted by several batchers
+                with self.stats_lock:
+                    job.done_frames += stop - start
+                    finished = job.done_frames == job.num_frames
+                if finished:
+                    self.finish_job(job)
+            with self.stats_lock:
+                self.batches += 1
+                self.denoised_frames += len(X)
+
+    def finish_job(self, job: DenoiseJob, error: Exception | None = None) -> None:
+        """
+        Mark a job as done and record its latency.
+
+        Args:
+            job (DenoiseJob): The finished job.
+            error (Exception, optional): Error that made the job fail.
+        """
+        if error is not None:
+            # drop frames of the job that were not scheduled yet
+            with self.condition:
+                jobs = self.pending.get(job.frame_shape)
+                if jobs is not None and job in jobs:
+                    jobs.remove(job)
+                    if not jobs:
+                        del self.pending[job.frame_shape]
+        with self.stats_lock:
+            if job.done.is_set():
+                return
+            if error is None:
+                self.completed_jobs += 1
+                self.latencies.append(time.perf_counter() - job.submitted)
+                # all frames are predicted, release the normalized input
+                job.img = job.img[:0]
+            else:
+                job.error = error
+                self.failed_jobs += 1
+            job.done.set()
+
+    def stats(self) -> dict:
+        """
+        Queue depth, throughput and latency of the service.
+
+        Returns:
+            dict: Statistics of the service. Latencies (in seconds, from submission to
+                  the last denoised frame) are computed over the last 1000 jobs.
+        """
+        with self.condition:
+            queued_jobs = sum(len(jobs) for jobs in self.pending.values())
+            queued_frames = sum(
+                self.pending_frames(frame_shape) for frame_shape in self.pending
+            )
+        with self.stats_lock:
+            latencies = np.array(self.latencies)
+            stats = {
+                "queued_jobs": queued_jobs,
+                "queued_frames": queued_frames,
+                "completed_jobs": self.completed_jobs,
+                "failed_jobs": self.failed_jobs,
+                "denoised_frames": self.denoised_frames,
+                "batches": self.batches,
+                "mean_batch_size": (
+                    self.denoised_frames / self.batches if self.batches > 0 else 0.0
+                ),
+                "num_models": len(self.models),
+                "uptime": time.time() - self.started,
+            }
+        if len(latencies) > 0:
+            stats["latency_mean"] = float(np.mean(latencies))
+            stats["latency_p50"] = float(np.percentile(latencies, 50))
+            stats["latency_p95"] = float(np.percentile(latencies, 95))
+            stats["latency_max"] = float(np.max(latencies))
+        return stats
+
+    def shutdown(self) -> None:
+        """
+        Stop the batcher threads. Waiting jobs are not denoised.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for batcher in self.batchers:
+            batcher.join()
+
+
+def make_request_handler(service: DenoiseService) -> type[BaseHTTPRequestHandler]:
+    """
+    Create the HTTP request handler of a service.
+
+    Endpoints:
+        GET /stats: Statistics of the service as JSON (see DenoiseService.stats).
+        POST /denoise: JSON {"path": ..., "outputpath": ...}, denoises a file and
+                       responds with {"outfilepath": ..., "runtime": ...}.
+        POST /denoise_array: Image sequence in .npy format (np.save), responds with
+                             the denoised image sequence (uint16) in .npy format.
+
+    Args:
+        service (DenoiseService): The service that denoises the requests.
+
+    Returns:
+        type[BaseHTTPRequestHandler]: Request handler class for the HTTP server.
+    """
+
+    class DenoiseRequestHandler(BaseHTTPRequestHandler):
+        def send_body(self, status: int, body: bytes, content_type: str) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, status: int, content: dict) -> None:
+            self.send_body(status, json.dumps(content).encode(), "application/json")
+
+        def read_body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_GET(self) -> None:
+            if self.path == "/stats":
+                self.send_json(200, service.stats())
+            else:
+                self.send_json(404, {"error": f"Unknown endpoint {self.path}."})
+
+        def do_POST(self) -> None:
+            start = time.perf_counter()
+            try:
+                if self.path == "/denoise":
+                    request = json.loads(self.read_body())
+                    outfilepath = service.denoise_file(
+                        request["path"], request["outputpath"]
+                    )
+                    self.send_json(
+                        200,
+                        {
+                            "outfilepath": outfilepath,
+                            "runtime": time.perf_counter() - start,
+                        },
+                    )
+                elif self.path == "/denoise_array":
+                    img = np.load(io.BytesIO(self.read_body()), allow_pickle=False)
+                    buffer = io.BytesIO()
+                    np.save(buffer, service.denoise(img))
+                    self.send_body(200, buffer.getvalue(), "application/octet-stream")
+                else:
+                    self.send_json(404, {"error": f"Unknown endpoint {self.path}."})
+            except (KeyError, ValueError, OSError) as error:
+                self.send_json(400, {"error": f"{type(error).__name__}: {error}"})
+            except Exception as error:
+                self.send_json(500, {"error": f"{type(error).__name__}: {error}"})
+
+    return DenoiseRequestHandler
+
+
+def serve(
+    model_kwargs: dict,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    num_models: int = 1,
+    max_wait: float = 0.005,
+) -> None:
+    """
+    Run the denoising service on a local HTTP server until it is interrupted.
+
+    Args:
+        model_kwargs (dict): Keyword arguments passed to ModelWrapper.
+        host (str): Address the server listens on (default: localhost only).
+        port (int): Port the server listens on.
+        num_models (int): Number of models that predict batches concurrently.
+        max_wait (float): Maximum time in seconds a partial batch waits for further jobs.
+    """
+    # the thread pool of torch is shared by all models of the process, set it once
+    if model_kwargs.get("num_threads") is not None:
+        torch.set_num_threads(model_kwargs["num_threads"])
+    service = DenoiseService(model_kwargs, num_models, max_wait)
+    server = ThreadingHTTPServer((host, port), make_request_handler(service))
+    print(f"Serving Neuroimage Denoiser on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+def tile_starts(length: int, tile_size: int, overlap: int) -> list[int]:
+    """
+    Compute the start positions of overlapping tiles along one axis.
+
+    The tiles are placed with a stride of tile_size - overlap. The last tile is
+    aligned to the end of the axis, so that the whole axis is covered.
+
+    Parameters:
+    - length (int): Length of the axis.
+    - tile_size (int): Size of the tiles along the axis.
+    - overlap (int): Minimal overlap of neighboring tiles.
+
+    Returns:
+    - list[int]: Start positions of the tiles.
+    """
+    if tile_size >= length:
+        return [0]
+    stride = tile_size - overlap
+    return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+
+def blending_weights(tile_height: int, tile_width: int, overlap: int) -> np.ndarray:
+    """
+    Compute the weights used to blend overlapping tiles.
+
+    The weights ramp up linearly within the overlap at each border of the tile
+    and are 1 in the center. Predictions of overlapping tiles are averaged with
+    these weights, which avoids visible seams at the tile borders.
+
+    Parameters:
+    - tile_height (int): Height of the tiles.
+    - tile_width (int): Width of the tiles.
+    - overlap (int): Overlap of neighboring tiles.
+
+    Returns:
+    - np.ndarray[np.float32]: Weights of shape (tile_height, tile_width).
+    """
+
+    def ramp(size: int) -> np.ndarray:
+        distance_to_border = np.minimum(np.arange(1, size + 1), np.arange(size, 0, -1))
+        return np.minimum(distance_to_border / (overlap + 1), 1.0)
+
+    return np.outer(ramp(tile_height), ramp(tile_width)).astype(np.float32)
+
+
+def blending_normalization(
+    img_height: int,
+    img_width: int,
+    y_starts: list[int],
+    x_starts: list[int],
+    weights: np.ndarray,
+) -> np.ndarray:
+    """
+    Compute the sum of the blending weights of all tiles for each pixel of a frame.
+
+    Parameters:
+    - img_height (int): Height of the frame.
+    - img_width (int): Width of the frame.
+    - y_starts (list[int]): Start positions of the tiles along the y-axis.
+    - x_starts (list[int]): Start positions of the tiles along the x-axis.
+    - weights (np.ndarray[np.float32]): Blending weights of a single tile.
+
+    Returns:
+    - np.ndarray[np.float32]: Sum of the weights of shape (img_height, img_width).
+    """
+    tile_height, tile_width = weights.shape
+    weight_sum = np.zeros((img_height, img_width), dtype=np.float32)
+    for y in y_starts:
+        for x in x_starts:
+            weight_sum[y : y + tile_height, x : x + tile_width] += weights
+    return weight_sum
@@ -1,5 +1,6 @@
 from neuroimage_denoiser.model.unet import UNet
-from neuroimage_denoiser.utils.dataloader import DataLoader
+from neuroimage_denoiser.utils.dataloader import DataLoader, PrefetchDataLoader
+from neuroimage_denoiser.utils.augmentation import BatchAugmentation
 from neuroimage_denoiser.utils.plot import plot_train_loss
 import torch
 import torch.nn as nn
@@ -11,26 +12,29 @@ from alive_progress import alive_bar
 
 def train(
     model: UNet,
-    dataloader: DataLoader,
+    dataloader: DataLoader | PrefetchDataLoader,
     num_epochs: int = 1,
     learningrate: float = 0.0001,
     lossfunction: str = "L1",
     modelpath: str = "unet.pt",
     history_savepath: str = "train_loss.npy",
-    pbar: bool = True
+    pbar: bool = True,
+    augmentation: BatchAugmentation | None = None,
 ) -> None:
     """
     Train the U-Net model using the specified data loader.
 
     Parameters:
     - model (UNet): U-Net model to be trained.
-    - dataloader (DataLoader): Data loader providing training data.
+    - dataloader (DataLoader | PrefetchDataLoader): Data loader providing training data.
     - num_epochs (int): Number of training epochs (default is 1).
     - learningrate (float): Learning rate for the optimizer (default is 0.0001).
     - modelpath (str): Filepath to save the trained model (default is "unet.pt").
     - history_savepath (str): Filepath to save the training loss history (default is "train_loss.npy").
     - example_img_path (str): Path to an example image for periodic model predictions (default is "").
     - predict_example_every_n_batches (int): Interval for making model predictions using the example image (default is 100).
+    - augmentation (BatchAugmentation | None): Augmentation applied to the clean patches (dataloader.y) on the
+      training device; the data loader must not augment then (default is None, the data loader augments).
     """
     lossfunctions = {
         "L1": nn.L1Loss(),
@@ -62,8 +66,13 @@ def train(
                     batch_generated = dataloader.get_batch()
                     if not batch_generated:
                         break
-                    data = dataloader.X.to(device)
-                    targets = dataloader.y.to(device)
+                    if augmentation is None:
+                        data = dataloader.X.to(device, non_blocking=True)
+                        targets = dataloader.y.to(device, non_blocking=True)
+                    else:
+                        data, targets = augmentation(
+                            dataloader.y.to(device, non_blocking=True)
+                        )
                     model.train()
                     outputs = model(data)
                     loss = criterion(outputs, targets)
@@ -82,8 +91,13 @@ def train(
                 batch_generated = dataloader.get_batch()
                 if not batch_generated:
                     break
-                data = dataloader.X.to(device)
-                targets = dataloader.y.to(device)
+                if augmentation is None:
+                    data = dataloader.X.to(device, non_blocking=True)
+                    targets = dataloader.y.to(device, non_blocking=True)
+                else:
+                    data, targets = augmentation(
+                        dataloader.y.to(device, non_blocking=True)
+                    )
                 model.train()
                 outputs = model(data)
                 loss = criterion(outputs, targets)
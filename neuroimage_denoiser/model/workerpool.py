@@ -0,0 +1,124 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import torch
+from alive_progress import alive_bar
+from neuroimage_denoiser.model.modelwrapper import ModelWrapper
+
+# model of the worker process, loaded once by the pool initializer
+_worker_model: ModelWrapper | None = None
+
+
+def init_worker(model_kwargs: dict, num_threads: int) -> None:
+    """
+    Initialize a worker process: limit the thread budget and load the model.
+
+    Args:
+        model_kwargs (dict): Keyword arguments passed to ModelWrapper.
+        num_threads (int): Number of threads the inference backend may use in this worker.
+    """
+    global _worker_model
+    torch.set_num_interop_threads(1)
+    torch.set_num_threads(num_threads)
+    _worker_model = ModelWrapper(**model_kwargs, num_threads=num_threads)
+
+
+def denoise_job(
+    filepath: str, outfilepath: str, streaming: bool, block_size: int
+) -> dict:
+    """
+    Denoise a single file with the model of the worker process.
+
+    Args:
+        filepath (str): Path to the input image.
+        outfilepath (str): Path to the output file.
+        streaming (bool): Flag to denoise the image in blocks of frames.
+        block_size (int): Number of frames per block in streaming mode.
+
+    Returns:
+        dict: Result of the job with the keys filepath, outfilepath, runtime and error
+              (None if the file was denoised successfully).
+    """
+    start = time.time()
+    error = None
+    try:
+        if streaming:
+            _worker_model.denoise_img_streaming(filepath, outfilepath, block_size)
+        else:
+            _worker_model.denoise_img(filepath)
+            _worker_model.write_denoised_img(outfilepath)
+    except Exception as job_error:
+        error = f"{type(job_error).__name__}: {job_error}"
+    return {
+        "filepath": filepath,
+        "outfilepath": outfilepath,
+        "runtime": time.time() - start,
+        "error": error,
+    }
+
+
+def denoise_worker_pool(
+    filelist: list[str],
+    outfilepaths: list[str],
+    workers: int,
+    model_kwargs: dict,
+    streaming: bool = False,
+    block_size: int = 256,
+    pbar: bool = True,
+) -> list[dict]:
+    """
+    Denoise several images in parallel with a pool of worker processes.
+
+    Every worker loads the model once and uses an equal share of the CPU cores
+    as thread budget of its inference backend. The files are scheduled largest
+    first, so that no single large file is left at the end while the other
+    workers are idle.
+
+    Args:
+        filelist (list[str]): Paths to the input images.
+        outfilepaths (list[str]): Paths to the output files.
+        workers (int): Number of worker processes.
+        model_kwargs (dict): Keyword arguments passed to ModelWrapper in each worker.
+        streaming (bool): Flag to denoise the images in blocks of frames.
+        block_size (int): Number of frames per block in streaming mode.
+        pbar (bool): Flag to show a progress bar.
+
+    Returns:
+        list[dict]: Results of all jobs (see denoise_job), in order of completion.
+    """
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    jobs = sorted(
+        zip(filelist, outfilepaths),
+        key=lambda job: os.path.getsize(job[0]),
+        reverse=True,
+    )
+    results = []
+    # spawn fresh interpreters, forking a process with an initialized torch can deadlock
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(model_kwargs, num_threads),
+    ) as executor:
+        futures = [
+            executor.submit(denoise_job, filepath, outfilepath, streaming, block_size)
+            for filepath, outfilepath in jobs
+        ]
+        with alive_bar(len(futures), disable=not pbar) as bar:
+            for future in as_completed(futures):
+                result = future.result()
+                if result["error"] is None:
+                    print(
+                        f"Saved image ({os.path.basename(result['filepath'])}) as: {result['outfilepath']} ({result['runtime']:.1f}s)"
+                    )
+                else:
+                    print(f"Skipped {result['filepath']}, due to an unexpected error:")
+                    print(result["error"])
+                results.append(result)
+                bar()
+    failed = [result for result in results if result["error"] is not None]
+    print(f"Denoised {len(results) - len(failed)} of {len(results)} file(s).")
+    for result in failed:
+        print(f"Failed: {result['filepath']} ({result['error']})")
+    return results
@@ -0,0 +1,14 @@
+import pytest
+import torch
+from neuroimage_denoiser.model.unet import UNet
+
+
+@pytest.fixture(scope="session")
+def weights(tmp_path_factory):
+    """
+    Weights of a randomly initialized U-Net.
+    """
+    torch.manual_seed(0)
+    path = tmp_path_factory.mktemp("weights") / "unet.pt"
+    torch.save(UNet(1).state_dict(), path)
+    return str(path)
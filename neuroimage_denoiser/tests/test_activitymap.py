@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from scipy.ndimage import uniform_filter
+from neuroimage_denoiser.utils.activitymap import compute_activitymap
+
+
+def reference_compute_activitymap(
+    img: np.ndarray, cropsize: int, roi_size: int
+) -> np.ndarray:
+    """
+    Previous frame by frame implementation of compute_activitymap.
+    """
+    h_activitymap = img.shape[1] // cropsize
+    w_activitymap = img.shape[2] // cropsize
+    activitymap = []
+    for frame in img:
+        mean_frame = uniform_filter(frame, roi_size, mode="constant")
+        activitymap.append(
+            [
+                [
+                    np.max(
+                        mean_frame[
+                            y * cropsize : (y + 1) * cropsize,
+                            x * cropsize : (x + 1) * cropsize,
+                        ]
+                    )
+                    for x in range(w_activitymap)
+                ]
+                for y in range(h_activitymap)
+            ]
+        )
+    return np.array(activitymap)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("chunk_size", [1, 4, 64])
+def test_matches_reference(dtype, chunk_size):
+    # neither side is divisible by the crop size
+    img = np.random.default_rng(0).normal(size=(11, 37, 50)).astype(dtype)
+    expected = reference_compute_activitymap(img, 8, 3)
+    result = compute_activitymap(img, 8, 3, chunk_size)
+    assert result.shape == (11, 4, 6) and result.dtype == dtype
+    np.testing.assert_array_equal(result, expected)
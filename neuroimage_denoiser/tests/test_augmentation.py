@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import torch
+from scipy.ndimage import gaussian_filter
+from neuroimage_denoiser.utils.augmentation import BatchAugmentation, gaussian_blur
+
+
+@pytest.mark.parametrize("sigma", [0.5, 1.0, 3.0])
+@pytest.mark.parametrize("dtype, rtol", [(torch.float64, 1e-12), (torch.float32, 1e-5)])
+def test_gaussian_blur_matches_scipy(sigma, dtype, rtol):
+    # the kernel of sigma 3 is wider than the patch, the padding is reflected repeatedly
+    patches = np.random.default_rng(0).normal(size=(3, 1, 5, 7))
+    expected = gaussian_filter(patches, (0, 0, sigma, sigma))
+    result = gaussian_blur(torch.from_numpy(patches).to(dtype), sigma)
+    assert result.shape == patches.shape and result.dtype == dtype
+    np.testing.assert_allclose(result.numpy(), expected, rtol=rtol, atol=rtol)
+
+
+def test_noise_is_reproducible_with_seed():
+    clean = torch.zeros((4, 1, 8, 8))
+    X1, _ = BatchAugmentation(noise_center=1, noise_scale=2, seed=7)(clean)
+    X2, _ = BatchAugmentation(noise_center=1, noise_scale=2, seed=7)(clean)
+    X3, _ = BatchAugmentation(noise_center=1, noise_scale=2, seed=8)(clean)
+    assert torch.equal(X1, X2)
+    assert not torch.equal(X1, X3)
+    # consecutive batches get new noise
+    augmentation = BatchAugmentation(seed=7)
+    assert not torch.equal(augmentation(clean)[0], augmentation(clean)[0])
+
+
+def test_targets():
+    clean = torch.from_numpy(np.random.default_rng(1).normal(size=(2, 1, 6, 6)))
+    _, y = BatchAugmentation(apply_gausian_filter=False)(clean)
+    assert torch.equal(y, clean)
+    _, y = BatchAugmentation(apply_gausian_filter=True, sigma_gausian_filter=1.0)(clean)
+    np.testing.assert_allclose(
+        y.numpy(), gaussian_filter(clean.numpy(), (0, 0, 1.0, 1.0)), rtol=1e-12
+    )
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from neuroimage_denoiser.model.modelwrapper import ModelWrapper
+from neuroimage_denoiser.utils import normalization
+from neuroimage_denoiser.utils.convert import uint_to_float
+
+
+@pytest.fixture(scope="module")
+def img():
+    rng = np.random.default_rng(0)
+    return rng.integers(100, 3000, size=(6, 32, 32), dtype=np.uint16)
+
+
+def test_normalization_float32_matches_float64(img):
+    results = {}
+    for dtype in [np.float32, np.float64]:
+        img_float = uint_to_float(img, dtype)
+        mean, std = normalization.mean_std(img_float, dtype)
+        z = normalization.z_norm(img_float, mean, std)
+        rolling_z = normalization.rolling_window_z_norm(img_float, 4)
+        assert z.dtype == dtype and rolling_z.dtype == dtype
+        reversed_img = normalization.reverse_z_norm(z, mean, std)
+        results[dtype] = (z, rolling_z, reversed_img)
+    for result32, result64 in zip(results[np.float32], results[np.float64]):
+        np.testing.assert_allclose(result32, result64, rtol=1e-4, atol=1e-4)
+
+
+def test_prediction_float32_matches_float64(weights, img):
+    denoised = {}
+    for dtype in [np.float32, np.float64]:
+        model = ModelWrapper(weights, batch_size=4, cpu=True, dtype=dtype)
+        model.denoise_array(img)
+        assert model.img.dtype == dtype
+        denoised[dtype] = model.denoised_img.astype(np.int64)
+    # uint16 output, float32 rounding may flip the last integer
+    np.testing.assert_allclose(denoised[np.float32], denoised[np.float64], atol=1)
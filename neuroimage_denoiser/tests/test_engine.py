@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import torch
+from neuroimage_denoiser.model import backends, engine
+from neuroimage_denoiser.model.unet import UNet
+
+
+@pytest.fixture(scope="module")
+def eager(weights):
+    """
+    The trained model without any inference optimization.
+    """
+    model = UNet(1)
+    model.load_state_dict(torch.load(weights, map_location="cpu"))
+    model.eval()
+
+    def predict(X: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            return model(torch.from_numpy(X)).numpy()
+
+    return predict
+
+
+def random_input(shape: tuple[int, ...]) -> np.ndarray:
+    return np.random.default_rng(0).normal(size=shape).astype(np.float32)
+
+
+# torch deprecates the TorchScript API
+@pytest.mark.filterwarnings("ignore::FutureWarning")
+@pytest.mark.parametrize("shape", [(2, 1, 64, 64), (3, 1, 48, 80)])
+def test_torchscript_export_matches_eager(weights, eager, tmp_path, shape):
+    outpath = str(tmp_path / "unet_ts.pt")
+    engine.export_torchscript(weights, outpath)
+    assert engine.is_torchscript(outpath) and not engine.is_torchscript(weights)
+    model = engine.load_model(outpath)
+    X = random_input(shape)
+    with torch.inference_mode():
+        y_pred = model(
+            torch.from_numpy(X).contiguous(memory_format=torch.channels_last)
+        )
+    # folded batch normalizations round differently
+    np.testing.assert_allclose(y_pred.numpy(), eager(X), rtol=1e-4, atol=1e-4)
+
+
+# the export uses the deprecated TorchScript based exporter of torch
+@pytest.mark.filterwarnings("ignore::DeprecationWarning")
+@pytest.mark.parametrize("shape", [(2, 1, 64, 64), (3, 1, 48, 80)])
+def test_onnx_export_matches_eager(weights, eager, tmp_path, shape):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    outpath = str(tmp_path / "unet.onnx")
+    engine.export_onnx(weights, outpath)
+    backend = backends.OnnxRuntimeBackend(outpath, num_threads=1)
+    X = random_input(shape)
+    np.testing.assert_allclose(backend(X), eager(X), rtol=1e-4, atol=1e-4)
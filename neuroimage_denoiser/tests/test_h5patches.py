@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+from neuroimage_denoiser.utils.h5patches import PatchStore
+
+
+@pytest.mark.parametrize("storage_dtype", ["float16", "int16"])
+def test_out_of_range_values_are_clipped(tmp_path, storage_dtype):
+    patches = np.random.default_rng(0).normal(size=(4, 8, 8)).astype(np.float32)
+    patches[0, 0, 0] = 1e6
+    patches[1, 1, 1] = -1e6
+    with PatchStore(str(tmp_path / "patches.h5"), "w") as store:
+        store.append(patches, storage_dtype=storage_dtype)
+        assert store.encoding_error()["clipped"] == 2
+        decoded = store.read(0, len(store))
+    assert np.all(np.isfinite(decoded))
+    assert decoded[0, 0, 0] > 100 and decoded[1, 1, 1] < -100
+    np.testing.assert_allclose(decoded[2:], patches[2:], atol=1e-2)
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from scipy.ndimage import uniform_filter1d
+from neuroimage_denoiser.utils.normalization import (
+    RunningStats,
+    compute_running_stats,
+    rolling_window_z_norm,
+    sliding_window_z_norm,
+)
+
+
+def reference_rolling_window_z_norm(img: np.ndarray, window_size: int) -> np.ndarray:
+    """
+    Previous O(T * window_size) implementation of rolling_window_z_norm.
+    """
+    before = window_size // 2
+    after = window_size - before
+    mean = uniform_filter1d(img, window_size, axis=0, mode="constant")
+    std = []
+    for idx in range(img.shape[0]):
+        start = max(0, idx - before)
+        end = min(img.shape[0] - 1, idx + after)
+        std.append(np.std(img[start:end], axis=0))
+    return np.divide(np.subtract(img, mean), std)
+
+
+def random_sequence(num_frames: int, dtype: np.dtype) -> np.ndarray:
+    rng = np.random.default_rng(num_frames)
+    # large offset, the running sums must not cancel
+    return (rng.random((num_frames, 4, 5)) * 1000 + 5000).astype(dtype)
+
+
+# np.std of the empty window at the end of short sequences
+@pytest.mark.filterwarnings("ignore:Degrees of freedom:RuntimeWarning")
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("num_frames", [1, 2, 3, 5, 9, 40])
+@pytest.mark.parametrize("window_size", [2, 3, 4, 5, 8, 20])
+def test_matches_reference(dtype, num_frames, window_size):
+    img = random_sequence(num_frames, dtype)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = reference_rolling_window_z_norm(img, window_size)
+        result = rolling_window_z_norm(img, window_size)
+    assert result.dtype == img.dtype
+    rtol = 1e-3 if dtype == np.float32 else 1e-7
+    np.testing.assert_allclose(result, expected, rtol=rtol, atol=rtol)
+
+
+@pytest.mark.parametrize("start, stop", [(0, 3), (4, 11), (20, 30), (29, 30)])
+def test_partial_output(start, stop):
+    img = random_sequence(30, np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = rolling_window_z_norm(img, 6)[start:stop]
+        result = sliding_window_z_norm(
+            img, 6, np.empty((stop - start,) + img.shape[1:]), start
+        )
+    np.testing.assert_allclose(result, expected, rtol=1e-9)
+
+
+@pytest.mark.parametrize("window_size", [-1, 0, 1])
+def test_rejects_single_frame_windows(window_size):
+    with pytest.raises(ValueError):
+        rolling_window_z_norm(random_sequence(5, np.float64), window_size)
+
+
+@pytest.mark.parametrize(
+    "splits",
+    [
+        [37],
+        [1, 36],
+        [5, 0, 13, 19],
+        [20, 2, 1, 14],
+    ],
+)
+def test_running_stats_merge(splits):
+    img = random_sequence(37, np.float32)
+    blocks = np.split(img, np.cumsum(splits)[:-1])
+    # every block in its own object, merged in a different order than added
+    partial = [RunningStats().update(block) for block in blocks]
+    stats = RunningStats()
+    for block_stats in partial[1::2] + partial[::2]:
+        stats.merge(block_stats)
+    assert stats.count == 37
+    mean, std = stats.mean_std()
+    np.testing.assert_allclose(mean, np.mean(img, axis=0, dtype=np.float64), rtol=1e-12)
+    np.testing.assert_allclose(std, np.std(img, axis=0, dtype=np.float64), rtol=1e-9)
+
+
+@pytest.mark.parametrize("block_size", [1, 4, 7, 37, 64])
+@pytest.mark.parametrize("num_threads", [1, 3])
+def test_compute_running_stats(block_size, num_threads):
+    img = random_sequence(37, np.float32)
+    stats = compute_running_stats(
+        lambda start, stop: img[start:stop], len(img), block_size, num_threads
+    )
+    mean, std = stats.mean_std(np.float32)
+    assert mean.dtype == std.dtype == np.float32
+    np.testing.assert_allclose(mean, np.mean(img, axis=0, dtype=np.float64), rtol=1e-6)
+    np.testing.assert_allclose(std, np.std(img, axis=0, dtype=np.float64), rtol=1e-5)
@@ -0,0 +1,64 @@
+import os
+import threading
+import time
+import numpy as np
+import pytest
+from neuroimage_denoiser.utils import patchcache
+from neuroimage_denoiser.utils.h5patches import PatchStore
+from neuroimage_denoiser.utils.patchcache import (
+    PatchCache,
+    lock_cache,
+    remove_patch_cache,
+)
+
+
+@pytest.fixture
+def h5_path(tmp_path):
+    path = str(tmp_path / "patches.h5")
+    patches = np.random.default_rng(0).normal(size=(10, 8, 8)).astype(np.float32)
+    with PatchStore(path, "w") as store:
+        store.append(patches)
+    return path
+
+
+def test_cache_roundtrip(h5_path, tmp_path):
+    cache_dir = str(tmp_path / "missing" / "cache")
+    with PatchStore(h5_path) as store:
+        expected = store.read(0, len(store))
+    cache = PatchCache(h5_path, cache_dir)
+    assert cache.created
+    np.testing.assert_array_equal(cache.read(0, len(cache)), expected)
+    np.testing.assert_array_equal(cache.read_indices([3, 1, 7]), expected[[3, 1, 7]])
+    # a second instance attaches to the existing cache
+    other = PatchCache(h5_path, cache_dir)
+    assert not other.created
+    other.close()
+    cache.remove()
+    assert os.listdir(cache_dir) == []
+    assert not remove_patch_cache(h5_path, cache_dir)
+
+
+@pytest.mark.skipif(patchcache.fcntl is None, reason="file locks require fcntl")
+def test_deleted_lock_file_is_not_shared(tmp_path):
+    path = str(tmp_path / "cache.npy")
+    first = lock_cache(path)
+    waiting_locked = threading.Event()
+
+    def wait_for_lock():
+        with lock_cache(path):
+            waiting_locked.set()
+
+    waiting = threading.Thread(target=wait_for_lock)
+    waiting.start()
+    # give the thread time to block on the old lock file
+    time.sleep(0.2)
+    assert not waiting_locked.is_set()
+    # the lock file is deleted while the thread waits for the old lock file
+    os.remove(f"{path}.lock")
+    first.close()
+    # a new process locks the new lock file, the waiting thread must not get the lock too
+    third = lock_cache(path)
+    assert not waiting_locked.wait(0.5)
+    third.close()
+    assert waiting_locked.wait(10)
+    waiting.join()
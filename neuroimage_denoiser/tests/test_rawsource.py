@@ -0,0 +1,76 @@
+import os
+import numpy as np
+import pytest
+import tifffile
+from neuroimage_denoiser.utils.h5patches import PatchStore
+from neuroimage_denoiser.utils.rawsource import RawPatchSource, evict_recordings
+from neuroimage_denoiser.utils.trainfiles import TrainFiles
+
+SETTINGS = {
+    "min_z_score": 2.0,
+    "crop_size": 16,
+    "roi_size": 4,
+    "window_size": 10,
+    "foreground_background_split": 0.5,
+    "seed": 3,
+}
+
+
+@pytest.fixture
+def recordings(tmp_path):
+    """
+    Directory with two synthetic recordings: noise with bright spots in some frames.
+    """
+    directory = tmp_path / "recordings"
+    directory.mkdir()
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[:40, :56]
+    for name in ["a.tif", "b.tif"]:
+        frames = rng.normal(1000, 30, size=(60, 40, 56))
+        for frame in rng.choice(np.arange(10, 50), 8, replace=False):
+            y, x = rng.integers(4, 36), rng.integers(4, 52)
+            frames[frame] += 800 * np.exp(-((yy - y) ** 2 + (xx - x) ** 2) / 8)
+        tifffile.imwrite(directory / name, frames.astype(np.uint16))
+    return str(directory)
+
+
+def test_patches_equal_prepare_training(recordings, tmp_path):
+    h5_path = str(tmp_path / "patches.h5")
+    trainfiles = TrainFiles(
+        [".tif"],
+        SETTINGS["min_z_score"],
+        SETTINGS["crop_size"],
+        SETTINGS["roi_size"],
+        h5_path,
+        window_size=SETTINGS["window_size"],
+        foreground_background_split=SETTINGS["foreground_background_split"],
+        seed=SETTINGS["seed"],
+    )
+    trainfiles.files_to_traindata(recordings, memory_optimized=True, block_size=16)
+    with PatchStore(h5_path) as store:
+        expected = store.read(0, len(store))
+    with RawPatchSource(
+        recordings, [".tif"], cache_dir=str(tmp_path / "cache"), **SETTINGS
+    ) as source:
+        assert len(source) == len(expected) > 0
+        np.testing.assert_array_equal(source.read(0, len(source)), expected)
+        idxs = np.random.default_rng(1).permutation(len(source))[:20]
+        np.testing.assert_array_equal(source.read_indices(idxs), expected[idxs])
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache_dir = tmp_path / "cache"
+    for i, name in enumerate(["old", "used", "new", "partial"]):
+        directory = cache_dir / name
+        directory.mkdir(parents=True)
+        np.save(directory / "znorm.npy", np.zeros(1000, dtype=np.float32))
+        if name == "partial":
+            # still being written by another process
+            (directory / "rolling.npy.123.tmp").write_bytes(b"0" * 4000)
+        os.utime(directory, ns=(i * 10**9, i * 10**9))
+    # "old" is the least recently used, but "used" is the oldest one in use
+    os.utime(cache_dir / "used", ns=(0, 0))
+    evict_recordings(str(cache_dir), 17000, keep=[str(cache_dir / "used")])
+    assert sorted(os.listdir(cache_dir)) == ["new", "partial", "used"]
+    evict_recordings(str(cache_dir), 0, keep=[str(cache_dir / "used")])
+    assert sorted(os.listdir(cache_dir)) == ["partial", "used"]
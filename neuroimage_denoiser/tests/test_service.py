@@ -0,0 +1,55 @@
+import threading
+import time
+import numpy as np
+import pytest
+from neuroimage_denoiser.model.modelwrapper import ModelWrapper
+from neuroimage_denoiser.model.service import DenoiseService
+
+
+@pytest.fixture
+def tuning_calls(monkeypatch):
+    """
+    Replace the probe passes with a slow fake, which selects batch size 4.
+    """
+    calls = []
+    lock = threading.Lock()
+
+    def fake_tune_batch_size(self, height, width):
+        with lock:
+            calls.append((height, width))
+        time.sleep(0.2)
+        self.batch_size = 4
+
+    monkeypatch.setattr(ModelWrapper, "tune_batch_size", fake_tune_batch_size)
+    return calls
+
+
+def test_batch_size_is_tuned_once_per_shape(weights, tuning_calls):
+    service = DenoiseService(
+        {"weights": weights, "batch_size": "auto", "cpu": True}, num_models=3
+    )
+    try:
+        img = np.random.default_rng(0).integers(0, 1000, (8, 32, 32), dtype=np.uint16)
+        jobs = [service.submit(img) for _ in range(6)]
+        for job in jobs:
+            assert job.done.wait(60)
+            assert job.error is None
+    finally:
+        service.shutdown()
+    assert tuning_calls == [(32, 32)]
+    assert service.batch_sizes == {("cpu", (32, 32)): 4}
+
+
+def test_failed_tuning_fails_jobs_and_keeps_batcher(weights, monkeypatch):
+    def failing_tune_batch_size(self, height, width):
+        raise RuntimeError("probe failed")
+
+    monkeypatch.setattr(ModelWrapper, "tune_batch_size", failing_tune_batch_size)
+    service = DenoiseService({"weights": weights, "batch_size": "auto", "cpu": True})
+    try:
+        img = np.random.default_rng(0).integers(0, 60000, (4, 32, 32), dtype=np.uint16)
+        with pytest.raises(RuntimeError, match="probe failed"):
+            service.denoise(img)
+        assert service.batchers[0].is_alive()
+    finally:
+        service.shutdown()
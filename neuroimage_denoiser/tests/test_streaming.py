@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+import tifffile
+from neuroimage_denoiser.model.modelwrapper import ModelWrapper
+
+
+@pytest.mark.parametrize(
+    "compression",
+    [
+        # memory-mapped
+        None,
+        # read page by page
+        "zlib",
+    ],
+)
+def test_streaming_matches_in_memory(weights, tmp_path, compression):
+    img = np.random.default_rng(0).integers(100, 3000, size=(10, 32, 48))
+    img_path = str(tmp_path / "img.tif")
+    tifffile.imwrite(img_path, img.astype(np.uint16), compression=compression)
+    model = ModelWrapper(weights, batch_size=3, cpu=True)
+    model.denoise_img(img_path)
+    expected = model.denoised_img.astype(np.int64)
+    outpath = str(tmp_path / "denoised.tif")
+    # the last block holds 2 of 4 frames
+    model.denoise_img_streaming(img_path, outpath, block_size=4)
+    streamed = tifffile.imread(outpath)
+    assert streamed.dtype == np.uint16 and streamed.shape == expected.shape
+    # the statistics are computed in blocks, float rounding may flip the last integer
+    np.testing.assert_allclose(streamed.astype(np.int64), expected, atol=1)
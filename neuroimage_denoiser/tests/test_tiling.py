@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from neuroimage_denoiser.model.modelwrapper import ModelWrapper
+
+
+def denoise(weights, img, **kwargs):
+    model = ModelWrapper(weights, batch_size=5, cpu=True, **kwargs)
+    model.denoise_array(img)
+    return model.denoised_img.astype(np.int64)
+
+
+@pytest.mark.parametrize(
+    "shape",
+    [
+        (6, 64, 64),
+        # neither side is divisible by the tile stride (24)
+        (6, 72, 100),
+    ],
+)
+def test_tiled_inference_matches_full_frames(weights, shape):
+    img = np.random.default_rng(0).integers(100, 3000, size=shape, dtype=np.uint16)
+    full = denoise(weights, img)
+    tiled = denoise(weights, img, tile_size=32, tile_overlap=8)
+    # the receptive field of the U-Net is cut at the tile borders
+    difference = np.abs(full - tiled)
+    assert difference.max() <= 6
+    assert difference.mean() <= 0.35
+
+
+def test_frame_smaller_than_tile(weights):
+    img = np.random.default_rng(0).integers(
+        100, 3000, size=(6, 20, 44), dtype=np.uint16
+    )
+    full = denoise(weights, img)
+    # a single tile of the frame size
+    tiled = denoise(weights, img, tile_size=64, tile_overlap=8)
+    np.testing.assert_allclose(tiled, full, atol=1)
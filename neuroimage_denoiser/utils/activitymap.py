@@ -2,50 +2,61 @@ import numpy as np
 from scipy.ndimage import uniform_filter
 
 
-def transform_frame(
-    frame: np.ndarray,
-    cropsize: int,
-    h_activitymap: int,
-    w_activitymap: int,
-    roi_size: int,
-) -> list[float]:
-    activity_map_frame = []
-    mean_frame = uniform_filter(frame, roi_size, mode="constant")
-    for y in range(h_activitymap):
-        start_y = y * cropsize
-        stop_y = (y + 1) * cropsize
-        row = []
-        for x in range(w_activitymap):
-            start_x = x * cropsize
-            stop_x = (x + 1) * cropsize
-
-            row.append(np.max(mean_frame[start_y:stop_y, start_x:stop_x]))
-        activity_map_frame.append(row)
-    return activity_map_frame
-
-
-def compute_activitymap(img: np.ndarray, cropsize: int, roi_size: int) -> np.ndarray:
+def block_max(img: np.ndarray, cropsize: int) -> np.ndarray:
     """
-    Compute the activity map for a sequence of image frames by applying the
-    transform_frame function.
+    Maximum of every non-overlapping cropsize x cropsize block of every frame.
+    Pixels at the right and bottom border that do not fill a complete block are ignored.
+
+    Parameters:
+    - img (np.ndarray): Image sequence as a 3D NumPy array (frames, height, width).
+    - cropsize (int): Size of the blocks.
+
+    Returns:
+    - np.ndarray: Block maxima (frames, height // cropsize, width // cropsize).
+    """
+    num_frames = img.shape[0]
+    h_activitymap = img.shape[1] // cropsize
+    w_activitymap = img.shape[2] // cropsize
+    blocks = img[:, : h_activitymap * cropsize, : w_activitymap * cropsize].reshape(
+        num_frames, h_activitymap, cropsize, w_activitymap, cropsize
+    )
+    return blocks.max(axis=(2, 4))
+
+
+def compute_activitymap(
+    img: np.ndarray, cropsize: int, roi_size: int, chunk_size: int = 64
+) -> np.ndarray:
+    """
+    Compute the activity map for a sequence of image frames. Every frame is smoothed
+    with a roi_size x roi_size mean filter (zero padded) and the maximum of every
+    cropsize x cropsize block is taken.
+
+    The frames are processed in chunks of chunk_size frames, every chunk is filtered
+    in a single call and reduced with a reshape, so only one chunk has to be held in
+    memory (img may be a memmap).
 
     Parameters:
     - img (np.ndarray): Input image sequence as a 3D NumPy array.
     - cropsize: Size of the kernel used for patch extraction (image size on that is trained).
     - roi_size: Size of the sliding window (Region of Interest).
+    - chunk_size: Number of frames processed at once (default: 64).
 
     Returns:
-    - np.ndarray: Activity map for the input image sequence.
+    - np.ndarray: Activity map for the input image sequence (frames, height // cropsize, width // cropsize).
     """
-    h_activitymap = img.shape[1] // cropsize
-    w_activitymap = img.shape[2] // cropsize
-    activitymap = []
-    for frame_idx in range(img.shape[0]):
-        frame = img[frame_idx]
-        activitymap.append(
-            transform_frame(frame, cropsize, h_activitymap, w_activitymap, roi_size)
+    activitymap = np.empty(
+        (img.shape[0], img.shape[1] // cropsize, img.shape[2] // cropsize),
+        dtype=img.dtype,
+    )
+    for start in range(0, img.shape[0], chunk_size):
+        # the filter is not applied along the frame axis (size 1)
+        mean_chunk = uniform_filter(
+            np.asarray(img[start : start + chunk_size]),
+            size=(1, roi_size, roi_size),
+            mode="constant",
         )
-    return np.array(activitymap)
+        activitymap[start : start + chunk_size] = block_max(mean_chunk, cropsize)
+    return activitymap
 
 
 def get_frames_position(
@@ -54,6 +65,7 @@ def get_frames_position(
     cropsize: int = 32,
     roi_size: int = 4,
     foreground_background_split: float = 0.5,
+    seed: int | np.random.Generator | None = None,
 ) -> list[list[int]]:
     """
     Identify positions of frames based on the computed activity map and a minimum Z-score threshold.
@@ -64,23 +76,107 @@ def get_frames_position(
     - cropsize (int): Size of the kernel used for patch extraction.
     - roi_size (int): Size of the sliding window (Region of Interest).
     - foreground_background_split (float): Split ratio between foreground and background.
+    - seed (int | np.random.Generator | None): Seed or random generator for the background sampling (default: None, random).
 
     Returns:
     - list[list[int]]: List of frame positions, each represented as [frame_index, y_position, x_position].
     """
-    frames_w_pos = []
     activitymap = compute_activitymap(img, cropsize, roi_size)
-    above_z = np.argwhere(activitymap > min_z_score)
-    for example in above_z:
-        frame, y, x = example
-        frames_w_pos.append([int(frame), int(y * cropsize), int(x * cropsize)])
+    return get_positions_from_activitymap(
+        activitymap, min_z_score, cropsize, foreground_background_split, seed
+    )
+
+
+def sample_background(
+    activitymap: np.ndarray,
+    min_z_score: float,
+    num_samples: int,
+    rng: np.random.Generator,
+    chunk_size: int = 64,
+) -> np.ndarray:
+    """
+    Uniformly sample cells of the activity map at or below the minimum Z-score, without replacement.
+
+    The number of background cells is counted chunk by chunk, the samples are
+    distributed over the chunks with a multivariate hypergeometric draw and then
+    drawn within every chunk. Only the coordinates of one chunk and of the
+    selected cells are held in memory, not the coordinates of all background cells.
+
+    Parameters:
+    - activitymap (np.ndarray): Activity map (see compute_activitymap).
+    - min_z_score (float): Minimum Z-score threshold.
+    - num_samples (int): Number of cells to sample, limited to the number of background cells.
+    - rng (np.random.Generator): Random generator.
+    - chunk_size (int): Number of frames processed at once (default: 64).
+
+    Returns:
+    - np.ndarray: Coordinates [frame, y, x] of the sampled cells in random order (num_samples, 3).
+    """
+    starts = range(0, activitymap.shape[0], chunk_size)
+    counts = np.array(
+        [
+            np.count_nonzero(activitymap[start : start + chunk_size] <= min_z_score)
+            for start in starts
+        ],
+        dtype=np.int64,
+    )
+    num_samples = min(num_samples, int(counts.sum()))
+    samples = []
+    if num_samples > 0:
+        per_chunk = rng.multivariate_hypergeometric(counts, num_samples)
+        for start, num_chunk_samples in zip(starts, per_chunk):
+            if num_chunk_samples == 0:
+                continue
+            below_z = np.argwhere(
+                activitymap[start : start + chunk_size] <= min_z_score
+            )
+            selected = below_z[
+                rng.choice(len(below_z), num_chunk_samples, replace=False)
+            ]
+            selected[:, 0] += start
+            samples.append(selected)
+    if len(samples) == 0:
+        return np.empty((0, 3), dtype=np.int64)
+    return rng.permutation(np.concatenate(samples))
+
+
+def get_positions_from_activitymap(
+    activitymap: np.ndarray,
+    min_z_score: float,
+    cropsize: int = 32,
+    foreground_background_split: float = 0.5,
+    seed: int | np.random.Generator | None = None,
+    chunk_size: int = 64,
+) -> list[list[int]]:
+    """
+    Select the positions of foreground patches (above the minimum Z-score) and a random
+    subset of background patches from an activity map.
+
+    Parameters:
+    - activitymap (np.ndarray): Activity map (see compute_activitymap).
+    - min_z_score (float): Minimum Z-score threshold for identifying frames.
+    - cropsize (int): Size of the kernel used for patch extraction.
+    - foreground_background_split (float): Split ratio between foreground and background.
+    - seed (int | np.random.Generator | None): Seed or random generator for the background sampling (default: None, random).
+    - chunk_size (int): Number of frames of the activity map processed at once (default: 64).
+
+    Returns:
+    - list[list[int]]: List of frame positions, each represented as [frame_index, y_position, x_position].
+    """
+    rng = np.random.default_rng(seed)
+    frames_w_pos = []
+    for start in range(0, activitymap.shape[0], chunk_size):
+        above_z = np.argwhere(activitymap[start : start + chunk_size] > min_z_score)
+        for example in above_z:
+            frame, y, x = example
+            frames_w_pos.append(
+                [int(frame + start), int(y * cropsize), int(x * cropsize)]
+            )
     bg_images_to_select = (1 / foreground_background_split - 1) * len(frames_w_pos)
-    below_z = np.argwhere(activitymap <= min_z_score)
-    np.random.shuffle(below_z)
-    for i, example in enumerate(below_z):
-        if i > bg_images_to_select:
-            break
+    below_z = sample_background(
+        activitymap, min_z_score, int(bg_images_to_select) + 1, rng, chunk_size
+    )
+    for example in below_z:
         frame, y, x = example
         frames_w_pos.append([int(frame), int(y * cropsize), int(x * cropsize)])
     return frames_w_pos
-
@@ -0,0 +1,148 @@
+import os
+from typing import Callable
+import numpy as np
+
+DEFAULT_ACTIVITYMAP_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "neuroimage_denoiser", "activitymaps"
+)
+
+
+class ActivityMapCache:
+    """
+    On-disk cache of activity maps, keyed by the content hash of the recording and
+    the parameters of the activity map (window_size, crop_size, roi_size, dtype).
+
+    Re-running prepare_training with another min_z_score or foreground_background_split
+    only thresholds the cached activity maps again, without the rolling window
+    z-normalization. Every activity map is a .npy file, written under a temporary name
+    and renamed when complete, so several processes can share the cache. The total
+    size is bounded: after an activity map is stored, the least recently used maps
+    (by modification time, which is updated on every hit) are deleted until the cache
+    fits into max_bytes.
+
+    Attributes:
+        cache_dir (str): Directory of the cache.
+        max_bytes (int): Maximal total size of the cached activity maps in bytes.
+    """
+
+    def __init__(self, cache_dir: str | None = None, max_bytes: int = 2**30) -> None:
+        """
+        Open the cache directory, create it if it does not exist.
+
+        Args:
+            cache_dir (str | None): Directory of the cache (default: ~/.cache/neuroimage_denoiser/activitymaps).
+            max_bytes (int): Maximal total size of the cached activity maps in bytes (default: 1 GiB).
+        """
+        if cache_dir is None:
+            cache_dir = DEFAULT_ACTIVITYMAP_CACHE_DIR
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(
+        self,
+        file_key: str,
+        window_size: int,
+        crop_size: int,
+        roi_size: int,
+        dtype: np.dtype | str,
+    ) -> str:
+        """
+        Path of a cached activity map.
+
+        Args:
+            file_key (str): Content hash of the recording (see file_hash).
+            window_size (int): Size of the rolling window.
+            crop_size (int): Size of the patches.
+            roi_size (int): Size of the sliding window (Region of Interest).
+            dtype (np.dtype | str): Floating point type of the normalization.
+
+        Returns:
+            str: Path of the .npy file.
+        """
+        return os.path.join(
+            self.cache_dir,
+            f"{file_key}_window{window_size}_crop{crop_size}_roi{roi_size}_{np.dtype(dtype).name}.npy",
+        )
+
+    def get(self, path: str) -> np.ndarray | None:
+        """
+        Load a cached activity map and mark it as recently used.
+
+        Args:
+            path (str): Path of the activity map (see path).
+
+        Returns:
+            np.ndarray | None: Activity map, None if it is not cached.
+        """
+        try:
+            activitymap = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            # not cached, or deleted by another process in the meantime
+            return None
+        return activitymap
+
+    def put(self, path: str, activitymap: np.ndarray) -> None:
+        """
+        Store an activity map and evict the least recently used maps. Activity maps
+        larger than the cache are not stored.
+
+        Args:
+            path (str): Path of the activity map (see path).
+            activitymap (np.ndarray): Activity map.
+        """
+        if activitymap.nbytes > self.max_bytes:
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, activitymap)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def get_or_compute(
+        self, path: str, compute: Callable[[], np.ndarray]
+    ) -> np.ndarray:
+        """
+        Load a cached activity map, or compute and store it if it is not cached.
+
+        Args:
+            path (str): Path of the activity map (see path).
+            compute (Callable[[], np.ndarray]): Computes the activity map.
+
+        Returns:
+            np.ndarray: Activity map.
+        """
+        activitymap = self.get(path)
+        if activitymap is None:
+            activitymap = compute()
+            self.put(path, activitymap)
+        return activitymap
+
+    def evict(self) -> None:
+        """
+        Delete the least recently used activity maps until the cache fits into max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
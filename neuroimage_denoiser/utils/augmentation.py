@@ -0,0 +1,152 @@
+import torch
+import torch.nn.functional as F
+
+
+def gaussian_kernel1d(
+    sigma: float,
+    truncate: float = 4.0,
+    dtype: torch.dtype = torch.float32,
+    device: torch.device | str = "cpu",
+) -> torch.Tensor:
+    """
+    Normalized 1D Gaussian kernel, identical to the kernel of scipy.ndimage.gaussian_filter.
+
+    Parameters:
+    - sigma (float): Standard deviation of the Gaussian.
+    - truncate (float): Truncate the kernel at this many standard deviations (default: 4.0).
+    - dtype (torch.dtype): Floating point type of the kernel (default: float32).
+    - device (torch.device | str): Device of the kernel (default: cpu).
+
+    Returns:
+    - torch.Tensor: Kernel of length 2 * int(truncate * sigma + 0.5) + 1.
+    """
+    radius = int(truncate * float(sigma) + 0.5)
+    x = torch.arange(-radius, radius + 1, dtype=torch.float64)
+    kernel = torch.exp(-0.5 / float(sigma) ** 2 * x**2)
+    kernel = kernel / kernel.sum()
+    return kernel.to(dtype=dtype, device=device)
+
+
+def reflect_pad(x: torch.Tensor, dim: int, radius: int) -> torch.Tensor:
+    """
+    Pad a tensor along one dimension by reflecting about the edge of the last pixel
+    (d c b a | a b c d | d c b a), like the 'reflect' mode of scipy.ndimage.
+    The padding may be larger than the dimension.
+
+    Parameters:
+    - x (torch.Tensor): Input tensor.
+    - dim (int): Dimension to pad.
+    - radius (int): Number of padded values on both sides.
+
+    Returns:
+    - torch.Tensor: Padded tensor.
+    """
+    size = x.shape[dim]
+    idxs = torch.arange(-radius, size + radius, device=x.device) % (2 * size)
+    idxs = torch.where(idxs < size, idxs, 2 * size - 1 - idxs)
+    return x.index_select(dim, idxs)
+
+
+def gaussian_blur(x: torch.Tensor, sigma: float, truncate: float = 4.0) -> torch.Tensor:
+    """
+    Blur every image of a batch with a separable Gaussian filter.
+
+    The result equals scipy.ndimage.gaussian_filter(x, (0, 0, sigma, sigma)) with the
+    default 'reflect' mode, up to floating point rounding.
+
+    Parameters:
+    - x (torch.Tensor): Batch of images (batch, 1, height, width).
+    - sigma (float): Standard deviation of the Gaussian.
+    - truncate (float): Truncate the kernel at this many standard deviations (default: 4.0).
+
+    Returns:
+    - torch.Tensor: Blurred images (batch, 1, height, width).
+    """
+    kernel = gaussian_kernel1d(sigma, truncate, x.dtype, x.device)
+    radius = (len(kernel) - 1) // 2
+    x = F.conv2d(reflect_pad(x, 2, radius), kernel.view(1, 1, -1, 1))
+    return F.conv2d(reflect_pad(x, 3, radius), kernel.view(1, 1, 1, -1))
+
+
+class BatchAugmentation:
+    """
+    Training augmentation of whole batches on the training device: Gaussian noise
+    is added to the inputs and the targets are optionally blurred with a Gaussian.
+
+    The noise is drawn from a torch.Generator on the device of the batch, seeded
+    with seed when it is first used, so the noise is reproducible per device.
+
+    Attributes:
+        noise_center (float): Center of the noise distribution.
+        noise_scale (float): Scale of the noise distribution.
+        apply_gausian_filter (bool): Whether the targets are blurred.
+        sigma_gausian_filter (float): Sigma of the gaussian filter.
+        seed (int | None): Seed of the noise generators (None: random).
+    """
+
+    def __init__(
+        self,
+        noise_center: float = 0,
+        noise_scale: float = 1.5,
+        apply_gausian_filter: bool = False,
+        sigma_gausian_filter: float = 1.0,
+        seed: int | None = 42,
+    ) -> None:
+        """
+        Initialize the augmentation.
+
+        Args:
+            noise_center (float, optional): Center of the noise distribution. Default is 0.
+            noise_scale (float, optional): Scale of the noise distribution. Default is 1.5.
+            apply_gausian_filter (bool, optional): Apply a gaussian filter to the targets. Default is False.
+            sigma_gausian_filter (float, optional): Sigma of the gaussian filter. Default is 1.0.
+            seed (int | None, optional): Seed of the noise generators (None: random). Default is 42.
+        """
+        self.noise_center = noise_center
+        self.noise_scale = noise_scale
+        self.apply_gausian_filter = apply_gausian_filter
+        self.sigma_gausian_filter = sigma_gausian_filter
+        self.seed = seed
+        self.generators = {}
+
+    def generator(self, device: torch.device) -> torch.Generator:
+        """
+        Noise generator of a device, created and seeded on first use.
+
+        Args:
+            device (torch.device): Device of the batch.
+
+        Returns:
+            torch.Generator: Generator on the device.
+        """
+        if device not in self.generators:
+            generator = torch.Generator(device=device)
+            if self.seed is None:
+                generator.seed()
+            else:
+                generator.manual_seed(self.seed)
+            self.generators[device] = generator
+        return self.generators[device]
+
+    def __call__(self, clean: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Create the noisy inputs and the targets of a batch of clean patches.
+
+        Args:
+            clean (torch.Tensor): Clean patches (batch, 1, crop_size, crop_size).
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: Noisy inputs and targets, on the device of clean.
+        """
+        noise = torch.randn(
+            clean.shape,
+            generator=self.generator(clean.device),
+            dtype=clean.dtype,
+            device=clean.device,
+        )
+        X = clean + (noise * self.noise_scale + self.noise_center)
+        if self.apply_gausian_filter:
+            y = gaussian_blur(clean, self.sigma_gausian_filter)
+        else:
+            y = clean
+        return X, y
@@ -1,36 +1,36 @@
 import numpy as np
 
 
-def uint_to_float(img: np.ndarray) -> np.ndarray:
+def uint_to_float(img: np.ndarray, dtype: np.dtype = np.float32) -> np.ndarray:
     """
-    Convert an input array of unsigned integers to float64.
+    Convert an input array of unsigned integers to floats.
 
     Parameters:
     - img (np.ndarray): Input array containing unsigned integers.
+    - dtype (np.dtype): Floating point type of the output (default: float32).
 
     Returns:
-    - np.ndarray: Output array with values converted to float64.
+    - np.ndarray: Output array with values converted to dtype.
     """
-    return img.astype(np.float64)
+    return img.astype(dtype)
 
 
-def float_to_uint(img: np.ndarray) -> np.ndarray:
+def float_to_uint(img: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
     """
     Convert an input array of floats to unsigned integers (uint16),
-    handling underflows and overflows.
+    handling underflows and overflows. The input array is clipped in place.
 
     Parameters:
-    - img (np.ndarray): Input array containing float64 values.
+    - img (np.ndarray): Input array containing float values.
+    - out (np.ndarray[np.uint16], optional): Preallocated output array with the
+      same shape as img. If None, a new array is allocated.
 
     Returns:
     - np.ndarray: Output array with values converted to uint16.
     """
-    # handle underflows
-    frames, y_coords, x_coords = np.where(img < 0)
-    for frame, y, x in zip(frames, y_coords, x_coords):
-        img[frame, y, x] = 0.0
-    # handle overflows
-    frames, y_coords, x_coords = np.where(img > 65535)
-    for frame, y, x in zip(frames, y_coords, x_coords):
-        img[frame, y, x] = 65535.0
-    return img.astype(np.uint16)
+    # handle underflows and overflows
+    np.clip(img, 0.0, 65535.0, out=img)
+    if out is None:
+        return img.astype(np.uint16)
+    np.copyto(out, img, casting="unsafe")
+    return out
@@ -1,43 +1,72 @@
+import queue
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
-import h5py
 from scipy.ndimage import gaussian_filter
+from neuroimage_denoiser.utils.h5patches import PatchStore
+from neuroimage_denoiser.utils.patchcache import PatchCache
+from neuroimage_denoiser.utils.rawsource import RawPatchSource
 
 
 class DataLoader:
     def __init__(
         self,
-        train_h5: str,
+        train_h5: str | None,
         batch_size: int,
         noise_center: float = 0,
         noise_scale: float = 1.5,
         apply_gausian_filter: bool = False,
         sigma_gausian_filter: float = 1.0,
+        dtype: np.dtype | str = np.float32,
+        augment: bool = True,
+        cache_dir: str | None = None,
+        patches: RawPatchSource | None = None,
     ):
         """
         Initialize the dataset with HDF5 file, batch size, and optional noise parameters.
 
         Args:
-            train_h5 (str): Path to the HDF5 file containing training samples.
+            train_h5 (str | None): Path to the HDF5 file containing training samples (None with patches).
             batch_size (int): Number of samples in each batch.
             noise_center (float, optional): Center of the noise distribution. Default is 0.
             noise_scale (float, optional): Scale of the noise distribution. Default is 1.5.
+            apply_gausian_filter (bool, optional): Apply a gaussian filter to the targets. Default is False.
+            sigma_gausian_filter (float, optional): Sigma of the gaussian filter. Default is 1.0.
+            dtype (np.dtype | str, optional): Floating point type used for the patches and the noise.
+                Default is float32.
+            augment (bool, optional): Add the noise and filter the targets. If False, X and y are
+                the clean patches, to be augmented on the training device (see BatchAugmentation).
+                Default is True.
+            cache_dir (str | None, optional): Read the patches from a shared in-RAM cache in this
+                directory (see PatchCache), created if it does not exist. Default is None, read the H5 file.
+            patches (RawPatchSource | None, optional): Read the patches from this source instead of
+                train_h5 (e.g. cropped from raw recordings). It is not closed by the data loader.
+                Default is None.
         """
         np.random.seed(42)
-        self.h5_file = h5py.File(train_h5, "r")
-        self.train_samples = list(self.h5_file.keys())
+        # a given patch source is shared and closed by its owner
+        self.owns_patches = patches is None
+        if patches is not None:
+            self.patches = patches
+        elif cache_dir is None:
+            self.patches = PatchStore(train_h5)
+        else:
+            self.patches = PatchCache(train_h5, cache_dir)
+        self.num_samples = len(self.patches)
         self.batch_size = batch_size
         self.noise_center = noise_center
         self.noise_scale = noise_scale
         self.apply_gausian_filter = apply_gausian_filter
         self.sigma_gausian_filter = sigma_gausian_filter
+        self.dtype = np.dtype(dtype)
+        self.augment = augment
         self.epoch_done = False
         print(
-            f"Found {len(self.train_samples)} samples to train. \n Batch size is {self.batch_size} -> {len(self.train_samples)//self.batch_size} iterations per epoch."
+            f"Found {self.num_samples} samples to train. \n Batch size is {self.batch_size} -> {self.num_samples//self.batch_size} iterations per epoch."
         )
         self.shuffle_array()
-        self.X_list = []
-        self.y_list = []
 
     def __len__(self) -> int:
         """
@@ -46,18 +75,16 @@ class DataLoader:
         Returns:
             int: Number of train samples in the dataset.
         """
-        return len(self.train_samples) // self.batch_size
+        return self.num_samples // self.batch_size
 
     def shuffle_array(self) -> None:
         """
         Shuffle the training examples for a new epoch.
         """
         self.epoch_done = False
-        random_order = np.arange(len(self.train_samples))
+        random_order = np.arange(self.num_samples)
         np.random.shuffle(random_order)
-        self.available_train_examples = [
-            self.train_samples[idx] for idx in random_order
-        ]
+        self.available_train_examples = random_order
 
     def add_gausian_noise(self, arr: np.ndarray) -> np.ndarray:
         """
@@ -70,36 +97,349 @@ class DataLoader:
         - arr (np.ndarray): array with added noise
         """
         noise = np.random.normal(self.noise_center, self.noise_scale, size=arr.shape)
-        return np.add(arr, noise)
+        return np.add(arr, noise, dtype=self.dtype)
 
     def get_batch(self) -> bool:
         """
-        Get a batch of training examples.
+        Get a batch of training examples. The patches of a batch are read with a single
+        (sorted) H5 read.
 
         Returns:
         - True if a batch is successfully created, False if the epoch is done.
         """
-        self.X_list = []
-        self.y_list = []
-        for _ in range(self.batch_size):
-            if len(self.available_train_examples) == 0:
-                # Check if available_train_examples is empty, indicating the end of the epoch
-                self.epoch_done = True
-                return False
-            h5_idx = self.available_train_examples.pop(0)
-            y_tmp = np.array(self.h5_file.get(h5_idx))
-            self.X_list.append(
-                self.add_gausian_noise(y_tmp.copy()).reshape(
-                    1, y_tmp.shape[0], y_tmp.shape[1]
+        if len(self.available_train_examples) < self.batch_size:
+            # not enough examples left for a full batch, indicating the end of the epoch
+            self.epoch_done = True
+            return False
+        h5_idxs = self.available_train_examples[: self.batch_size]
+        self.available_train_examples = self.available_train_examples[self.batch_size :]
+        y = self.patches.read_indices(h5_idxs).astype(self.dtype, copy=False)
+        if not self.augment:
+            self.y = torch.from_numpy(y[:, np.newaxis].astype(np.float32))
+            self.X = self.y
+            return True
+        X = self.add_gausian_noise(y)
+        if self.apply_gausian_filter:
+            # filter every patch, not along the batch axis
+            y = gaussian_filter(
+                y, (0, self.sigma_gausian_filter, self.sigma_gausian_filter)
+            )
+        # the model is trained in float32, with a channel axis
+        self.X = torch.from_numpy(X[:, np.newaxis].astype(np.float32))
+        self.y = torch.from_numpy(y[:, np.newaxis].astype(np.float32))
+        return True
+
+    def close(self) -> None:
+        """
+        Close the H5 file (or detach from the patch cache).
+        """
+        if self.owns_patches:
+            self.patches.close()
+
+
+class PrefetchDataLoader(DataLoader):
+    """
+    Training data loader that prepares the batches on background threads.
+
+    The epoch order is a shuffled index array. The patches of every batch are read
+    in ascending order in contiguous runs (see PatchStore.read_runs), noise is added
+    in the floating point type of the patches and the batch is written into one of
+    a few reusable (pinned, if CUDA is available) tensors. Up to prefetch_batches
+    batches are prepared ahead, so the model does not wait for the H5 file.
+
+    The noise of every batch is drawn from its own generator, derived from the seed,
+    the epoch and the batch index; the batches do not depend on the number of workers.
+
+    Attributes:
+        X (torch.Tensor): Noisy input patches of the current batch (batch_size, 1, crop_size, crop_size).
+        y (torch.Tensor): Target patches of the current batch (batch_size, 1, crop_size, crop_size).
+        epoch_done (bool): Whether all full batches of the epoch were returned.
+        data_wait_time (float): Seconds get_batch waited for batches in the current epoch.
+        compute_time (float): Seconds between the calls of get_batch in the current epoch.
+    """
+
+    def __init__(
+        self,
+        train_h5: str | None,
+        batch_size: int,
+        noise_center: float = 0,
+        noise_scale: float = 1.5,
+        apply_gausian_filter: bool = False,
+        sigma_gausian_filter: float = 1.0,
+        dtype: np.dtype | str = np.float32,
+        augment: bool = True,
+        cache_dir: str | None = None,
+        patches: RawPatchSource | None = None,
+        num_workers: int = 2,
+        prefetch_batches: int = 4,
+        seed: int = 42,
+    ):
+        """
+        Initialize the data loader and start prefetching the first epoch.
+
+        Args:
+            train_h5 (str | None): Path to the HDF5 file containing training samples (None with patches).
+            batch_size (int): Number of samples in each batch.
+            noise_center (float, optional): Center of the noise distribution. Default is 0.
+            noise_scale (float, optional): Scale of the noise distribution. Default is 1.5.
+            apply_gausian_filter (bool, optional): Apply a gaussian filter to the targets. Default is False.
+            sigma_gausian_filter (float, optional): Sigma of the gaussian filter. Default is 1.0.
+            dtype (np.dtype | str, optional): Floating point type used for the patches and the noise.
+                Default is float32.
+            augment (bool, optional): Add the noise and filter the targets. If False, X and y are
+                the clean patches, to be augmented on the training device (see BatchAugmentation).
+                Default is True.
+            cache_dir (str | None, optional): Read the patches from a shared in-RAM cache in this
+                directory (see PatchCache), created if it does not exist. Default is None, read the H5 file.
+            patches (RawPatchSource | None, optional): Read the patches from this source instead of
+                train_h5 (e.g. cropped from raw recordings). It is not closed by the data loader.
+                Default is None.
+            num_workers (int, optional): Number of threads preparing batches. Default is 2.
+            prefetch_batches (int, optional): Number of batches prepared ahead. Default is 4.
+            seed (int, optional): Seed of the shuffling and the noise. Default is 42.
+        """
+        if num_workers < 1 or prefetch_batches < 1:
+            raise ValueError("num_workers and prefetch_batches have to be at least 1.")
+        self.prefetch_batches = prefetch_batches
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.epoch = -1
+        self.free_buffers = None
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.pending = deque()
+        self.current_buffers = None
+        # opens the patches and starts the first epoch (see shuffle_array)
+        super().__init__(
+            train_h5,
+            batch_size,
+            noise_center,
+            noise_scale,
+            apply_gausian_filter,
+            sigma_gausian_filter,
+            dtype=dtype,
+            augment=augment,
+            cache_dir=cache_dir,
+            patches=patches,
+        )
+
+    def allocate_buffers(self) -> None:
+        """
+        Allocate the reusable (pinned, if CUDA is available) batch tensors.
+        """
+        crop_size = self.patches.read(0, 1).shape[-1] if self.num_samples > 0 else 0
+        shape = (self.batch_size, 1, crop_size, crop_size)
+        pin_memory = torch.cuda.is_available()
+        # one buffer more than batches in flight: the current batch is in use by the model
+        self.free_buffers = queue.Queue()
+        for _ in range(self.prefetch_batches + 1):
+            self.free_buffers.put(
+                (
+                    torch.empty(shape, dtype=torch.float32, pin_memory=pin_memory),
+                    torch.empty(shape, dtype=torch.float32, pin_memory=pin_memory),
                 )
             )
+
+    def shuffle_array(self) -> None:
+        """
+        Shuffle the training examples for a new epoch and start prefetching its batches.
+        """
+        if self.free_buffers is None:
+            self.allocate_buffers()
+        self.cancel_pending()
+        self.epoch += 1
+        self.epoch_done = False
+        self.available_train_examples = self.rng.permutation(self.num_samples)
+        self.next_batch = 0
+        self.data_wait_time = 0.0
+        self.compute_time = 0.0
+        self.last_batch_time = None
+        while len(self.pending) < self.prefetch_batches and self.submit_next_batch():
+            pass
+
+    def submit_next_batch(self) -> bool:
+        """
+        Submit the preparation of the next batch of the epoch to the workers.
+
+        Returns:
+            bool: False if all full batches of the epoch are submitted.
+        """
+        if self.next_batch >= len(self):
+            return False
+        start = self.next_batch * self.batch_size
+        h5_idxs = self.available_train_examples[start : start + self.batch_size]
+        self.pending.append(
+            self.executor.submit(
+                self.prepare_batch, h5_idxs, self.epoch, self.next_batch
+            )
+        )
+        self.next_batch += 1
+        return True
+
+    def prepare_batch(
+        self, h5_idxs: np.ndarray, epoch: int, batch: int
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Read a batch, add noise and write it into free buffers (runs on a worker thread).
+
+        Args:
+            h5_idxs (np.ndarray[int]): Indices of the patches of the batch.
+            epoch (int): Index of the epoch.
+            batch (int): Index of the batch in the epoch.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: Noisy inputs and targets.
+        """
+        X_buffer, y_buffer = self.free_buffers.get()
+        try:
+            y = self.patches.read_indices(h5_idxs).astype(self.dtype, copy=False)
+            if not self.augment:
+                y_buffer.numpy()[:, 0] = y
+                return X_buffer, y_buffer
+            rng = np.random.default_rng([self.seed, epoch, batch])
+            noise = rng.standard_normal(size=y.shape, dtype=self.dtype)
+            X = noise * self.dtype.type(self.noise_scale) + (
+                self.dtype.type(self.noise_center) + y
+            )
             if self.apply_gausian_filter:
-                y_tmp = gaussian_filter(y_tmp, self.sigma_gausian_filter)
-            y_tmp = y_tmp.reshape(1, y_tmp.shape[0], y_tmp.shape[1])
-            self.y_list.append(y_tmp)
-
-        self.X = torch.tensor(np.array(self.X_list), dtype=torch.float)
-        self.X_list = []
-        self.y = torch.tensor(np.array(self.y_list), dtype=torch.float)
-        self.y_list = []
+                # filter every patch, not along the batch axis
+                y = gaussian_filter(
+                    y, (0, self.sigma_gausian_filter, self.sigma_gausian_filter)
+                )
+            X_buffer.numpy()[:, 0] = X
+            y_buffer.numpy()[:, 0] = y
+        except BaseException:
+            self.free_buffers.put((X_buffer, y_buffer))
+            raise
+        return X_buffer, y_buffer
+
+    def release_current(self) -> None:
+        """
+        Return the buffers of the current batch for reuse.
+        """
+        if self.current_buffers is not None:
+            self.free_buffers.put(self.current_buffers)
+            self.current_buffers = None
+
+    def cancel_pending(self) -> None:
+        """
+        Discard the batches in flight and return their buffers.
+        """
+        self.release_current()
+        while self.pending:
+            future = self.pending.popleft()
+            if future.cancel():
+                continue
+            try:
+                self.free_buffers.put(future.result())
+            except Exception:
+                pass
+
+    def get_batch(self) -> bool:
+        """
+        Get the next prefetched batch of training examples. The tensors X and y stay
+        valid until the next call of get_batch or shuffle_array.
+
+        Returns:
+        - True if a batch is successfully created, False if the epoch is done.
+        """
+        start = time.perf_counter()
+        if self.last_batch_time is not None:
+            self.compute_time += start - self.last_batch_time
+        self.release_current()
+        if not self.pending:
+            self.epoch_done = True
+            self.last_batch_time = None
+            self.print_timing()
+            return False
+        future = self.pending.popleft()
+        self.current_buffers = future.result()
+        self.X, self.y = self.current_buffers
+        if not self.augment:
+            self.X = self.y
+        self.submit_next_batch()
+        self.last_batch_time = time.perf_counter()
+        self.data_wait_time += self.last_batch_time - start
         return True
+
+    def print_timing(self) -> None:
+        """
+        Print the time spent waiting for data and the time spent in between (training) in the epoch.
+        """
+        total = self.data_wait_time + self.compute_time
+        if total == 0:
+            return
+        print(
+            f"Epoch {self.epoch + 1}: waited {self.data_wait_time:.2f}s for data, computed {self.compute_time:.2f}s ({100 * self.data_wait_time / total:.1f}% waiting)."
+        )
+
+    def close(self) -> None:
+        """
+        Stop the workers and close the H5 file (or detach from the patch cache).
+        """
+        self.cancel_pending()
+        self.executor.shutdown(wait=True)
+        super().close()
+
+
+def create_dataloader(
+    train_h5: str | None,
+    batch_size: int,
+    noise_center: float = 0,
+    noise_scale: float = 1.5,
+    apply_gausian_filter: bool = False,
+    sigma_gausian_filter: float = 1.0,
+    dtype: np.dtype | str = np.float32,
+    augment: bool = True,
+    cache_dir: str | None = None,
+    patches: RawPatchSource | None = None,
+    num_workers: int = 0,
+    prefetch_batches: int = 4,
+) -> DataLoader | PrefetchDataLoader:
+    """
+    Create the training data loader: a DataLoader for num_workers = 0, otherwise a
+    PrefetchDataLoader with num_workers threads.
+
+    Parameters:
+    - train_h5 (str | None): Path to the HDF5 file containing training samples (None with patches).
+    - batch_size (int): Number of samples in each batch.
+    - noise_center (float): Center of the noise distribution.
+    - noise_scale (float): Scale of the noise distribution.
+    - apply_gausian_filter (bool): Apply a gaussian filter to the targets.
+    - sigma_gausian_filter (float): Sigma of the gaussian filter.
+    - dtype (np.dtype | str): Floating point type used for the patches and the noise.
+    - augment (bool): Add the noise and filter the targets in the data loader (default: True).
+    - cache_dir (str | None): Directory of the shared patch cache (default: None, no cache).
+    - patches (RawPatchSource | None): Patch source used instead of train_h5 (default: None).
+    - num_workers (int): Number of threads preparing batches (default: 0, no prefetching).
+    - prefetch_batches (int): Number of batches prepared ahead (default: 4).
+
+    Returns:
+    - DataLoader | PrefetchDataLoader: Data loader for train().
+    """
+    if num_workers == 0:
+        return DataLoader(
+            train_h5,
+            batch_size,
+            noise_center,
+            noise_scale,
+            apply_gausian_filter,
+            sigma_gausian_filter,
+            dtype=dtype,
+            augment=augment,
+            cache_dir=cache_dir,
+            patches=patches,
+        )
+    return PrefetchDataLoader(
+        train_h5,
+        batch_size,
+        noise_center,
+        noise_scale,
+        apply_gausian_filter,
+        sigma_gausian_filter,
+        dtype=dtype,
+        augment=augment,
+        cache_dir=cache_dir,
+        patches=patches,
+        num_workers=num_workers,
+        prefetch_batches=prefetch_batches,
+    )
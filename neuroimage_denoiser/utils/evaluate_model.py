@@ -101,11 +101,22 @@ def evaluate(
     stimulation_frames: list[int],
     response_patience: int,
     result_raw: dict,
+    quantized: bool = False,
 ) -> dict:
-    use_cpu = not torch.cuda.is_available()
+    # quantized models run on the CPU only
+    use_cpu = quantized or not torch.cuda.is_available()
     stimulation_frames = sorted(stimulation_frames)
     # denoise image
-    inference(img_path, modelpath, False, tmppath, batch_size, use_cpu, False)
+    inference(
+        img_path,
+        modelpath,
+        False,
+        tmppath,
+        batch_size,
+        use_cpu,
+        False,
+        quantized=quantized,
+    )
     img_name = ".".join(os.path.basename(img_path).split(".")[:-1])
     fileending = os.path.basename(img_path).split(".")[-1]
     img = open_file(os.path.join(tmppath, f"{img_name}_denoised.{fileending}"))
@@ -0,0 +1,517 @@
+import h5py
+import numpy as np
+from alive_progress import alive_bar
+from scipy.ndimage import uniform_filter
+
+# name of the dataset that holds all training patches (patches, crop_size, crop_size)
+PATCHES_DATASET = "patches"
+COMPRESSIONS = ["gzip", "lzf"]
+STORAGE_DTYPES = ["float64", "float32", "float16", "int16"]
+# resolution of int16 patches: z-scores in [-128, 128) with a step of 1/256
+INT16_SCALE = 2.0**-8
+# per-patch metadata: index of the source file, frame, position and max. ROI-mean z-score per ROI size
+METADATA_DATASET = "metadata"
+SOURCES_DATASET = "sources"
+
+
+def metadata_dtype(num_roi_sizes: int) -> np.dtype:
+    """
+    Dtype of the metadata records of the patches.
+
+    Args:
+        num_roi_sizes (int): Number of ROI sizes with a max. ROI-mean z-score.
+
+    Returns:
+        np.dtype: Structured dtype with the fields source, frame, y, x and max_roi_mean.
+    """
+    return np.dtype(
+        [
+            ("source", np.int32),
+            ("frame", np.int64),
+            ("y", np.int32),
+            ("x", np.int32),
+            ("max_roi_mean", np.float32, (num_roi_sizes,)),
+        ]
+    )
+
+
+def max_roi_means(patches: np.ndarray, roi_sizes: list[int]) -> np.ndarray:
+    """
+    Maximum of the roi_size x roi_size mean (zero padded) of every patch, for every ROI size.
+
+    Args:
+        patches (np.ndarray): Patches (patches, crop_size, crop_size).
+        roi_sizes (list[int]): ROI sizes.
+
+    Returns:
+        np.ndarray: Max. ROI-mean z-scores (patches, ROI sizes), float32 or float64 for float64 patches.
+    """
+    scores = np.empty(
+        (len(patches), len(roi_sizes)), dtype=np.result_type(patches.dtype, np.float32)
+    )
+    for i, roi_size in enumerate(roi_sizes):
+        # mean filter of every patch, not along the patch axis
+        mean_patches = uniform_filter(patches, (1, roi_size, roi_size), mode="constant")
+        scores[:, i] = mean_patches.max(axis=(1, 2), initial=-np.inf)
+    return scores
+
+
+class PatchStore:
+    """
+    Training patches of an H5 file, stored in a single resizable, chunked dataset
+    of shape (patches, crop_size, crop_size).
+
+    Patches are read and appended in slices, so the number of H5 objects does
+    not grow with the number of patches. Files in the legacy layout (one dataset
+    per patch, named by its index) can be read as well, but not appended to, they
+    can be converted with convert_legacy_h5.
+
+    The patches can be stored in a compact dtype (float16 or int16). The stored
+    values are decoded with value * scale + offset, scale and offset are
+    attributes of the patches dataset. Compact patches are decoded to float32
+    when they are read. While appending, the reconstruction error of the
+    encoding is accumulated (see encoding_error).
+
+    Optionally, a metadata record is stored for every patch (see metadata_dtype):
+    the source file (index into the sources dataset), the frame and position of
+    the patch in the recording and the max. ROI-mean z-score for every ROI size
+    in the attribute roi_sizes. Metadata is only kept if it is appended with
+    every patch.
+
+    Attributes:
+        h5_path (str): Path to the H5 file.
+        legacy (bool): Whether the file uses the legacy layout.
+    """
+
+    def __init__(self, h5_path: str, mode: str = "r") -> None:
+        """
+        Open the H5 file.
+
+        Args:
+            h5_path (str): Path to the H5 file.
+            mode (str): h5py file mode, "r" to read, "a" to append (default: "r").
+        """
+        self.h5_path = h5_path
+        self.h5_file = h5py.File(h5_path, mode)
+        self.legacy = PATCHES_DATASET not in self.h5_file and len(self.h5_file) > 0
+        if self.legacy:
+            self.keys = sorted(self.h5_file.keys(), key=int)
+        self.num_encoded = 0
+        self.num_clipped = 0
+        self.max_error = 0.0
+        self.sum_error = 0.0
+
+    def __enter__(self) -> "PatchStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        """
+        Returns the number of patches.
+
+        Returns:
+            int: Number of patches.
+        """
+        if self.legacy:
+            return len(self.keys)
+        if PATCHES_DATASET not in self.h5_file:
+            return 0
+        return self.h5_file[PATCHES_DATASET].shape[0]
+
+    @property
+    def storage_dtype(self) -> str | None:
+        """
+        Dtype in which the patches are stored, None for a file without patches.
+
+        Returns:
+            str | None: Name of the dtype, e.g. "float32".
+        """
+        if self.legacy:
+            return self.h5_file[self.keys[0]].dtype.name
+        if PATCHES_DATASET not in self.h5_file:
+            return None
+        return self.h5_file[PATCHES_DATASET].dtype.name
+
+    def scale_offset(self) -> tuple[float, float]:
+        """
+        Scale and offset to decode the stored patches.
+
+        Returns:
+            tuple[float, float]: Scale and offset (1 and 0 for the legacy layout).
+        """
+        if self.legacy or PATCHES_DATASET not in self.h5_file:
+            return 1.0, 0.0
+        attrs = self.h5_file[PATCHES_DATASET].attrs
+        return float(attrs.get("scale", 1.0)), float(attrs.get("offset", 0.0))
+
+    def decode(self, stored: np.ndarray) -> np.ndarray:
+        """
+        Decode stored patches. float32 and float64 patches are returned unchanged,
+        compact patches are decoded to float32.
+
+        Args:
+            stored (np.ndarray): Stored patches.
+
+        Returns:
+            np.ndarray: Patches (z-scores).
+        """
+        if stored.dtype in (np.float32, np.float64):
+            return stored
+        scale, offset = self.scale_offset()
+        patches = stored.astype(np.float32)
+        if scale != 1.0:
+            patches *= np.float32(scale)
+        if offset != 0.0:
+            patches += np.float32(offset)
+        return patches
+
+    def encode(self, patches: np.ndarray) -> np.ndarray:
+        """
+        Encode patches in the dtype of the patches dataset and accumulate the reconstruction error.
+
+        Args:
+            patches (np.ndarray): Patches (z-scores).
+
+        Returns:
+            np.ndarray: Patches in the storage dtype.
+        """
+        dtype = self.h5_file[PATCHES_DATASET].dtype
+        if dtype == patches.dtype:
+            return patches
+        scale, offset = self.scale_offset()
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            scaled = np.rint((patches - offset) / scale)
+        else:
+            # values beyond the float range would be stored as inf
+            info = np.finfo(dtype)
+            scaled = (patches - offset) / scale
+        self.num_clipped += int(
+            np.count_nonzero((scaled < info.min) | (scaled > info.max))
+        )
+        stored = np.clip(scaled, info.min, info.max).astype(dtype)
+        error = np.abs(
+            np.subtract(self.decode(stored), patches, dtype=np.float64),
+            dtype=np.float64,
+        )
+        self.num_encoded += error.size
+        if error.size > 0:
+            self.max_error = max(self.max_error, float(error.max()))
+            self.sum_error += float(error.sum())
+        return stored
+
+    def encoding_error(self) -> dict:
+        """
+        Reconstruction error of the patches appended with this object.
+
+        Returns:
+            dict: num_values (number of encoded values), max_error and mean_error
+                  (absolute, in z-scores) and clipped (number of values outside the range of the storage dtype).
+        """
+        return {
+            "num_values": self.num_encoded,
+            "max_error": self.max_error,
+            "mean_error": self.sum_error / max(1, self.num_encoded),
+            "clipped": self.num_clipped,
+        }
+
+    @property
+    def has_metadata(self) -> bool:
+        """
+        Whether every patch has a metadata record.
+
+        Returns:
+            bool: True if the metadata is complete.
+        """
+        return METADATA_DATASET in self.h5_file and self.h5_file[
+            METADATA_DATASET
+        ].shape[0] == len(self)
+
+    def metadata_roi_sizes(self) -> list[int]:
+        """
+        ROI sizes of the max. ROI-mean z-scores in the metadata.
+
+        Returns:
+            list[int]: ROI sizes, empty without metadata.
+        """
+        if METADATA_DATASET not in self.h5_file:
+            return []
+        return [int(size) for size in self.h5_file[METADATA_DATASET].attrs["roi_sizes"]]
+
+    def read_metadata(self, start: int = 0, stop: int | None = None) -> np.ndarray:
+        """
+        Read the metadata records of consecutive patches.
+
+        Args:
+            start (int): Index of the first patch (default: 0).
+            stop (int, optional): Index after the last patch (default: None, all patches).
+
+        Returns:
+            np.ndarray: Metadata records (see metadata_dtype).
+        """
+        return self.h5_file[METADATA_DATASET][start:stop]
+
+    def sources(self) -> list[str]:
+        """
+        Source files of the patches, the source field of the metadata is an index into this list.
+
+        Returns:
+            list[str]: Paths of the source files.
+        """
+        if SOURCES_DATASET not in self.h5_file:
+            return []
+        return [source.decode() for source in self.h5_file[SOURCES_DATASET][()]]
+
+    def add_sources(self, sources: list[str]) -> int:
+        """
+        Append source files.
+
+        Args:
+            sources (list[str]): Paths of the source files.
+
+        Returns:
+            int: Index of the first added source file.
+        """
+        if SOURCES_DATASET not in self.h5_file:
+            self.h5_file.create_dataset(
+                SOURCES_DATASET,
+                shape=(0,),
+                maxshape=(None,),
+                dtype=h5py.string_dtype(),
+            )
+        dataset = self.h5_file[SOURCES_DATASET]
+        num_sources = dataset.shape[0]
+        dataset.resize(num_sources + len(sources), axis=0)
+        dataset[num_sources:] = sources
+        return num_sources
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        """
+        Read consecutive patches.
+
+        Args:
+            start (int): Index of the first patch.
+            stop (int): Index after the last patch.
+
+        Returns:
+            np.ndarray: Patches start to stop (patches, crop_size, crop_size).
+        """
+        if self.legacy:
+            return np.stack(
+                [np.array(self.h5_file[key]) for key in self.keys[start:stop]]
+            )
+        return self.decode(self.h5_file[PATCHES_DATASET][start:stop])
+
+    def read_runs(
+        self, sorted_idxs: np.ndarray, max_gap: int | None = None
+    ) -> np.ndarray:
+        """
+        Read the patches at ascending indices in bulk.
+
+        Indices that are at most max_gap apart are merged into one run, and every
+        run is read with a single slice (h5py reads slices considerably faster than
+        lists of indices). The patches in the gaps are read and dropped, which costs
+        nothing extra as long as the gaps lie within already decompressed chunks.
+
+        Args:
+            sorted_idxs (np.ndarray[int]): Ascending indices of the patches.
+            max_gap (int, optional): Maximal distance of two indices in the same run.
+                Default is the number of patches per chunk.
+
+        Returns:
+            np.ndarray: Patches in the order of sorted_idxs (patches, crop_size, crop_size).
+        """
+        sorted_idxs = np.asarray(sorted_idxs, dtype=np.int64)
+        if self.legacy:
+            return np.stack(
+                [np.array(self.h5_file[self.keys[idx]]) for idx in sorted_idxs]
+            )
+        dataset = self.h5_file[PATCHES_DATASET]
+        if len(sorted_idxs) == 0:
+            return self.decode(dataset[0:0])
+        if max_gap is None:
+            max_gap = dataset.chunks[0] if dataset.chunks is not None else 1
+        run_starts = np.flatnonzero(np.diff(sorted_idxs) > max_gap) + 1
+        runs = [
+            dataset[run[0] : run[-1] + 1][run - run[0]]
+            for run in np.split(sorted_idxs, run_starts)
+        ]
+        return self.decode(np.concatenate(runs))
+
+    def read_indices(self, idxs: np.ndarray) -> np.ndarray:
+        """
+        Read the patches at arbitrary indices.
+
+        The indices are read in ascending order and in contiguous runs (see
+        read_runs), so that every chunk is decompressed at most once, and returned
+        in the given order.
+
+        Args:
+            idxs (np.ndarray[int]): Indices of the patches.
+
+        Returns:
+            np.ndarray: Patches in the order of idxs (patches, crop_size, crop_size).
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        order = np.argsort(idxs)
+        sorted_patches = self.read_runs(idxs[order])
+        patches = np.empty_like(sorted_patches)
+        patches[order] = sorted_patches
+        return patches
+
+    def append(
+        self,
+        patches: np.ndarray,
+        compression: str | None = None,
+        chunk_patches: int = 64,
+        storage_dtype: str | None = None,
+        metadata: np.ndarray | None = None,
+        roi_sizes: list[int] | None = None,
+    ) -> None:
+        """
+        Append patches at the end of the patches dataset, which is created with the first patches.
+        The patches are encoded in the storage dtype of the dataset.
+
+        Metadata is only written if every patch has a metadata record, i.e. for a
+        new file or a file with complete metadata.
+
+        Args:
+            patches (np.ndarray): Patches (patches, crop_size, crop_size).
+            compression (str, optional): Compression of a new dataset, "gzip" or "lzf" (default: None).
+            chunk_patches (int): Number of patches per chunk of a new dataset (default: 64).
+            storage_dtype (str, optional): Storage dtype of a new dataset, see STORAGE_DTYPES
+                                           (default: None, dtype of the patches).
+            metadata (np.ndarray, optional): Metadata records of the patches (see metadata_dtype).
+            roi_sizes (list[int], optional): ROI sizes of the max_roi_mean field, required for a
+                                             new metadata dataset.
+
+        Raises:
+            ValueError: If the file uses the legacy layout.
+        """
+        if self.legacy:
+            raise ValueError(
+                f"{self.h5_path} uses the legacy layout (one dataset per patch). Convert it with convert_h5 first."
+            )
+        if len(patches) == 0:
+            return
+        if (
+            metadata is not None
+            and METADATA_DATASET not in self.h5_file
+            and len(self) == 0
+        ):
+            dataset = self.h5_file.create_dataset(
+                METADATA_DATASET,
+                shape=(0,),
+                maxshape=(None,),
+                chunks=(4096,),
+                dtype=metadata.dtype,
+                compression=compression,
+            )
+            dataset.attrs["roi_sizes"] = roi_sizes
+        if metadata is not None and self.has_metadata:
+            dataset = self.h5_file[METADATA_DATASET]
+            num_records = dataset.shape[0]
+            dataset.resize(num_records + len(metadata), axis=0)
+            dataset[num_records:] = metadata
+        if PATCHES_DATASET not in self.h5_file:
+            crop_size = patches.shape[1:]
+            dtype = np.dtype(storage_dtype or patches.dtype)
+            dataset = self.h5_file.create_dataset(
+                PATCHES_DATASET,
+                shape=(0, *crop_size),
+                maxshape=(None, *crop_size),
+                chunks=(chunk_patches, *crop_size),
+                dtype=dtype,
+                compression=compression,
+            )
+            dataset.attrs["scale"] = (
+                INT16_SCALE if np.issubdtype(dtype, np.integer) else 1.0
+            )
+            dataset.attrs["offset"] = 0.0
+        dataset = self.h5_file[PATCHES_DATASET]
+        num_patches = dataset.shape[0]
+        dataset.resize(num_patches + len(patches), axis=0)
+        dataset[num_patches:] = self.encode(patches)
+
+    def close(self) -> None:
+        """
+        Close the H5 file.
+        """
+        self.h5_file.close()
+
+
+def merge_encoding_errors(error: dict | None, other: dict) -> dict:
+    """
+    Combine the reconstruction errors (see PatchStore.encoding_error) of two sets of patches.
+
+    Args:
+        error (dict, optional): Reconstruction error of the first set of patches (None: no patches).
+        other (dict): Reconstruction error of the second set of patches.
+
+    Returns:
+        dict: Reconstruction error of both sets of patches.
+    """
+    if error is None:
+        return other
+    num_values = error["num_values"] + other["num_values"]
+    return {
+        "num_values": num_values,
+        "max_error": max(error["max_error"], other["max_error"]),
+        "mean_error": (
+            error["mean_error"] * error["num_values"]
+            + other["mean_error"] * other["num_values"]
+        )
+        / max(1, num_values),
+        "clipped": error["clipped"] + other["clipped"],
+    }
+
+
+def print_encoding_error(error: dict, storage_dtype: str) -> None:
+    """
+    Print the reconstruction error of patches that were stored in another dtype.
+
+    Args:
+        error (dict): Reconstruction error (see PatchStore.encoding_error).
+        storage_dtype (str): Storage dtype of the patches.
+    """
+    if error["num_values"] == 0:
+        return
+    print(
+        f"Stored patches as {storage_dtype}: max. reconstruction error {error['max_error']:.2e}, mean reconstruction error {error['mean_error']:.2e}"
+    )
+    if error["clipped"] > 0:
+        print(
+            f"WARNING: {error['clipped']} value(s) exceeded the range of {storage_dtype} and were clipped."
+        )
+
+
+def convert_legacy_h5(
+    input_h5: str,
+    output_h5: str,
+    compression: str | None = None,
+    block_size: int = 4096,
+    storage_dtype: str | None = None,
+) -> None:
+    """
+    Convert an H5 file with one dataset per patch into the layout with a single patches dataset.
+    The patches keep their order (index of the legacy dataset).
+
+    Args:
+        input_h5 (str): Path to the legacy H5 file.
+        output_h5 (str): Path to the converted H5 file.
+        compression (str, optional): Compression of the patches dataset, "gzip" or "lzf" (default: None).
+        block_size (int): Number of patches converted at once (default: 4096).
+        storage_dtype (str, optional): Storage dtype of the patches, see STORAGE_DTYPES
+                                       (default: None, dtype of the input).
+    """
+    with PatchStore(input_h5) as patches_in, PatchStore(output_h5, "w") as patches_out:
+        num_patches = len(patches_in)
+        with alive_bar(num_patches) as bar:
+            for start in range(0, num_patches, block_size):
+                block = patches_in.read(start, start + block_size)
+                patches_out.append(block, compression, storage_dtype=storage_dtype)
+                bar(len(block))
+        print(f"Converted {num_patches} patches to {output_h5}.")
+        print_encoding_error(patches_out.encoding_error(), patches_out.storage_dtype)
@@ -0,0 +1,20 @@
+import hashlib
+
+
+def file_hash(filepath: str, chunk_size: int = 2**20) -> str:
+    """
+    Compute a hash of the content of a file. The file is read in chunks,
+    so that files larger than the RAM can be hashed.
+
+    Parameters:
+    - filepath (str): Path to the file.
+    - chunk_size (int): Number of bytes read at once (default: 1 MiB).
+
+    Returns:
+    - str: Hexadecimal BLAKE2b digest of the file content.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filepath, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
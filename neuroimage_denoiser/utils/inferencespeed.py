@@ -1,6 +1,5 @@
 from neuroimage_denoiser.model.modelwrapper import ModelWrapper
 from neuroimage_denoiser.utils.open_file import open_file
-import neuroimage_denoiser.utils.normalization as normalization
 import numpy as np
 import os
 import time
@@ -101,10 +100,7 @@ def eval_inferencespeed(
                 model.img_height = cropsize
                 model.img_width = cropsize
                 model.normalize_img()
-                denoised_image_sequence = model.inference()
-                denoised_image_sequence = normalization.reverse_z_norm(
-                    denoised_image_sequence, model.img_mean, model.img_std
-                )
+                model.inference()
                 runtimes[cropsize].append(time.time() - start)
             bar()
     outfile = os.path.join(outpath, "inferencespeed.json")
@@ -1,6 +1,7 @@
 import numpy as np
-import os
-from scipy.ndimage import uniform_filter1d
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+from neuroimage_denoiser.utils.open_file import StackReader
 
 
 def z_norm(
@@ -10,18 +11,222 @@ def z_norm(
 ) -> np.ndarray:
     """
     Pixelwise z-scaling for the image. z = (x-µ)/σ
+    The result has the dtype of img, mean and std.
 
     Parameters:
-    - img (np.ndarray[np.float64]): Input image.
-    - mean (np.ndarray[np.float64]): Mean matrix for scaling
-    - std (np.ndarray[np.float64]): Standard deviation matrix for scaling.
+    - img (np.ndarray[np.floating]): Input image.
+    - mean (np.ndarray[np.floating]): Mean matrix for scaling
+    - std (np.ndarray[np.floating]): Standard deviation matrix for scaling.
 
     Returns:
-        np.ndarray[np.float64]: z-scaled image.
+        np.ndarray[np.floating]: z-scaled image.
     """
     return np.divide(np.subtract(img, mean), std)
 
 
+class RunningStats:
+    """
+    Streaming pixelwise mean and standard deviation along the z-axis of an image sequence.
+
+    Blocks of consecutive frames are added with update, partial results (e.g. of
+    other threads or processes, the object can be pickled) are combined with merge.
+    Every block is reduced in float64 with a two-pass algorithm and combined with
+    the running result by the parallel update of Chan et al. (Welford's algorithm
+    generalized to blocks), which is numerically stable for large pixel values
+    and does not depend on the order of the blocks (up to rounding).
+
+    Attributes:
+        count (int): Number of frames seen so far.
+        mean (np.ndarray[np.float64] | None): Pixelwise mean, None before the first frame.
+        m2 (np.ndarray[np.float64] | None): Pixelwise sum of squared deviations from the mean.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, block: np.ndarray) -> "RunningStats":
+        """
+        Add a block of frames.
+
+        Args:
+            block (np.ndarray): Block of frames (frames, height, width).
+
+        Returns:
+            RunningStats: self
+        """
+        if block.shape[0] == 0:
+            return self
+        block_stats = RunningStats()
+        block_stats.count = block.shape[0]
+        block_stats.mean = np.mean(block, axis=0, dtype=np.float64)
+        centered = np.subtract(block, block_stats.mean, dtype=np.float64)
+        block_stats.m2 = np.sum(np.square(centered, out=centered), axis=0)
+        return self.merge(block_stats)
+
+    def merge(self, other: "RunningStats") -> "RunningStats":
+        """
+        Combine with the statistics of other frames of the same image sequence.
+
+        Args:
+            other (RunningStats): Statistics of other frames.
+
+        Returns:
+            RunningStats: self
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean.copy()
+            self.m2 = other.m2.copy()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / count)
+        self.m2 += other.m2 + np.square(delta) * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    def mean_std(self, dtype: np.dtype = np.float64) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Pixelwise mean and (population) standard deviation of all frames seen so far.
+
+        Args:
+            dtype (np.dtype): Floating point type of the returned matrices (default: float64).
+
+        Returns:
+            tuple[np.ndarray[dtype], np.ndarray[dtype]]: Mean and standard deviation matrix.
+
+        Raises:
+            ValueError: If no frames were added.
+        """
+        if self.count == 0:
+            raise ValueError(
+                "Cannot compute mean and standard deviation of an empty image."
+            )
+        std = np.sqrt(np.maximum(self.m2 / self.count, 0.0))
+        return self.mean.astype(dtype), std.astype(dtype)
+
+
+def compute_running_stats(
+    read: Callable[[int, int], np.ndarray],
+    num_frames: int,
+    block_size: int = 256,
+    num_threads: int = 1,
+) -> RunningStats:
+    """
+    Accumulate the statistics of an image sequence block by block, optionally in parallel.
+
+    With num_threads > 1, every thread accumulates a contiguous range of blocks
+    and the partial results are merged. NumPy releases the GIL during the
+    reductions, so the threads run in parallel. read has to be thread-safe in
+    this case (e.g. slicing of an array or memmap).
+
+    Parameters:
+    - read (Callable[[int, int], np.ndarray]): Returns the frames start to stop, e.g. StackReader.read.
+    - num_frames (int): Number of frames of the image sequence.
+    - block_size (int): Number of frames per block (default: 256).
+    - num_threads (int): Number of threads (default: 1).
+
+    Returns:
+        RunningStats: Statistics of the image sequence.
+    """
+    starts = list(range(0, num_frames, block_size))
+    num_threads = max(1, min(num_threads, len(starts)))
+
+    def accumulate(thread_starts: list[int]) -> RunningStats:
+        stats = RunningStats()
+        for start in thread_starts:
+            stats.update(read(start, min(start + block_size, num_frames)))
+        return stats
+
+    if num_threads == 1:
+        return accumulate(starts)
+    chunks = np.array_split(np.array(starts, dtype=np.int64), num_threads)
+    with ThreadPoolExecutor(num_threads) as pool:
+        partial_stats = list(pool.map(accumulate, [chunk.tolist() for chunk in chunks]))
+    stats = RunningStats()
+    for partial in partial_stats:
+        stats.merge(partial)
+    return stats
+
+
+def blockwise_mean_std(
+    blocks: Iterable[np.ndarray], dtype: np.dtype = np.float64
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pixelwise mean and standard deviation along the z-axis of an image sequence
+    that is passed in blocks of consecutive frames. Only one block has to be
+    held in memory at a time (see RunningStats).
+
+    Parameters:
+    - blocks (Iterable[np.ndarray]): Blocks of frames (frames, height, width).
+    - dtype (np.dtype): Floating point type of the returned matrices (default: float64).
+
+    Returns:
+        tuple[np.ndarray[dtype], np.ndarray[dtype]]: Mean and standard deviation matrix.
+    """
+    stats = RunningStats()
+    for block in blocks:
+        stats.update(block)
+    return stats.mean_std(dtype)
+
+
+def mean_std(
+    img: np.ndarray,
+    dtype: np.dtype = np.float64,
+    block_size: int = 256,
+    num_threads: int = 1,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pixelwise mean and standard deviation along the z-axis of an image sequence.
+
+    The image sequence is processed in blocks of frames with float64 accumulators
+    (see RunningStats), so no float64 copy of the whole image sequence is created.
+
+    Parameters:
+    - img (np.ndarray): Input image sequence (frames, height, width).
+    - dtype (np.dtype): Floating point type of the returned matrices (default: float64).
+    - block_size (int): Number of frames per block (default: 256).
+    - num_threads (int): Number of threads (default: 1).
+
+    Returns:
+        tuple[np.ndarray[dtype], np.ndarray[dtype]]: Mean and standard deviation matrix.
+    """
+    return compute_running_stats(
+        lambda start, stop: img[start:stop], img.shape[0], block_size, num_threads
+    ).mean_std(dtype)
+
+
+def reader_mean_std(
+    reader: StackReader,
+    dtype: np.dtype = np.float64,
+    block_size: int = 256,
+    num_threads: int = 1,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pixelwise mean and standard deviation along the z-axis of an image sequence
+    that is read block by block. Threads are only used for memory-mapped files,
+    the other readers are read sequentially.
+
+    Parameters:
+    - reader (StackReader): Reader of the image sequence.
+    - dtype (np.dtype): Floating point type of the returned matrices (default: float64).
+    - block_size (int): Number of frames per block (default: 256).
+    - num_threads (int): Number of threads (default: 1).
+
+    Returns:
+        tuple[np.ndarray[dtype], np.ndarray[dtype]]: Mean and standard deviation matrix.
+    """
+    if not reader.memory_mapped:
+        num_threads = 1
+    return compute_running_stats(
+        reader.read, len(reader), block_size, num_threads
+    ).mean_std(dtype)
+
+
 def moving_std(img: np.ndarray, start: int, end: int) -> np.ndarray:
     """
     Calculate the moving standard deviation of a numpy array within a specified range.
@@ -37,66 +242,187 @@ def moving_std(img: np.ndarray, start: int, end: int) -> np.ndarray:
     return np.std(img[start:end], axis=0)
 
 
-def rolling_window_z_norm(
+def sliding_window_z_norm(
     img: np.ndarray,
     window_size: int,
+    out: np.ndarray,
+    start: int = 0,
 ) -> np.ndarray:
     """
-    Apply rolling window z-scaling to an image sequence.
+    Rolling window z-scaling with running sums, O(T) in the number of frames.
+
+    The window sums of the pixel values and of their squares are updated frame by
+    frame, when frames enter and leave the window. The sums are accumulated in
+    float64 relative to the first frame, which avoids cancellation for large pixel
+    values. The edges behave like the reference implementation:
+    - the mean of frame i is the sum over frames [i - window_size//2, i - window_size//2 + window_size),
+      zero padded at the edges and divided by window_size (uniform_filter1d with mode="constant").
+    - the std of frame i is computed over frames [max(0, i - window_size//2), min(T-1, i + window_size - window_size//2)),
+      i.e. the last frame of the image sequence is never part of the window.
+    - windows of a single frame have a std of exactly zero (inf or nan after the division),
+      windows without frames a std of nan.
 
     Parameters:
-    - img (np.ndarray[np.float64]): Input image sequence.
+    - img (np.ndarray[np.floating]): Input image sequence (frames, height, width).
     - window_size (int): Size of the rolling window.
+    - out (np.ndarray[np.floating]): Output array for the frames start to start + len(out), may be a memmap.
+    - start (int): Index of the first z-scaled frame (default: 0).
 
     Returns:
-        np.ndarray[np.float64]: Z-scaled image sequence.
+        np.ndarray[np.floating]: out, the z-scaled frames.
+
+    Raises:
+        ValueError: If window_size is smaller than 2.
     """
+    if window_size < 2:
+        # every std window would contain a single frame
+        raise ValueError(f"window_size must be at least 2, got {window_size}.")
+    num_frames = img.shape[0]
+    if num_frames == 0 or out.shape[0] == 0:
+        return out
     before = window_size // 2
     after = window_size - before
-    mean = uniform_filter1d(img, window_size, axis=0, mode="constant")
-    std = []
-    for idx in range(img.shape[0]):
-        start = max(0, idx - before)
-        end = min(img.shape[0] - 1, idx + after)
-        std.append(moving_std(img, start, end))
-    return np.divide(np.subtract(img, mean), std)
+    shift = np.array(img[start], dtype=np.float64)
+    last_frame = np.subtract(img[num_frames - 1], shift)
+    window_sum = np.zeros_like(shift)
+    window_sum_sq = np.zeros_like(shift)
+    frame = np.empty_like(shift)
+    mean = np.empty_like(shift)
+    var = np.empty_like(shift)
+    window_start = max(0, start - before)
+    window_end = window_start
+    for idx in range(start, start + out.shape[0]):
+        std_start = max(0, idx - before)
+        std_end = min(num_frames - 1, idx + after)
+        while window_end < std_end:
+            np.subtract(img[window_end], shift, out=frame)
+            window_sum += frame
+            window_sum_sq += np.square(frame, out=frame)
+            window_end += 1
+        while window_start < std_start:
+            np.subtract(img[window_start], shift, out=frame)
+            window_sum -= frame
+            window_sum_sq -= np.square(frame, out=frame)
+            window_start += 1
+        count = std_end - std_start
+        # the mean window additionally contains the last frame at the end of the sequence
+        mean_count = min(num_frames, idx + after) - std_start
+        np.add(window_sum, mean_count * shift, out=mean)
+        if mean_count > count:
+            mean += last_frame
+        mean /= window_size
+        if count > 1:
+            # var = (sum(x^2) - sum(x)^2 / n) / n
+            np.square(window_sum, out=var)
+            var /= -count
+            var += window_sum_sq
+            var /= count
+            np.maximum(var, 0.0, out=var)
+            np.sqrt(var, out=var)
+        elif count == 1:
+            # exactly zero, the running sums may not cancel exactly
+            var.fill(0.0)
+        else:
+            # empty window, like np.std of no frames
+            var.fill(np.nan)
+        np.subtract(img[idx], mean, out=frame)
+        np.divide(frame, var, out=frame)
+        out[idx - start] = frame
+    return out
 
 
-def rolling_window_z_norm_memory_optimized(
+def rolling_window_z_norm(
     img: np.ndarray,
     window_size: int,
-    base_dir: str,
 ) -> np.ndarray:
     """
     Apply rolling window z-scaling to an image sequence.
+    The result has the dtype of img.
 
     Parameters:
-    - img (np.ndarray[np.float64]): Input image sequence.
+    - img (np.ndarray[np.floating]): Input image sequence.
     - window_size (int): Size of the rolling window.
 
     Returns:
-        np.ndarray[np.float64]: Z-scaled image sequence.
-    """
-    std_mmap = np.memmap(
-        os.path.join(base_dir, "mmap_std.npy"),
-        dtype="float64",
-        mode="w+",
-        shape=img.shape,
-    )
-    mean_mmap = np.memmap(
-        os.path.join(base_dir, "mmap_mean.npy"),
-        dtype="float64",
-        mode="w+",
-        shape=img.shape,
-    )
+        np.ndarray[np.floating]: Z-scaled image sequence.
+    """
+    return sliding_window_z_norm(img, window_size, np.empty_like(img))
+
+
+class HaloBlock:
+    """
+    Consecutive frames of an image sequence, indexed with the frame indices of the
+    whole sequence. The last frame of the sequence is always available, since the
+    rolling window mean at the end of the sequence depends on it.
+
+    Attributes:
+    - frames (np.ndarray): Frames start to start + len(frames).
+    - start (int): Index of the first frame.
+    - shape (tuple[int, int, int]): Shape of the whole image sequence.
+    - last_frame (np.ndarray): Last frame of the image sequence.
+    """
+
+    def __init__(
+        self, frames: np.ndarray, start: int, num_frames: int, last_frame: np.ndarray
+    ) -> None:
+        self.frames = frames
+        self.start = start
+        self.shape = (num_frames,) + frames.shape[1:]
+        self.last_frame = last_frame
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        if idx == self.shape[0] - 1:
+            return self.last_frame
+        if not self.start <= idx < self.start + self.frames.shape[0]:
+            raise IndexError(
+                f"Frame {idx} is outside of the block ({self.start}-{self.start + self.frames.shape[0]})."
+            )
+        return self.frames[idx - self.start]
+
+
+def rolling_window_z_norm_blocks(
+    reader: StackReader,
+    window_size: int,
+    block_size: int = 256,
+    start: int = 0,
+    stop: int | None = None,
+) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    Apply rolling window z-scaling to an image sequence block by block.
+
+    Every block is read with a halo of window_size frames, so only
+    block_size + window_size + 1 frames are held in memory. The result equals
+    rolling_window_z_norm of the whole sequence. The yielded output buffer is
+    reused, each block is only valid until the next block is requested.
+
+    Parameters:
+    - reader (StackReader): Reader of the image sequence.
+    - window_size (int): Size of the rolling window.
+    - block_size (int): Number of z-scaled frames per block (default: 256).
+    - start (int): Index of the first z-scaled frame (default: 0).
+    - stop (int, optional): Index after the last z-scaled frame (default: all frames).
+
+    Yields:
+        tuple[int, np.ndarray]: Index of the first frame and the z-scaled block of frames.
+    """
+    num_frames = len(reader)
+    stop = num_frames if stop is None else min(stop, num_frames)
+    if stop <= start:
+        return
     before = window_size // 2
     after = window_size - before
-    mean_mmap[:] = uniform_filter1d(img, window_size, axis=0, mode="constant")[:]
-    for idx in range(img.shape[0]):
-        start = max(0, idx - before)
-        end = min(img.shape[0] - 1, idx + after)
-        std_mmap[idx] = moving_std(img, start, end)
-    return np.divide(np.subtract(img, mean_mmap), std_mmap)
+    last_frame = reader.read(num_frames - 1, num_frames)[0]
+    out = np.empty((block_size,) + reader.shape[1:], dtype=reader.dtype)
+    for block_start in range(start, stop, block_size):
+        block_stop = min(stop, block_start + block_size)
+        halo_start = max(0, block_start - before)
+        halo_stop = min(num_frames, block_stop + after)
+        frames = HaloBlock(
+            reader.read(halo_start, halo_stop), halo_start, num_frames, last_frame
+        )
+        yield block_start, sliding_window_z_norm(
+            frames, window_size, out[: block_stop - block_start], block_start
+        )
 
 
 def reverse_z_norm(
@@ -108,11 +434,12 @@ def reverse_z_norm(
     Reverse z-scaling for the image. x = z*σ+µ
 
     Parameters:
-    - img (np.ndarray[np.float64]): Input image.
-    - mean (np.ndarray[np.float64]): Mean matrix for scaling.
-    - std (np.ndarray[np.float64]): Standard deviation matrix for scaling.
+    - img (np.ndarray[np.floating]): Input image.
+    - mean (np.ndarray[np.floating]): Mean matrix for scaling.
+    - std (np.ndarray[np.floating]): Standard deviation matrix for scaling.
 
     Returns:
-        np.ndarray[np.float64]; reversed z-scored image.
+        np.ndarray[np.floating]; reversed z-scored image.
     """
-    return np.add(np.multiply(img, std), mean)
+    reversed_img = np.multiply(img, std)
+    return np.add(reversed_img, mean, out=reversed_img)
@@ -0,0 +1,92 @@
+import neuroimage_denoiser.utils.normalization as normalization
+from neuroimage_denoiser.utils.open_file import open_file
+from scipy.ndimage import uniform_filter1d
+import numpy as np
+import os
+import time
+import json
+from alive_progress import alive_bar
+
+
+def rolling_window_z_norm_reference(
+    img: np.ndarray,
+    window_size: int,
+) -> np.ndarray:
+    """
+    Reference implementation of the rolling window z-scaling, which computes the
+    standard deviation of every window from scratch (O(T*window_size)).
+
+    Args:
+        img (np.ndarray[np.floating]): Input image sequence.
+        window_size (int): Size of the rolling window.
+
+    Returns:
+        np.ndarray[np.floating]: Z-scaled image sequence.
+    """
+    before = window_size // 2
+    after = window_size - before
+    mean = uniform_filter1d(img, window_size, axis=0, mode="constant")
+    std = []
+    for idx in range(img.shape[0]):
+        start = max(0, idx - before)
+        end = min(img.shape[0] - 1, idx + after)
+        std.append(normalization.moving_std(img, start, end))
+    return np.divide(np.subtract(img, mean), std)
+
+
+def eval_normalization_speed(
+    filepath: str,
+    window_sizes: list[int],
+    num_frames: int | None,
+    outpath: str,
+    dtype: str = "float32",
+) -> None:
+    """
+    Compare the runtime and the result of the rolling window z-scaling with the reference implementation.
+
+    For every window size, the maximal absolute and relative (to max(1, |reference|))
+    deviation from the reference is recorded, as well as whether both produce NaN
+    (empty windows) and inf (constant pixels) at the same positions.
+
+    Args:
+        filepath (str): Path to the image sequence.
+        window_sizes (list[int]): Window sizes to evaluate.
+        num_frames (int, optional): Number of frames used from the start of the image sequence (None: all).
+        outpath (str): Path to the output directory for saving the results (normalizationspeed.json).
+        dtype (str): Floating point type of the image sequence.
+
+    Raises:
+        FileNotFoundError: If the image sequence does not exist.
+    """
+    if not os.path.exists(filepath):
+        raise FileNotFoundError(f"Image sequence not found: {filepath}")
+    os.makedirs(outpath, exist_ok=True)
+    img = open_file(filepath, dtype)[:num_frames]
+    results = {}
+    with alive_bar(len(window_sizes)) as bar:
+        for window_size in sorted(window_sizes):
+            start = time.time()
+            reference = rolling_window_z_norm_reference(img, window_size)
+            runtime_reference = time.time() - start
+            start = time.time()
+            znorm = normalization.rolling_window_z_norm(img, window_size)
+            runtime = time.time() - start
+            finite = np.isfinite(reference) & np.isfinite(znorm)
+            deviation = np.abs(reference[finite] - znorm[finite]).astype(np.float64)
+            relative_deviation = deviation / np.maximum(1, np.abs(reference[finite]))
+            results[window_size] = {
+                "runtime_reference": runtime_reference,
+                "runtime": runtime,
+                "speedup": runtime_reference / runtime,
+                "max_abs_diff": float(deviation.max(initial=0.0)),
+                "max_rel_diff": float(relative_deviation.max(initial=0.0)),
+                "same_nan": bool(np.array_equal(np.isnan(reference), np.isnan(znorm))),
+                "same_inf": bool(np.array_equal(np.isinf(reference), np.isinf(znorm))),
+            }
+            print(
+                f"Window size {window_size}: {runtime_reference:.2f}s -> {runtime:.2f}s, max. relative deviation {results[window_size]['max_rel_diff']:.2e}"
+            )
+            bar()
+    outfile = os.path.join(outpath, "normalizationspeed.json")
+    with open(outfile, "w") as f:
+        json.dump(results, f, indent=2)
@@ -1,18 +1,20 @@
+from typing import Iterator
 import numpy as np
 import tifffile
 import nd2
 from neuroimage_denoiser.utils.convert import uint_to_float
 
 
-def open_file(filepath: str) -> np.ndarray:
+def open_file(filepath: str, dtype: np.dtype = np.float32) -> np.ndarray:
     """
     Open and read an image file from the specified filepath.
 
     Parameters:
     - filepath (str): Path to the image file.
+    - dtype (np.dtype): Floating point type of the returned array (default: float32).
 
     Returns:
-    - np.ndarray[np.float64]: NumPy array representing the image data.
+    - np.ndarray[dtype]: NumPy array representing the image data.
 
     Raises:
     - NotImplementedError: If the file format is not supported.
@@ -23,10 +25,172 @@ def open_file(filepath: str) -> np.ndarray:
     """
     tiff_fileendings = [".tif", ".tiff", ".stk"]
     if filepath.endswith(".nd2"):
-        return uint_to_float(nd2.imread(filepath))
+        return uint_to_float(nd2.imread(filepath), dtype)
     elif any([filepath.endswith(fileending) for fileending in tiff_fileendings]):
-        return uint_to_float(tifffile.imread(filepath))
+        return uint_to_float(tifffile.imread(filepath), dtype)
     else:
         raise NotImplementedError(
             f'Fileformat .{filepath.split(".")[-1]} is currently not implemented. Please change utils/open_file.py'
         )
+
+
+class StackReader:
+    """
+    Lazy reader for image sequences that are too large to be loaded at once.
+
+    Frames are only decoded when they are requested, so the memory footprint
+    depends on the number of requested frames and not on the recording length.
+    Uncompressed tiff files and .npy files are memory-mapped, all other tiff
+    files are read page by page and nd2 files frame by frame.
+
+    Attributes:
+        filepath (str): Path to the image file.
+        shape (tuple[int, int, int]): Shape of the image sequence (frames, height, width).
+        dtype (np.dtype): Floating point type of the returned frames.
+    """
+
+    def __init__(self, filepath: str, dtype: np.dtype = np.float32) -> None:
+        """
+        Open the image file for lazy reading.
+
+        Args:
+            filepath (str): Path to the image file.
+            dtype (np.dtype): Floating point type of the returned frames (default: float32).
+
+        Raises:
+            NotImplementedError: If the file format is not supported.
+            ValueError: If the file is not an image sequence.
+        """
+        tiff_fileendings = [".tif", ".tiff", ".stk"]
+        self.filepath = filepath
+        self.dtype = np.dtype(dtype)
+        self._nd2_file = None
+        self._tiff_file = None
+        self._mmap = None
+        if filepath.endswith(".nd2"):
+            self._nd2_file = nd2.ND2File(filepath)
+            self.shape = tuple(self._nd2_file.shape)
+        elif filepath.endswith(".npy"):
+            self._mmap = np.load(filepath, mmap_mode="r")
+            self.shape = self._mmap.shape
+        elif any([filepath.endswith(fileending) for fileending in tiff_fileendings]):
+            try:
+                # uncompressed, contiguous data can be memory-mapped
+                self._mmap = tifffile.memmap(filepath, mode="r")
+                self.shape = self._mmap.shape
+            except ValueError:
+                self._tiff_file = tifffile.TiffFile(filepath)
+                self.shape = self._tiff_file.series[0].shape
+        else:
+            raise NotImplementedError(
+                f'Fileformat .{filepath.split(".")[-1]} is currently not implemented. Please change utils/open_file.py'
+            )
+        if len(self.shape) != 3:
+            self.close()
+            raise ValueError(
+                f"Expected an image sequence (frames, height, width), but {filepath} has shape {self.shape}."
+            )
+
+    def __len__(self) -> int:
+        """
+        Returns the number of frames in the image sequence.
+
+        Returns:
+            int: Number of frames.
+        """
+        return self.shape[0]
+
+    @property
+    def random_access(self) -> bool:
+        """
+        Whether frames can be read in any order without decoding other frames.
+
+        Compressed tiff files are decoded page by page, reading overlapping blocks
+        decodes the same pages repeatedly.
+
+        Returns:
+            bool: True for memory-mapped and nd2 files.
+        """
+        return self._tiff_file is None
+
+    @property
+    def memory_mapped(self) -> bool:
+        """
+        Whether the frames are read from a memory-mapped file. Memory-mapped
+        files can be read from several threads at once.
+
+        Returns:
+            bool: True for uncompressed tiff files and .npy files.
+        """
+        return self._mmap is not None
+
+    def __enter__(self) -> "StackReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        """
+        Read a block of consecutive frames.
+
+        Args:
+            start (int): Index of the first frame.
+            stop (int): Index after the last frame.
+
+        Returns:
+            np.ndarray[dtype]: Frames start to stop.
+        """
+        stop = min(stop, len(self))
+        if self._mmap is not None:
+            block = self._mmap[start:stop]
+        elif self._tiff_file is not None:
+            block = self._tiff_file.asarray(key=slice(start, stop), series=0)
+            block = block.reshape(stop - start, self.shape[1], self.shape[2])
+        else:
+            block = np.stack(
+                [self._nd2_file.read_frame(idx) for idx in range(start, stop)]
+            )
+        return uint_to_float(block, self.dtype)
+
+    def iter_blocks(self, block_size: int) -> Iterator[tuple[int, np.ndarray]]:
+        """
+        Iterate over the image sequence in blocks of consecutive frames.
+
+        Args:
+            block_size (int): Number of frames per block.
+
+        Yields:
+            tuple[int, np.ndarray]: Index of the first frame and the block of frames.
+        """
+        for start in range(0, len(self), block_size):
+            yield start, self.read(start, start + block_size)
+
+    def close(self) -> None:
+        """
+        Close the underlying file handles.
+        """
+        if self._nd2_file is not None:
+            self._nd2_file.close()
+        if self._tiff_file is not None:
+            self._tiff_file.close()
+        # memory-mapped files are closed once the last reference is released
+        self._mmap = None
+
+
+def decode_to_npy(reader: StackReader, filepath: str, block_size: int = 256) -> None:
+    """
+    Decode an image sequence block by block into a .npy file, which can be memory-mapped.
+
+    Parameters:
+    - reader (StackReader): Reader of the image sequence.
+    - filepath (str): Path to the .npy file that will be written.
+    - block_size (int): Number of frames decoded at once (default: 256).
+    """
+    frames = np.lib.format.open_memmap(
+        filepath, mode="w+", dtype=reader.dtype, shape=reader.shape
+    )
+    for start, block in reader.iter_blocks(block_size):
+        frames[start : start + block.shape[0]] = block
+    frames.flush()
+    del frames
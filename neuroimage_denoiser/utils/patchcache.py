@@ -0,0 +1,286 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+from neuroimage_denoiser.utils.h5patches import PatchStore
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+DEFAULT_CACHE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def cache_key(h5_path: str) -> str:
+    """
+    Key of the cached patches of an H5 file, derived from its absolute path,
+    size and modification time (a changed file gets a new key).
+
+    Parameters:
+    - h5_path (str): Path to the H5 file.
+
+    Returns:
+    - str: Hexadecimal BLAKE2b digest.
+    """
+    stat = os.stat(h5_path)
+    identity = f"{os.path.abspath(h5_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.blake2b(identity.encode(), digest_size=20).hexdigest()
+
+
+def cache_path(h5_path: str, cache_dir: str | None = None) -> str:
+    """
+    Path of the cached patches of an H5 file.
+
+    Parameters:
+    - h5_path (str): Path to the H5 file.
+    - cache_dir (str | None): Directory of the cache (default: /dev/shm if available).
+
+    Returns:
+    - str: Path of the .npy file.
+    """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    return os.path.join(
+        cache_dir, f"neuroimage_denoiser_patches_{cache_key(h5_path)}.npy"
+    )
+
+
+def lock_cache(path: str):
+    """
+    Open and exclusively lock the lock file of a cache. The lock file may be deleted
+    (by remove_patch_cache) while waiting for the lock, then the current lock file
+    is locked instead, so all processes always lock the same file.
+
+    Parameters:
+    - path (str): Path of the cache file.
+
+    Returns:
+    - file: Open lock file, the lock is released when it is closed.
+    """
+    lock_path = f"{path}.lock"
+    while True:
+        lock = open(lock_path, "a")
+        if fcntl is None:
+            return lock
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(lock.fileno()), os.stat(lock_path)):
+                return lock
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+
+def available_memory() -> int | None:
+    """
+    Memory that is available without swapping, in bytes.
+
+    Returns:
+    - int | None: Available memory (None if it cannot be determined).
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class PatchCache:
+    """
+    Decoded training patches of an H5 file in a memory-mapped .npy file, by default
+    in shared memory (/dev/shm).
+
+    The cache is created once and reused by every data loader, worker process and
+    concurrent training process that opens the same (unchanged) H5 file: all of them
+    map the same pages, so the patches are held in RAM only once and are not read
+    from disk again. The cache is written to a temporary file under a file lock and
+    renamed when complete, so processes never attach to a partial cache.
+
+    The cache is not deleted automatically, call remove() (or remove_patch_cache)
+    when it is no longer needed. Processes that still have it open keep reading it.
+
+    Attributes:
+        h5_path (str): Path to the H5 file.
+        path (str): Path of the .npy file.
+        created (bool): Whether the cache was created by this instance.
+        patches (np.memmap): Decoded patches (patches, crop_size, crop_size).
+    """
+
+    def __init__(
+        self,
+        h5_path: str,
+        cache_dir: str | None = None,
+        block_size: int = 4096,
+        max_memory_fraction: float = 0.8,
+    ) -> None:
+        """
+        Attach to the cache of an H5 file, create it if it does not exist yet.
+
+        Args:
+            h5_path (str): Path to the H5 file.
+            cache_dir (str | None): Directory of the cache (default: /dev/shm if available).
+            block_size (int): Number of patches copied at once when the cache is created (default: 4096).
+            max_memory_fraction (float): Maximal fraction of the available RAM (and of the free
+                space of cache_dir) the cache may use (default: 0.8).
+
+        Raises:
+            MemoryError: If the patches do not fit into the available RAM or cache_dir.
+            ValueError: If the H5 file contains no patches.
+        """
+        self.h5_path = h5_path
+        self.path = cache_path(h5_path, cache_dir)
+        self.created = False
+        if not os.path.exists(self.path):
+            self.create(block_size, max_memory_fraction)
+        self.patches = np.load(self.path, mmap_mode="r")
+
+    def __enter__(self) -> "PatchCache":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        """
+        Returns the number of patches.
+
+        Returns:
+            int: Number of patches.
+        """
+        return self.patches.shape[0]
+
+    def create(self, block_size: int, max_memory_fraction: float) -> None:
+        """
+        Decode the patches of the H5 file into the cache file.
+
+        Args:
+            block_size (int): Number of patches copied at once.
+            max_memory_fraction (float): Maximal fraction of the available RAM (and of the
+                free space of the cache directory) the cache may use.
+
+        Raises:
+            MemoryError: If the patches do not fit into the available RAM or cache directory.
+            ValueError: If the H5 file contains no patches.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with lock_cache(self.path):
+            if os.path.exists(self.path):
+                # created by a concurrent process while waiting for the lock
+                return
+            with PatchStore(self.h5_path) as store:
+                num_patches = len(store)
+                if num_patches == 0:
+                    raise ValueError(f"{self.h5_path} contains no patches.")
+                first = store.read(0, 1)
+                shape = (num_patches,) + first.shape[1:]
+                nbytes = int(np.prod(shape)) * first.dtype.itemsize
+                limits = [shutil.disk_usage(os.path.dirname(self.path)).free]
+                memory = available_memory()
+                if memory is not None:
+                    limits.append(memory)
+                if nbytes > max_memory_fraction * min(limits):
+                    raise MemoryError(
+                        f"The patches of {self.h5_path} need {nbytes / 1e9:.2f} GB, more than {max_memory_fraction:.0%} of the {min(limits) / 1e9:.2f} GB available for the cache in {os.path.dirname(self.path)}."
+                    )
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                try:
+                    cache = np.lib.format.open_memmap(
+                        tmp_path, mode="w+", dtype=first.dtype, shape=shape
+                    )
+                    for start in range(0, num_patches, block_size):
+                        cache[start : start + block_size] = store.read(
+                            start, start + block_size
+                        )
+                    cache.flush()
+                    del cache
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+            self.created = True
+            print(
+                f"Cached {num_patches} patches ({nbytes / 1e9:.2f} GB) in {self.path}."
+            )
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        """
+        Read consecutive patches.
+
+        Args:
+            start (int): Index of the first patch.
+            stop (int): Index after the last patch.
+
+        Returns:
+            np.ndarray: Patches start to stop (patches, crop_size, crop_size).
+        """
+        return np.array(self.patches[start:stop])
+
+    def read_runs(self, sorted_idxs: np.ndarray) -> np.ndarray:
+        """
+        Read the patches at ascending indices.
+
+        Args:
+            sorted_idxs (np.ndarray[int]): Ascending indices of the patches.
+
+        Returns:
+            np.ndarray: Patches in the order of sorted_idxs (patches, crop_size, crop_size).
+        """
+        return self.patches[np.asarray(sorted_idxs, dtype=np.int64)]
+
+    def read_indices(self, idxs: np.ndarray) -> np.ndarray:
+        """
+        Read the patches at arbitrary indices.
+
+        Args:
+            idxs (np.ndarray[int]): Indices of the patches.
+
+        Returns:
+            np.ndarray: Patches in the order of idxs (patches, crop_size, crop_size).
+        """
+        return self.patches[np.asarray(idxs, dtype=np.int64)]
+
+    def close(self) -> None:
+        """
+        Detach from the cache. The cache file is kept.
+        """
+        self.patches = None
+
+    def remove(self) -> None:
+        """
+        Detach from the cache and delete the cache file.
+        """
+        self.close()
+        remove_patch_cache(self.h5_path, os.path.dirname(self.path))
+
+
+def remove_patch_cache(h5_path: str, cache_dir: str | None = None) -> bool:
+    """
+    Delete the cached patches of an H5 file and its lock file. Both are deleted while
+    holding the lock, so a cache that is being created is deleted after it is complete.
+
+    Parameters:
+    - h5_path (str): Path to the H5 file.
+    - cache_dir (str | None): Directory of the cache (default: /dev/shm if available).
+
+    Returns:
+    - bool: Whether a cache file was deleted.
+    """
+    path = cache_path(h5_path, cache_dir)
+    if not os.path.exists(path) and not os.path.exists(f"{path}.lock"):
+        return False
+    with lock_cache(path):
+        removed = os.path.exists(path)
+        if removed:
+            os.remove(path)
+        # waiting processes notice the deleted lock file and lock a new one
+        os.remove(f"{path}.lock")
+    return removed
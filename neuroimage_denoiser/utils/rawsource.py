@@ -0,0 +1,454 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import neuroimage_denoiser.utils.normalization as normalization
+from neuroimage_denoiser.utils.activitymap import (
+    compute_activitymap,
+    get_positions_from_activitymap,
+)
+from neuroimage_denoiser.utils.activitymapcache import ActivityMapCache
+from neuroimage_denoiser.utils.hashing import file_hash
+from neuroimage_denoiser.utils.open_file import StackReader, decode_to_npy
+
+DEFAULT_RECORDING_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "neuroimage_denoiser", "recordings"
+)
+
+
+def find_files(directory: str, fileendings: list[str]) -> list[str]:
+    """
+    Find all files with one of the file endings in a directory (recursively), in the
+    order of prepare_training.
+
+    Parameters:
+    - directory (str): Directory containing the recordings.
+    - fileendings (list[str]): File endings to consider.
+
+    Returns:
+    - list[str]: Paths of the files.
+    """
+    filepaths = []
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if any([file.endswith(ending) for ending in fileendings]):
+                filepaths.append(os.path.join(root, file))
+    return filepaths
+
+
+def evict_recordings(
+    cache_dir: str, max_bytes: int, keep: list[str] | None = None
+) -> None:
+    """
+    Delete the least recently used cached recordings until the cache fits into max_bytes.
+    The recordings in keep (e.g. the recordings of the current training) and
+    recordings that are still being written are never deleted.
+
+    Parameters:
+    - cache_dir (str): Directory of the cached recordings.
+    - max_bytes (int): Maximal total size of the cached recordings in bytes.
+    - keep (list[str] | None): Cache directories of recordings that must not be deleted.
+    """
+    keep = {os.path.abspath(directory) for directory in keep or []}
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        directory = os.path.join(cache_dir, name)
+        try:
+            files = os.listdir(directory)
+            size = sum(os.path.getsize(os.path.join(directory, f)) for f in files)
+            mtime = os.stat(directory).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        total += size
+        complete = all(f.endswith(".npy") for f in files)
+        if complete and os.path.abspath(directory) not in keep:
+            entries.append((mtime, size, directory))
+    for _, size, directory in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(directory, ignore_errors=True)
+        total -= size
+
+
+def write_npy_blocks(filepath: str, shape: tuple, blocks) -> None:
+    """
+    Write blocks of frames into a new .npy file. The file is written under a temporary
+    name and renamed when complete, so an interrupted run does not leave a partial file.
+
+    Parameters:
+    - filepath (str): Path to the .npy file.
+    - shape (tuple): Shape of the array (frames, height, width).
+    - blocks (Iterable[tuple[int, np.ndarray]]): Index of the first frame and the block of frames.
+    """
+    tmp_path = f"{filepath}.{os.getpid()}.tmp"
+    try:
+        frames = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.float32, shape=shape
+        )
+        for start, block in blocks:
+            frames[start : start + block.shape[0]] = block
+        frames.flush()
+        del frames
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class NormalizedRecording:
+    """
+    Z-normalized versions of a recording, cached as memory-mapped float32 .npy files.
+
+    Two arrays are cached in a directory named after the hash of the file content:
+    the recording z-normalized with the pixelwise mean and standard deviation of the
+    whole recording (the training patches are cropped from it, as in prepare_training),
+    and the rolling window z-normalization (the activity maps are computed from it),
+    without the first and last window_size // 2 frames. The modification time of the
+    directory is updated whenever the recording is opened, the least recently used
+    recordings are deleted by evict_recordings.
+
+    Attributes:
+        filepath (str): Path to the recording.
+        window_size (int): Size of the rolling window.
+        start (int): Frame of the recording of the first frame of rolling_znorm (window_size // 2).
+        file_key (str): Content hash of the recording.
+        directory (str): Cache directory of the recording.
+        znorm (np.memmap): Z-normalized recording (frames, height, width).
+        rolling_znorm (np.memmap): Rolling window z-normalized recording (frames - 2 * start, height, width).
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        window_size: int = 50,
+        cache_dir: str | None = None,
+        block_size: int = 256,
+        num_threads: int = 1,
+    ) -> None:
+        """
+        Open the cached z-normalized recording, create the cache if it does not exist.
+
+        Args:
+            filepath (str): Path to the recording.
+            window_size (int): Size of the rolling window (default: 50).
+            cache_dir (str | None): Directory of the cache (default: ~/.cache/neuroimage_denoiser/recordings).
+            block_size (int): Number of frames processed at once when the cache is created (default: 256).
+            num_threads (int): Number of threads for the mean and standard deviation (default: 1).
+
+        Raises:
+            ValueError: If the file is not an image sequence.
+        """
+        if cache_dir is None:
+            cache_dir = DEFAULT_RECORDING_CACHE_DIR
+        self.filepath = filepath
+        self.window_size = window_size
+        self.start = window_size // 2
+        self.file_key = file_hash(filepath)
+        self.directory = os.path.join(cache_dir, self.file_key)
+        znorm_path = os.path.join(self.directory, "znorm.npy")
+        rolling_path = os.path.join(
+            self.directory, f"rolling_znorm_window{window_size}.npy"
+        )
+        if not os.path.exists(znorm_path) or not os.path.exists(rolling_path):
+            os.makedirs(self.directory, exist_ok=True)
+            self.create(znorm_path, rolling_path, block_size, num_threads)
+        self.znorm = np.load(znorm_path, mmap_mode="r")
+        self.rolling_znorm = np.load(rolling_path, mmap_mode="r")
+        # mark as recently used
+        os.utime(self.directory)
+
+    def create(
+        self, znorm_path: str, rolling_path: str, block_size: int, num_threads: int
+    ) -> None:
+        """
+        Write the missing z-normalized arrays, block by block (like prepare_training
+        with --memory_optimized).
+
+        Args:
+            znorm_path (str): Path of the z-normalized recording.
+            rolling_path (str): Path of the rolling window z-normalized recording.
+            block_size (int): Number of frames processed at once.
+            num_threads (int): Number of threads for the mean and standard deviation.
+        """
+        reader = StackReader(self.filepath, np.float32)
+        with tempfile.TemporaryDirectory(
+            prefix="neuroimage_denoiser_", dir=self.directory
+        ) as tmp_dir:
+            if not reader.random_access:
+                # the rolling window reads overlapping blocks, decode compressed files once
+                decoded_path = os.path.join(tmp_dir, "frames.npy")
+                decode_to_npy(reader, decoded_path, block_size)
+                reader.close()
+                reader = StackReader(decoded_path, np.float32)
+            with reader:
+                if not os.path.exists(znorm_path):
+                    mean, std = normalization.reader_mean_std(
+                        reader, np.float32, block_size, num_threads
+                    )
+                    write_npy_blocks(
+                        znorm_path,
+                        reader.shape,
+                        (
+                            (start, normalization.z_norm(block, mean, std))
+                            for start, block in reader.iter_blocks(block_size)
+                        ),
+                    )
+                if not os.path.exists(rolling_path):
+                    stop = max(self.start, len(reader) - self.start)
+                    write_npy_blocks(
+                        rolling_path,
+                        (stop - self.start,) + reader.shape[1:],
+                        (
+                            (start - self.start, block)
+                            for start, block in normalization.rolling_window_z_norm_blocks(
+                                reader, self.window_size, block_size, self.start, stop
+                            )
+                        ),
+                    )
+
+    def activitymap(
+        self,
+        crop_size: int,
+        roi_size: int,
+        activitymap_cache: ActivityMapCache | None = None,
+    ) -> np.ndarray:
+        """
+        Activity map of the rolling window z-normalized recording.
+
+        Args:
+            crop_size (int): Size of the patches.
+            roi_size (int): Size of the sliding window (Region of Interest).
+            activitymap_cache (ActivityMapCache | None): Cache of the activity maps, shared with
+                prepare_training (default: None, no cache).
+
+        Returns:
+            np.ndarray: Activity map (frames - 2 * start, height // crop_size, width // crop_size).
+        """
+
+        def compute() -> np.ndarray:
+            return compute_activitymap(self.rolling_znorm, crop_size, roi_size)
+
+        if activitymap_cache is None:
+            return compute()
+        return activitymap_cache.get_or_compute(
+            activitymap_cache.path(
+                self.file_key, self.window_size, crop_size, roi_size, np.float32
+            ),
+            compute,
+        )
+
+    def close(self) -> None:
+        """
+        Release the memory-mapped arrays.
+        """
+        self.znorm = None
+        self.rolling_znorm = None
+
+
+class RawPatchSource:
+    """
+    Training patches cropped lazily from cached z-normalized recordings.
+
+    The source only holds an index of the [file, frame, y, x] positions of the
+    foreground and background patches, selected from the activity maps like in
+    prepare_training. The patches are cropped from the memory-mapped z-normalized
+    recordings (see NormalizedRecording) when they are read. Changing crop_size,
+    roi_size, min_z_score or foreground_background_split only recomputes the index,
+    the z-normalized recordings are reused (they only depend on window_size).
+
+    With the same seed, the index and the patches equal the patches that
+    prepare_training --memory_optimized writes for the same directory.
+    The source has the read interface of PatchStore and can be used by the data loaders.
+
+    The cache of the z-normalized recordings is bounded by max_cache_bytes: once the
+    index is built, the least recently used recordings of other trainings are deleted.
+
+    Attributes:
+        recordings (list[NormalizedRecording]): Recordings with at least one patch.
+        index (np.ndarray[int64]): Positions [recording, frame, y, x] of the patches (patches, 4).
+        crop_size (int): Size of the patches.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fileendings: list[str],
+        min_z_score: float = 2.0,
+        crop_size: int = 32,
+        roi_size: int = 4,
+        window_size: int = 50,
+        foreground_background_split: float = 0.5,
+        seed: int | None = None,
+        cache_dir: str | None = None,
+        block_size: int = 256,
+        activitymap_cache: ActivityMapCache | None = None,
+        max_cache_bytes: int | None = 20 * 10**9,
+    ) -> None:
+        """
+        Find the recordings, create the missing cached z-normalizations and build the index.
+
+        Args:
+            directory (str): Directory containing the recordings.
+            fileendings (list[str]): File endings to consider.
+            min_z_score (float): Minimum Z-score of a foreground patch (default: 2.0).
+            crop_size (int): Size of the patches (default: 32).
+            roi_size (int): Size of the sliding window (Region of Interest) (default: 4).
+            window_size (int): Size of the rolling window (default: 50).
+            foreground_background_split (float): Split ratio between foreground and background (default: 0.5).
+            seed (int | None): Seed for the selection of the background patches (default: None, random).
+            cache_dir (str | None): Directory of the cached recordings (default: ~/.cache/neuroimage_denoiser/recordings).
+            block_size (int): Number of frames processed at once when a cache is created (default: 256).
+            activitymap_cache (ActivityMapCache | None): Cache of the activity maps, shared with
+                prepare_training (default: None, no cache).
+            max_cache_bytes (int | None): Maximal size of the cached recordings in bytes, the recordings
+                of this source are kept regardless (default: 20 GB, None: unbounded).
+        """
+        if cache_dir is None:
+            cache_dir = DEFAULT_RECORDING_CACHE_DIR
+        self.crop_size = crop_size
+        self.recordings = []
+        filepaths = find_files(directory, fileendings)
+        print(f"Found {len(filepaths)} file(s).")
+        # every file gets its own random generator, like in prepare_training
+        file_seeds = np.random.SeedSequence(seed).spawn(len(filepaths))
+        num_threads = os.cpu_count() or 1
+        index_blocks = []
+        in_use = []
+        for filepath, file_seed in zip(filepaths, file_seeds):
+            try:
+                recording = NormalizedRecording(
+                    filepath, window_size, cache_dir, block_size, num_threads
+                )
+            except ValueError:
+                print(f"WARNING: skipped ({filepath}), not a series.")
+                continue
+            in_use.append(recording.directory)
+            positions = get_positions_from_activitymap(
+                recording.activitymap(crop_size, roi_size, activitymap_cache),
+                min_z_score,
+                crop_size,
+                foreground_background_split,
+                np.random.default_rng(file_seed),
+            )
+            print(f"Found {len(positions)} example(s) in file {filepath}")
+            if len(positions) == 0:
+                recording.close()
+                continue
+            index = np.empty((len(positions), 4), dtype=np.int64)
+            index[:, 0] = len(self.recordings)
+            index[:, 1:] = positions
+            # correct for frames that were removed from the beginning
+            index[:, 1] += recording.start
+            index_blocks.append(index)
+            self.recordings.append(recording)
+        if len(index_blocks) == 0:
+            self.index = np.empty((0, 4), dtype=np.int64)
+        else:
+            self.index = np.concatenate(index_blocks)
+        if max_cache_bytes is not None and os.path.isdir(cache_dir):
+            evict_recordings(cache_dir, max_cache_bytes, in_use)
+
+    def __enter__(self) -> "RawPatchSource":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        """
+        Returns the number of patches.
+
+        Returns:
+            int: Number of patches.
+        """
+        return len(self.index)
+
+    def read_indices(self, idxs: np.ndarray) -> np.ndarray:
+        """
+        Crop the patches at arbitrary indices. The patches are cropped in the order of
+        the index (recording, frame), which keeps the reads of the memory maps local.
+
+        Args:
+            idxs (np.ndarray[int]): Indices of the patches.
+
+        Returns:
+            np.ndarray[float32]: Patches in the order of idxs (patches, crop_size, crop_size).
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        patches = np.empty((len(idxs), self.crop_size, self.crop_size), np.float32)
+        for i in np.argsort(idxs):
+            recording, frame, y, x = self.index[idxs[i]]
+            patches[i] = self.recordings[recording].znorm[
+                frame, y : y + self.crop_size, x : x + self.crop_size
+            ]
+        return patches
+
+    def read_runs(self, sorted_idxs: np.ndarray) -> np.ndarray:
+        """
+        Crop the patches at ascending indices.
+
+        Args:
+            sorted_idxs (np.ndarray[int]): Ascending indices of the patches.
+
+        Returns:
+            np.ndarray[float32]: Patches in the order of sorted_idxs (patches, crop_size, crop_size).
+        """
+        return self.read_indices(sorted_idxs)
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        """
+        Crop consecutive patches.
+
+        Args:
+            start (int): Index of the first patch.
+            stop (int): Index after the last patch.
+
+        Returns:
+            np.ndarray[float32]: Patches start to stop (patches, crop_size, crop_size).
+        """
+        return self.read_indices(np.arange(start, min(stop, len(self))))
+
+    def close(self) -> None:
+        """
+        Release the memory-mapped recordings.
+        """
+        for recording in self.recordings:
+            recording.close()
+
+
+def raw_source_from_config(trainconfig: dict) -> RawPatchSource | None:
+    """
+    Create the raw recording source of a train config, if it sets train_directory.
+
+    Parameters:
+    - trainconfig (dict): Train config with train_directory, fileendings and the optional
+      sampling settings crop_size, roi_size, min_z_score, window_size, fgsplit, seed,
+      recording_cache_dir, recording_cache_size (GB), activitymap_cache_dir and
+      activitymap_cache_size (defaults as in prepare_training).
+
+    Returns:
+    - RawPatchSource | None: Patch source, None if train_directory is not set.
+    """
+    if trainconfig.get("train_directory") is None:
+        return None
+    activitymap_cache = None
+    if trainconfig.get("activitymap_cache_dir") is not None:
+        activitymap_cache = ActivityMapCache(
+            trainconfig["activitymap_cache_dir"],
+            int(trainconfig.get("activitymap_cache_size", 1.0) * 1e9),
+        )
+    return RawPatchSource(
+        trainconfig["train_directory"],
+        trainconfig["fileendings"],
+        min_z_score=trainconfig.get("min_z_score", 2.0),
+        crop_size=trainconfig.get("crop_size", 32),
+        roi_size=trainconfig.get("roi_size", 4),
+        window_size=trainconfig.get("window_size", 50),
+        foreground_background_split=trainconfig.get("fgsplit", 0.5),
+        seed=trainconfig.get("seed"),
+        cache_dir=trainconfig.get("recording_cache_dir"),
+        activitymap_cache=activitymap_cache,
+        max_cache_bytes=int(trainconfig.get("recording_cache_size", 20.0) * 1e9),
+    )
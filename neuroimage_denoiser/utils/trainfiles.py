@@ -1,12 +1,28 @@
 import os
+import tempfile
+from typing import Callable
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-import h5py
 from alive_progress import alive_bar
 import neuroimage_denoiser.utils.normalization as normalization
-from neuroimage_denoiser.utils.activitymap import get_frames_position
+from neuroimage_denoiser.utils.activitymap import (
+    compute_activitymap,
+    get_positions_from_activitymap,
+)
+from neuroimage_denoiser.utils.activitymapcache import ActivityMapCache
+from neuroimage_denoiser.utils.hashing import file_hash
 
-from neuroimage_denoiser.utils.open_file import open_file
+from neuroimage_denoiser.utils.open_file import open_file, StackReader, decode_to_npy
+from neuroimage_denoiser.utils.h5patches import (
+    PatchStore,
+    max_roi_means,
+    metadata_dtype,
+    merge_encoding_errors,
+    print_encoding_error,
+)
 
 
 class TrainFiles:
@@ -20,6 +36,13 @@ class TrainFiles:
         window_size: int = 50,
         foreground_background_split: float = 0.1,
         overwrite: bool = False,
+        dtype: np.dtype | str = np.float32,
+        seed: int | None = None,
+        compression: str | None = None,
+        storage_dtype: str | None = None,
+        index_roi_sizes: list[int] | None = None,
+        activitymap_cache_dir: str | None = None,
+        activitymap_cache_size: float = 1.0,
     ) -> None:
         """
         Initialize TrainFiles object.
@@ -27,6 +50,18 @@ class TrainFiles:
         Args:
             train_csv_path (str): Path to the CSV file containing training examples information.
             overwrite (bool, optional): If True, overwrite existing files. Default is False.
+            dtype (np.dtype | str, optional): Floating point type used for normalization, temporary
+                files and the stored patches. Default is float32.
+            seed (int, optional): Seed for the selection of the background patches. Default is None (random).
+            compression (str, optional): Compression of the patches dataset of a new h5 file, "gzip" or "lzf".
+                Default is None.
+            storage_dtype (str, optional): Dtype of the patches in a new h5 file ("float16" or "int16" for
+                compact storage). Default is None (dtype).
+            index_roi_sizes (list[int], optional): ROI sizes for which the max. ROI-mean z-score of every
+                patch is stored in the metadata. Default is None ([roi_size]).
+            activitymap_cache_dir (str, optional): Directory in which the activity maps are cached (see
+                ActivityMapCache). Default is None (no cache).
+            activitymap_cache_size (float, optional): Maximal size of the activity map cache in GB. Default is 1.0.
         """
         self.fileendings = fileendings
         self.min_z_score = min_z_score
@@ -36,12 +71,29 @@ class TrainFiles:
         self.window_size = window_size
         self.foreground_background_split = foreground_background_split
         self.overwrite = overwrite
+        self.dtype = np.dtype(dtype)
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.num_threads = os.cpu_count() or 1
+        self.compression = compression
+        self.storage_dtype = storage_dtype
+        self.index_roi_sizes = index_roi_sizes or [roi_size]
+        self.activitymap_cache = None
+        if activitymap_cache_dir is not None:
+            self.activitymap_cache = ActivityMapCache(
+                activitymap_cache_dir, int(activitymap_cache_size * 1e9)
+            )
+        # reconstruction error and dtype of the patches written to the h5 file
+        self.encoding_error = None
+        self.stored_dtype = None
         self.file_list = {}
 
     def files_to_traindata(
         self,
         directory: str,
         memory_optimized=False,
+        scratch_dir: str | None = None,
+        block_size: int = 256,
+        workers: int = 1,
     ):
         """
         Iterates through given directory and searches for all files having the specified fileendings.
@@ -62,6 +114,12 @@ class TrainFiles:
             window_size (int, optional): Size of the rolling window for normalization. Default is 50.
             foreground_background_split (float, optional): Split ratio for foreground and background patches.
                 Default is 0.1.
+            memory_optimized (bool, optional): Process the files out-of-core in blocks of frames. Default is False.
+            scratch_dir (str, optional): Directory for temporary files in memory optimized mode.
+                Default is the system temp directory.
+            block_size (int, optional): Number of frames processed at once in memory optimized mode. Default is 256.
+            workers (int, optional): Number of processes that extract the examples of the files in parallel.
+                The examples are written by this process only, in the order of the files. Default is 1.
         """
         files_to_do = []
 
@@ -76,146 +134,427 @@ class TrainFiles:
         if os.path.exists(self.output_h5_file) and not self.overwrite:
             print("Found existing h5-file. Will append.")
             # find index
-            hf = h5py.File(self.output_h5_file, "a")
-            self.idx = np.max([int(key) for key in hf.keys()]) + 1
-            hf.close()
+            with PatchStore(self.output_h5_file) as store:
+                if store.legacy:
+                    raise ValueError(
+                        f"Cannot append to {self.output_h5_file}, it uses the legacy layout (one dataset per patch). Convert it with convert_h5 first."
+                    )
+                self.idx = len(store)
+                if (
+                    self.storage_dtype is not None
+                    and store.storage_dtype not in (None, self.storage_dtype)
+                ):
+                    print(
+                        f"WARNING: the existing h5-file stores the patches as {store.storage_dtype}, new patches are stored as {store.storage_dtype} as well."
+                    )
         elif os.path.exists(self.output_h5_file) and self.overwrite:
             os.remove(self.output_h5_file)
             # initalize h5 file
-            hf = h5py.File(self.output_h5_file, "w")
+            PatchStore(self.output_h5_file, "w").close()
             self.idx = 0
-            hf.close()
         else:
             # initalize h5 file
-            hf = h5py.File(self.output_h5_file, "w")
+            PatchStore(self.output_h5_file, "w").close()
             self.idx = 0
-            hf.close()
 
+        # every file gets its own random generator, so the examples do not depend on the number of workers
+        file_seeds = self.seed_sequence.spawn(len(files_to_do))
         with alive_bar(len(files_to_do)) as bar:
-            for filepath in files_to_do:
-                if memory_optimized:
-                    self.handle_file_memory_optimized(
-                        filepath, directory
-                    )
-                else:
-                    self.handle_file(filepath)
-                bar()
+            if workers <= 1:
+                for filepath, file_seed in zip(files_to_do, file_seeds):
+                    rng = np.random.default_rng(file_seed)
+                    if memory_optimized:
+                        self.handle_file_memory_optimized(
+                            filepath, scratch_dir, block_size, rng
+                        )
+                    else:
+                        self.handle_file(filepath, rng)
+                    bar()
+            else:
+                num_threads = max(1, (os.cpu_count() or 1) // workers)
+                # spawn fresh interpreters, like the denoising worker pool
+                with ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                ) as executor:
+                    # bound the extracted but unwritten examples held in memory:
+                    # the next file is submitted once the oldest one is written
+                    max_in_flight = 2 * workers
+                    jobs = iter(zip(files_to_do, file_seeds))
+                    in_flight = deque()
+                    while True:
+                        for filepath, file_seed in jobs:
+                            future = executor.submit(
+                                extract_examples_job,
+                                self,
+                                filepath,
+                                file_seed,
+                                memory_optimized,
+                                scratch_dir,
+                                block_size,
+                                num_threads,
+                            )
+                            in_flight.append((filepath, future))
+                            if len(in_flight) >= max_in_flight:
+                                break
+                        if not in_flight:
+                            break
+                        # this process is the only writer, files are appended in order
+                        filepath, future = in_flight.popleft()
+                        self.write_examples(*future.result(), filepath)
+                        bar()
+        if self.encoding_error is not None:
+            print_encoding_error(self.encoding_error, self.stored_dtype)
+
+    def empty_examples(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Result of the extraction of a file without examples.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: No examples and no positions.
+        """
+        return (
+            np.empty((0, self.crop_size, self.crop_size), dtype=self.dtype),
+            np.empty((0, 3), dtype=np.int64),
+        )
+
+    def write_examples(
+        self, examples: np.ndarray, positions: np.ndarray, filepath: str
+    ) -> None:
+        """
+        Append examples and their metadata to the h5 file.
+
+        Args:
+            examples (np.ndarray): Examples (number of examples, crop_size, crop_size).
+            positions (np.ndarray): Positions [frame, y, x] of the examples in the recording.
+            filepath (str): Path to the recording.
+        """
+        if len(examples) == 0:
+            return
+        metadata = np.empty(
+            len(examples), dtype=metadata_dtype(len(self.index_roi_sizes))
+        )
+        metadata["frame"] = positions[:, 0]
+        metadata["y"] = positions[:, 1]
+        metadata["x"] = positions[:, 2]
+        # computed before the examples are encoded in the storage dtype
+        metadata["max_roi_mean"] = max_roi_means(examples, self.index_roi_sizes)
+        with PatchStore(self.output_h5_file, "a") as store:
+            metadata["source"] = store.add_sources([filepath])
+            store.append(
+                examples,
+                self.compression,
+                storage_dtype=self.storage_dtype,
+                metadata=metadata,
+                roi_sizes=self.index_roi_sizes,
+            )
+            self.encoding_error = merge_encoding_errors(
+                self.encoding_error, store.encoding_error()
+            )
+            self.stored_dtype = store.storage_dtype
+        self.idx += len(examples)
+
+    def activitymap_cache_path(self, filepath: str) -> str | None:
+        """
+        Path of the cached activity map of a recording with the current settings.
 
-        if memory_optimized:
-            os.remove(os.path.join(directory, "mmap_time_file.npy"))
-            os.remove(os.path.join(directory, "mmap_time_znorm_file.npy"))
-            os.remove(os.path.join(directory, "mmap_std.npy"))
-            os.remove(os.path.join(directory, "mmap_mean.npy"))
-        hf.close()
+        Args:
+            filepath (str): Path to the recording.
 
+        Returns:
+            str | None: Path in the activity map cache, None without cache.
+        """
+        if self.activitymap_cache is None:
+            return None
+        return self.activitymap_cache.path(
+            file_hash(filepath),
+            self.window_size,
+            self.crop_size,
+            self.roi_size,
+            self.dtype,
+        )
+
+    def load_activitymap(
+        self, cache_path: str | None, compute: Callable[[], np.ndarray]
+    ) -> np.ndarray:
+        """
+        Load the activity map from the cache, or compute (and cache) it.
+
+        Args:
+            cache_path (str | None): Path in the activity map cache (see activitymap_cache_path).
+            compute (Callable[[], np.ndarray]): Computes the activity map.
+
+        Returns:
+            np.ndarray: Activity map.
+        """
+        if cache_path is None:
+            return compute()
+        return self.activitymap_cache.get_or_compute(cache_path, compute)
 
     def handle_file(
         self,
         filepath: str,
+        rng: np.random.Generator | None = None,
     ) -> None:
-        file = open_file(filepath)
+        """
+        Extract the training examples of a file in memory and append them to the h5 file.
+        """
+        self.write_examples(*self.extract_examples(filepath, rng), filepath)
+
+    def extract_examples(
+        self,
+        filepath: str,
+        rng: np.random.Generator | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Extract the training examples of a file in memory.
+
+        Args:
+            filepath (str): Path to the recording.
+            rng (np.random.Generator, optional): Random generator for the selection of the background patches.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Examples (number of examples, crop_size, crop_size) and their
+                positions [frame, y, x] in the recording.
+        """
+        file = open_file(filepath, self.dtype)
         if len(file.shape) <= 2:
             print(f"WARNING: skipped ({filepath}), not a series.")
-            return
-        # remove inital and last frames to avoid artifacts from start/end recording + rolling window normalization artifacts
-        file_znorm = normalization.rolling_window_z_norm(file, self.window_size)[self.window_size//2:(file.shape[0]-self.window_size//2)]
+            return self.empty_examples()
+
+        def activitymap() -> np.ndarray:
+            # remove inital and last frames to avoid artifacts from start/end recording + rolling window normalization artifacts
+            file_znorm = normalization.rolling_window_z_norm(file, self.window_size)[self.window_size//2:(file.shape[0]-self.window_size//2)]
+            return compute_activitymap(file_znorm, self.crop_size, self.roi_size)
+
+        cache_path = self.activitymap_cache_path(filepath)
+        frames_activitymap = self.load_activitymap(cache_path, activitymap)
         # will go through all frames and extract events that within a meaned kernel exceed the
         # min_z_score threshold
         # returns a list of events in the form [frame, y-coord, x-coord]
-        frames_and_positions = get_frames_position(
-            file_znorm,
+        frames_and_positions = get_positions_from_activitymap(
+            frames_activitymap,
             self.min_z_score,
             self.crop_size,
-            self.roi_size,
             self.foreground_background_split,
+            rng,
         )
         print(f"Found {len(frames_and_positions)} example(s) in file {filepath}")
         if len(frames_and_positions) == 0:
-            return
-        mean = np.mean(file, axis=0)
-        std = np.std(file, axis=0)
+            return self.empty_examples()
+        mean, std = normalization.mean_std(
+            file, self.dtype, num_threads=self.num_threads
+        )
         file = normalization.z_norm(file, mean, std)
-        hf = h5py.File(self.output_h5_file, "a")
-        # create dict to be stored as h5 file
-        for event in frames_and_positions:
+        examples = np.empty(
+            (len(frames_and_positions), self.crop_size, self.crop_size),
+            dtype=self.dtype,
+        )
+        for i, event in enumerate(frames_and_positions):
             target_frame, y_pos, x_pos = event
             # correct for frames that were removed from the begining
             target_frame += self.window_size//2
-            example = file[
+            examples[i] = file[
                 target_frame,
                 y_pos : y_pos + self.crop_size,
                 x_pos : x_pos + self.crop_size,
             ]
-            hf.create_dataset(str(self.idx), data=example)
-            self.idx += 1
-        hf.close()
+        positions = np.array(frames_and_positions, dtype=np.int64)
+        positions[:, 0] += self.window_size // 2
+        return examples, positions
 
     def handle_file_memory_optimized(
-        self, filepath: str, directory: str
+        self,
+        filepath: str,
+        scratch_dir: str | None = None,
+        block_size: int = 256,
+        rng: np.random.Generator | None = None,
     ) -> None:
-        file = open_file(filepath)
-        if len(file.shape) <= 2:
-            print(f"WARNING: skipped ({filepath}), not a series.")
-            return
-        # -- numpy memmaps --
-        mmap_file_path = os.path.join(directory, "mmap_time_file.npy")
-        file_shape = file.shape
-        np.save(mmap_file_path, file)
-        # wrap memmap around file on disk
-        mmap_file = np.memmap(
-            mmap_file_path, dtype="float64", mode="w+", shape=file_shape
-        )
-        mmap_file[:] = file[:]
-        # clear ram by removing file
-        del file
-        # flush mmap to disk
-        mmap_file.flush()
-
-        mmap_znorm_file_path = os.path.join(directory, "mmap_time_znorm_file.npy")
-        # wrap memmap around file on disk
-        mmap_znorm_file = np.memmap(
-            mmap_znorm_file_path, dtype="float64", mode="w+", shape=file_shape
+        """
+        Extract the training examples of a file out-of-core and append them to the h5 file.
+        """
+        self.write_examples(
+            *self.extract_examples_memory_optimized(
+                filepath, scratch_dir, block_size, rng
+            ),
+            filepath,
         )
+
+    def extract_examples_memory_optimized(
+        self,
+        filepath: str,
+        scratch_dir: str | None = None,
+        block_size: int = 256,
+        rng: np.random.Generator | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Extract the training examples of a file out-of-core.
+
+        The recording is processed in blocks of block_size frames (with a halo of
+        window_size frames for the rolling window z-normalization), so the peak memory
+        usage depends on the block size and not on the length of the recording. Only
+        the activity map, which has one value per frame and crop, is kept for the whole
+        recording. Recordings that cannot be read in random order (compressed tiff
+        files) are decoded once into a temporary .npy file in a unique directory
+        within scratch_dir, which is removed afterwards; not if their activity map
+        is cached, the examples are read frame by frame then.
+
+        Args:
+            filepath (str): Path to the recording.
+            scratch_dir (str, optional): Directory for temporary files (default: system temp directory).
+            block_size (int): Number of frames processed at once.
+            rng (np.random.Generator, optional): Random generator for the selection of the background patches.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Examples (number of examples, crop_size, crop_size) and their
+                positions [frame, y, x] in the recording.
+        """
+        try:
+            reader = StackReader(filepath, self.dtype)
+        except ValueError:
+            print(f"WARNING: skipped ({filepath}), not a series.")
+            return self.empty_examples()
+        cache_path = self.activitymap_cache_path(filepath)
+        frames_activitymap = None
+        if cache_path is not None:
+            frames_activitymap = self.activitymap_cache.get(cache_path)
+        with tempfile.TemporaryDirectory(
+            prefix="neuroimage_denoiser_", dir=scratch_dir
+        ) as tmp_dir:
+            if not reader.random_access and frames_activitymap is None:
+                decoded_path = os.path.join(tmp_dir, "frames.npy")
+                decode_to_npy(reader, decoded_path, block_size)
+                reader.close()
+                reader = StackReader(decoded_path, self.dtype)
+            with reader:
+                return self.extract_examples_blockwise(
+                    reader, filepath, block_size, rng, cache_path, frames_activitymap
+                )
+
+    def extract_examples_blockwise(
+        self,
+        reader: StackReader,
+        filepath: str,
+        block_size: int,
+        rng: np.random.Generator | None = None,
+        cache_path: str | None = None,
+        frames_activitymap: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Extract the training examples of a recording block by block.
+
+        Args:
+            reader (StackReader): Reader of the recording (random access).
+            filepath (str): Path to the recording, used for messages.
+            block_size (int): Number of frames processed at once.
+            rng (np.random.Generator, optional): Random generator for the selection of the background patches.
+            cache_path (str, optional): Path of the activity map in the activity map cache (None: no cache).
+            frames_activitymap (np.ndarray, optional): Activity map that was already loaded from the cache
+                (None: load or compute it).
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Examples (number of examples, crop_size, crop_size) and their
+                positions [frame, y, x] in the recording.
+        """
+        num_frames = len(reader)
         # remove inital and last frames to avoid artifacts from start/end recording + rolling window normalization artifacts
-        znorm_file = normalization.rolling_window_z_norm_memory_optimized(
-            mmap_file, self.window_size, directory
-        )[self.window_size//2:(mmap_file.shape[0]-self.window_size//2)]
-        mmap_znorm_file[:] = znorm_file[:]
-        # flush mmap to disk
-        del znorm_file
-        mmap_znorm_file.flush()
+        start = self.window_size // 2
+        stop = num_frames - self.window_size // 2
+
+        def activitymap() -> np.ndarray:
+            activitymap_blocks = [
+                compute_activitymap(block, self.crop_size, self.roi_size)
+                for _, block in normalization.rolling_window_z_norm_blocks(
+                    reader, self.window_size, block_size, start, stop
+                )
+            ]
+            if len(activitymap_blocks) == 0:
+                return np.empty(
+                    (
+                        0,
+                        reader.shape[1] // self.crop_size,
+                        reader.shape[2] // self.crop_size,
+                    ),
+                    dtype=self.dtype,
+                )
+            return np.concatenate(activitymap_blocks)
+
+        if frames_activitymap is None:
+            frames_activitymap = self.load_activitymap(cache_path, activitymap)
         # will go through all frames and extract events that within a meaned kernel exceed the
         # min_z_score threshold
         # returns a list of events in the form [frame, y-coord, x-coord]
-        frames_and_positions = get_frames_position(
-            mmap_znorm_file,
+        frames_and_positions = get_positions_from_activitymap(
+            frames_activitymap,
             self.min_z_score,
             self.crop_size,
-            self.roi_size,
             self.foreground_background_split,
+            rng,
         )
-
         print(f"Found {len(frames_and_positions)} example(s) in file {filepath}")
-
         if len(frames_and_positions) == 0:
-            return
-
-        mean = np.mean(mmap_file, axis=0)
-        std = np.std(mmap_file, axis=0)
-
-        mmap_file[:] = normalization.z_norm(mmap_file, mean, std)[:]
-
-        # create dict to be stored as h5 file
-        hf = h5py.File(self.output_h5_file, "a")
-        for event in frames_and_positions:
-            target_frame, y_pos, x_pos = event
+            return self.empty_examples()
+        mean, std = normalization.reader_mean_std(
+            reader, self.dtype, block_size, self.num_threads
+        )
+        # examples keep their index in the order of frames_and_positions, but are
+        # extracted frame by frame so that every frame is read and normalized once
+        order = sorted(
+            range(len(frames_and_positions)), key=lambda i: frames_and_positions[i][0]
+        )
+        examples = np.empty(
+            (len(frames_and_positions), self.crop_size, self.crop_size),
+            dtype=self.dtype,
+        )
+        current_frame = -1
+        frame = None
+        for i in order:
+            target_frame, y_pos, x_pos = frames_and_positions[i]
             # correct for frames that were removed from the begining
-            target_frame += self.window_size//2
-            example = mmap_file[
-                target_frame,
+            target_frame += start
+            if target_frame != current_frame:
+                frame = normalization.z_norm(
+                    reader.read(target_frame, target_frame + 1)[0], mean, std
+                )
+                current_frame = target_frame
+            examples[i] = frame[
                 y_pos : y_pos + self.crop_size,
                 x_pos : x_pos + self.crop_size,
             ]
-            hf.create_dataset(str(self.idx), data=example)
-            self.idx += 1
-        hf.close()
+        positions = np.array(frames_and_positions, dtype=np.int64)
+        positions[:, 0] += start
+        return examples, positions
+
+
+def extract_examples_job(
+    trainfiles: TrainFiles,
+    filepath: str,
+    seed: np.random.SeedSequence,
+    memory_optimized: bool,
+    scratch_dir: str | None,
+    block_size: int,
+    num_threads: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Extract the training examples of a single file in a worker process.
+
+    Args:
+        trainfiles (TrainFiles): Settings of the extraction (copy of the parent's object).
+        filepath (str): Path to the recording.
+        seed (np.random.SeedSequence): Seed of the file for the selection of the background patches.
+        memory_optimized (bool): Process the file out-of-core in blocks of frames.
+        scratch_dir (str, optional): Directory for temporary files in memory optimized mode.
+        block_size (int): Number of frames processed at once in memory optimized mode.
+        num_threads (int): Number of threads of the worker for the mean and standard deviation.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Examples (number of examples, crop_size, crop_size) and their
+            positions [frame, y, x] in the recording.
+    """
+    trainfiles.num_threads = num_threads
+    rng = np.random.default_rng(seed)
+    if memory_optimized:
+        return trainfiles.extract_examples_memory_optimized(
+            filepath, scratch_dir, block_size, rng
+        )
+    return trainfiles.extract_examples(filepath, rng)
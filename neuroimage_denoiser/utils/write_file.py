@@ -1,3 +1,5 @@
+import os
+from typing import Iterable
 import numpy as np
 import tifffile
 
@@ -27,3 +29,43 @@ def write_file(img: np.ndarray, filepath: str) -> None:
         raise NotImplementedError(
             f'Fileformat .{filepath.split(".")[-1]} is currently not implemented. Please change utils/open_file.py'
         )
+
+
+def write_file_blocks(
+    blocks: Iterable[np.ndarray], shape: tuple[int, int, int], filepath: str
+) -> None:
+    """
+    Write an image sequence block by block to the specified filepath.
+
+    Only one block has to be held in memory at a time. If writing fails,
+    the incomplete file is removed.
+
+    Parameters:
+    - blocks (Iterable[np.ndarray[np.uint16]]): Consecutive blocks of frames.
+    - shape (tuple[int, int, int]): Shape of the complete image sequence (frames, height, width).
+    - filepath (str): Path to the output file.
+
+    Raises:
+    - NotImplementedError: If the file format is not supported.
+
+    Supported file formats:
+    - .tif, .tiff, .stk (using tifffile library)
+    """
+    tiff_fileendings = [".tif", ".tiff", ".stk"]
+    if not any([filepath.endswith(fileending) for fileending in tiff_fileendings]):
+        raise NotImplementedError(
+            f'Fileformat .{filepath.split(".")[-1]} is currently not implemented. Please change utils/write_file.py'
+        )
+    frames = (frame for block in blocks for frame in block)
+    # tiff files exceeding 4 GB require the BigTIFF format
+    bigtiff = (
+        np.prod(shape, dtype=np.int64) * np.dtype(np.uint16).itemsize > 2**32 - 2**25
+    )
+    try:
+        tifffile.imwrite(
+            filepath, frames, shape=shape, dtype=np.uint16, bigtiff=bigtiff
+        )
+    except BaseException:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        raise